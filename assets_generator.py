@@ -2,20 +2,39 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 import configparser
-from copy import deepcopy
 from datetime import datetime
+import hashlib
+import io
 import json
 import os
 import re
 import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
 from util import colorise
 import springer_compact_coverage as scc
+import cache_index
+import embedded_store
+import preaggregates
+from response_cache import DATA_VERSION_FILE, read_data_version
+import snapshots
 
 import sqlalchemy
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STREAMING_BATCH_SIZE = 5000
+STREAMING_MAX_BUFFERED_ROWS = 100000
+
 ARG_HELP_STRINGS = {
 
     "dir": "A path to a directory where the generated output files should be stored. " +
@@ -25,7 +44,60 @@ ARG_HELP_STRINGS = {
                        "reducing API loads and saving results from time to time.",
     "refetch": "Try to re-fetch a journal csv file from Springerlink during the " +
                "coverage_stats job when a DOI is not found. Only useful if the journal csv " +
-               "directory has not been cleared recently."
+               "directory has not been cleared recently.",
+    "streaming": "Insert rows into the database tables in batches while the source files " +
+                 "are being processed (tables job), instead of collecting all rows before " +
+                 "populating the tables. The number of rows buffered across all tables is " +
+                 "limited by --max_buffered_rows. Lookup data (institutions, additional costs, " +
+                 "coverage caches) is still held in memory as a whole.",
+    "batch_size": "Number of rows written per insert batch when using --streaming " +
+                  "(Default: " + str(STREAMING_BATCH_SIZE) + ").",
+    "max_buffered_rows": "Maximum number of rows buffered across all tables when using --streaming. " +
+                         "If exceeded, the largest buffers are written out early " +
+                         "(Default: " + str(STREAMING_MAX_BUFFERED_ROWS) + ").",
+    "use_inserts": "Populate database tables using SQLAlchemy INSERT statements instead " +
+                   "of PostgreSQL's COPY command (tables job). Much slower, mainly " +
+                   "useful for comparison.",
+    "incremental": "Only rewrite tables whose content changed since the last build " +
+                   "(tables job). Unchanged tables are detected by comparing row " +
+                   "fingerprints against the last build (table_fingerprints.json) " +
+                   "and carried over from the live schema. Only the database writes are " +
+                   "saved, the source files are still processed in full and " +
+                   "institutional_cubes.csv is always rewritten completely.",
+    "partitioned": "Store the rows of each cube type only once, in an aggregated table " +
+                   "list-partitioned by institution (tables job). Institutional cubes " +
+                   "are served from the partitions instead of separate tables. " +
+                   "Requires PostgreSQL 11 or later.",
+    "engine": "ETL implementation used by the tables job. 'rows' processes the source " +
+              "files row by row, 'columnar' loads them into numpy arrays and applies " +
+              "the enrichment steps to whole columns (requires numpy). Both produce " +
+              "identical tables.",
+    "jobs": "Number of worker processes used to process the source files in parallel " +
+            "(tables job). Rows are collected per file and merged in a fixed order, " +
+            "so the result is the same as with a single process (Default: 1).",
+    "load_workers": "Number of tables which are written to the database concurrently " +
+                    "(tables job). Each worker uses a connection of its own, the " +
+                    "connection pool is limited accordingly (Default: 1).",
+    "warm_url": "Base URL of the OLAP server to send the requests of the warm job to " +
+                "(Default: http://localhost:3001).",
+    "warm_workers": "Maximum number of concurrent requests during the warm job (Default: 4).",
+    "snapshot_format": "File format of the snapshots job, 'parquet' (Default) or 'arrow' (Arrow IPC). " +
+                       "Requires pyarrow.",
+    "institutional_snapshots": "Also write snapshots of all institutional cubes during the snapshots " +
+                               "job, not just of the aggregated tables.",
+    "fetch_workers": "Number of concurrent SpringerLink requests during the coverage_stats job (Default: 4).",
+    "rate_limit": "Maximum number of SpringerLink requests per second during the coverage_stats job, " +
+                  "across all workers (Default: 2).",
+    "sqlite_file": "Build the tables into an embedded SQLite database file instead of PostgreSQL " +
+                   "(tables and rollback_tables jobs). No database server is required, serve the " +
+                   "file with a slicer configuration pointing to it (see slicer_sqlite.ini).",
+    "dry_run": "Only plan the coverage_stats job and report the remaining work and an estimate " +
+               "of the number of SpringerLink requests, without performing any lookups.",
+    "replan": "Plan the work queue of the coverage_stats job again, even if the catalogue and " +
+              "transformative agreements files have not changed since the last run.",
+    "lazy_model": "Write a lazy model file (model_lazy.json) during the model job, from which " +
+                  "the slicer only builds the institutional cubes when they are first requested " +
+                  "(see model_provider.py)."
 }
 
 APC_DE_FILE = "../openapc-de/data/apc_de.csv"
@@ -36,7 +108,35 @@ DEAL_SPRINGER_OPT_OUT_FILE = "../openapc-de/data/transformative_agreements/deal_
 INSTITUTIONS_FILE = "../openapc-de/data/institutions.csv"
 ADDITIONAL_COSTS_FILE = "../openapc-de/data/apc_de_additional_costs.csv"
 
+# All input files of the tables job, used to derive the build identifier
+SOURCE_FILES = [APC_DE_FILE, BPC_FILE, TRANSFORMATIVE_AGREEMENTS_FILE, DEAL_WILEY_OPT_OUT_FILE,
+                DEAL_SPRINGER_OPT_OUT_FILE, INSTITUTIONS_FILE, ADDITIONAL_COSTS_FILE,
+                scc.COVERAGE_CACHE_FILE, scc.PUBDATES_CACHE_FILE]
+
 CUBES_LIST_FILE = "institutional_cubes.csv"
+
+# Output of the model job with --lazy_model and the name of its model provider
+# (model_provider.LAZY_PROVIDER_NAME)
+LAZY_MODEL_FILE = "model_lazy.json"
+LAZY_MODEL_PROVIDER = "openapc_lazy"
+
+WARM_URL = "http://localhost:3001"
+TABLE_FINGERPRINTS_FILE = "table_fingerprints.json"
+# Part of every table fingerprint. Increase it whenever the way tables are
+# created changes (column types, keys, indexes), so an incremental build
+# does not carry over tables of the old shape.
+TABLE_SCHEMA_VERSION = 2
+
+# Files describing the current build. The tables job writes them with a
+# ".staging" suffix and rotates them into place after a successful swap,
+# keeping the replaced versions with a ".previous" suffix.
+BUILD_STATE_FILES = [CUBES_LIST_FILE, TABLE_FINGERPRINTS_FILE, DATA_VERSION_FILE]
+
+# The tables job builds into STAGING_SCHEMA and then swaps it with LIVE_SCHEMA,
+# the replaced tables are kept in PREVIOUS_SCHEMA for rollback.
+LIVE_SCHEMA = "openapc_schema"
+STAGING_SCHEMA = "openapc_schema_staging"
+PREVIOUS_SCHEMA = "openapc_schema_previous"
 CUBES_PRIORITIES = ["apc", "apc_ac", "bpc", "ta", "deal"] # Treemap hierarchy menu order from left to right
 
 DEAL_WILEY_START_YEAR = datetime(2019, 1, 1)
@@ -65,6 +165,38 @@ YAML_STATIC_FILES = {
     "deal": "YAML_STATIC_PART_DEAL"
 }
 
+# Aggregated tables holding the same rows as the institutional tables of a
+# certain type. Used as partitioned parent tables in partitioned mode.
+PARTITIONED_TABLES = {
+    "apc": "openapc",
+    "apc_ac": "openapc_ac",
+    "bpc": "bpc",
+    "ta": "transformative_agreements",
+    "deal": "deal"
+}
+
+# Every cube table has a serial id column. It is the key used for keyset
+# pagination of facts (see facts_export.py).
+ID_COLUMN = "id"
+
+# Dimensions most cubes requests cut on: The treemaps drill down by
+# institution, period, publisher and hybrid status and the DOI lookup
+# URLs (see _create_lookup_data) cut by doi. Tables are indexed on these
+# and on all fields used as filters or drilldowns in their YAML templates.
+COMMON_CUT_DIMENSIONS = ["institution", "period", "publisher", "is_hybrid", "doi"]
+
+# Institutional table types of aggregated tables, used to find their YAML templates
+AGGREGATED_TABLE_TYPES = {
+    "openapc": "apc",
+    "openapc_ac": "apc_ac",
+    "bpc": "bpc",
+    "transformative_agreements": "ta",
+    "deal": "deal",
+    "combined": "apc"
+}
+
+YAML_FIELD_RE = re.compile(r"^\s*-\s+(field:\s*)?'?(?P<field>\w+)'?\s*$")
+
 TABLE_SCHEMAS = {
     "bpc": [
         ("institution", "string"),
@@ -177,13 +309,47 @@ TABLE_SCHEMAS = {
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("job", choices=["tables", "model", "yamls", "db_settings",
-                                        "coverage_stats"])
+    parser.add_argument("job", choices=["tables", "rollback_tables", "model", "yamls",
+                                        "db_settings", "coverage_stats", "cache_index", "warm", "snapshots"])
     parser.add_argument("-d", "--dir", help=ARG_HELP_STRINGS["dir"])
     parser.add_argument("-n", "--num_api_lookups", type=int,
                         help=ARG_HELP_STRINGS["num_api_lookups"])
     parser.add_argument("--refetch", action="store_true",
                         help=ARG_HELP_STRINGS["refetch"])
+    parser.add_argument("--streaming", action="store_true",
+                        help=ARG_HELP_STRINGS["streaming"])
+    parser.add_argument("--batch_size", type=int, default=STREAMING_BATCH_SIZE,
+                        help=ARG_HELP_STRINGS["batch_size"])
+    parser.add_argument("--max_buffered_rows", type=int, default=STREAMING_MAX_BUFFERED_ROWS,
+                        help=ARG_HELP_STRINGS["max_buffered_rows"])
+    parser.add_argument("--use_inserts", action="store_true",
+                        help=ARG_HELP_STRINGS["use_inserts"])
+    parser.add_argument("--incremental", action="store_true",
+                        help=ARG_HELP_STRINGS["incremental"])
+    parser.add_argument("--partitioned", action="store_true",
+                        help=ARG_HELP_STRINGS["partitioned"])
+    parser.add_argument("--engine", choices=["rows", "columnar"], default="rows",
+                        help=ARG_HELP_STRINGS["engine"])
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=ARG_HELP_STRINGS["jobs"])
+    parser.add_argument("--load_workers", type=int, default=1,
+                        help=ARG_HELP_STRINGS["load_workers"])
+    parser.add_argument("--warm_url", default=WARM_URL,
+                        help=ARG_HELP_STRINGS["warm_url"])
+    parser.add_argument("--warm_workers", type=int, default=4,
+                        help=ARG_HELP_STRINGS["warm_workers"])
+    parser.add_argument("--snapshot_format", choices=sorted(snapshots.FORMATS), default="parquet",
+                        help=ARG_HELP_STRINGS["snapshot_format"])
+    parser.add_argument("--institutional_snapshots", action="store_true",
+                        help=ARG_HELP_STRINGS["institutional_snapshots"])
+    parser.add_argument("--fetch_workers", type=int, default=4,
+                        help=ARG_HELP_STRINGS["fetch_workers"])
+    parser.add_argument("--rate_limit", type=float, default=2.0,
+                        help=ARG_HELP_STRINGS["rate_limit"])
+    parser.add_argument("--sqlite_file", help=ARG_HELP_STRINGS["sqlite_file"])
+    parser.add_argument("--dry_run", action="store_true", help=ARG_HELP_STRINGS["dry_run"])
+    parser.add_argument("--lazy_model", action="store_true", help=ARG_HELP_STRINGS["lazy_model"])
+    parser.add_argument("--replan", action="store_true", help=ARG_HELP_STRINGS["replan"])
     args = parser.parse_args()
 
     path = "."
@@ -194,26 +360,37 @@ def main():
             print("ERROR: '" + args.dir + "' is no valid directory!")
 
     if args.job == "tables":
-        if not os.path.isfile("db_settings.ini"):
-            print("ERROR: Database Configuration file db_settings.ini not found!")
-            sys.exit()
-        cparser = configparser.ConfigParser()
-        cparser.read("db_settings.ini")
-        try:
-            db_user = cparser.get("postgres_credentials", "user")
-            db_pass = cparser.get("postgres_credentials", "pass")
-        except (configparser.NoSectionError, configparser.NoOptionError) as e:
-            print("ERROR: db_settings.ini is malformed ({})".format(e.message))
-            sys.exit()
-        psql_uri = "postgresql://" + db_user + ":" + db_pass + "@localhost/openapc_db"
-        engine = sqlalchemy.create_engine(psql_uri)
-        create_cubes_tables(engine)
-        with engine.begin() as connection:
-            connection.execute("GRANT SELECT ON ALL TABLES IN SCHEMA openapc_schema TO cubes_user")
-
-
+        if args.incremental and args.streaming:
+            parser.error("--incremental cannot be combined with --streaming")
+        if args.incremental and args.partitioned:
+            parser.error("--incremental cannot be combined with --partitioned")
+        if args.engine == "columnar" and numpy is None:
+            parser.error("The columnar engine requires numpy, which could not be imported")
+        if args.sqlite_file:
+            if args.incremental or args.partitioned:
+                parser.error("--sqlite_file cannot be combined with --incremental or --partitioned")
+            if args.load_workers > 1:
+                parser.error("--sqlite_file cannot be combined with --load_workers, SQLite has a single writer")
+            build_embedded_tables(args.sqlite_file, streaming=args.streaming, batch_size=args.batch_size,
+                                  max_buffered_rows=args.max_buffered_rows, engine=args.engine, jobs=args.jobs)
+            return
+        if args.load_workers > 1:
+            engine = _create_db_engine(pool_size=args.load_workers)
+        else:
+            engine = _create_db_engine()
+        build_cubes_tables(engine, incremental=args.incremental, streaming=args.streaming,
+                           batch_size=args.batch_size, max_buffered_rows=args.max_buffered_rows,
+                           use_copy=not args.use_inserts,
+                           partitioned=args.partitioned, engine=args.engine, jobs=args.jobs,
+                           load_workers=args.load_workers)
+    elif args.job == "rollback_tables":
+        if args.sqlite_file:
+            rollback_embedded_tables(args.sqlite_file)
+            return
+        engine = _create_db_engine()
+        rollback_cubes_tables(engine)
     elif args.job == "model":
-        generate_model_file(path)
+        generate_model_file(path, lazy=args.lazy_model)
     elif args.job == "yamls":
         generate_yamls(path)
     elif args.job == "db_settings":
@@ -227,7 +404,269 @@ def main():
         with open('db_settings.ini', 'w') as config_file:
             cparser.write(config_file)
     elif args.job == "coverage_stats":
-        scc.update_coverage_stats(TRANSFORMATIVE_AGREEMENTS_FILE, args.num_api_lookups, args.refetch)
+        scc.update_coverage_stats(TRANSFORMATIVE_AGREEMENTS_FILE, args.num_api_lookups, args.refetch,
+                                  args.fetch_workers, args.rate_limit, args.dry_run, args.replan)
+    elif args.job == "cache_index":
+        scc.update_cache_indexes()
+    elif args.job == "warm":
+        warm_caches(path, args.warm_url, args.warm_workers)
+    elif args.job == "snapshots":
+        if snapshots.pyarrow is None:
+            parser.error("The snapshots job requires pyarrow, which could not be imported")
+        engine = _create_db_engine()
+        create_snapshots(engine, path, args.snapshot_format, args.institutional_snapshots)
+
+def _create_db_engine(pool_size=None):
+    """
+    Create an engine for the OpenAPC database.
+
+    If pool_size is set, the engine will never open more than pool_size
+    connections at the same time.
+    """
+    if not os.path.isfile("db_settings.ini"):
+        print("ERROR: Database Configuration file db_settings.ini not found!")
+        sys.exit()
+    cparser = configparser.ConfigParser()
+    cparser.read("db_settings.ini")
+    try:
+        db_user = cparser.get("postgres_credentials", "user")
+        db_pass = cparser.get("postgres_credentials", "pass")
+    except (configparser.NoSectionError, configparser.NoOptionError) as e:
+        print("ERROR: db_settings.ini is malformed ({})".format(e.message))
+        sys.exit()
+    psql_uri = "postgresql://" + db_user + ":" + db_pass + "@localhost/openapc_db"
+    if pool_size is not None:
+        return sqlalchemy.create_engine(psql_uri, pool_size=pool_size, max_overflow=0)
+    return sqlalchemy.create_engine(psql_uri)
+
+def _schema_exists(connection, schema):
+    query = sqlalchemy.text("SELECT 1 FROM information_schema.schemata WHERE schema_name = :schema")
+    return connection.execute(query, schema=schema).first() is not None
+
+def _list_tables(connection, schema):
+    query = sqlalchemy.text("SELECT tablename FROM pg_tables WHERE schemaname = :schema")
+    return set([row[0] for row in connection.execute(query, schema=schema)])
+
+def build_cubes_tables(engine, incremental=False, **table_options):
+    """
+    Build all cube tables into a fresh staging schema and swap it into place.
+
+    In incremental mode, tables whose fingerprint did not change since the
+    last build are not written again but moved over from the live schema
+    during the swap.
+
+    Args:
+        engine: An SQLAlchemy engine.
+        incremental: Bool. Only rewrite tables with changed content.
+        table_options: Additional keyword arguments for create_cubes_tables().
+    """
+    previous_fingerprints = {}
+    if incremental:
+        previous_fingerprints = _load_table_fingerprints(engine)
+    # Build everything into a fresh staging schema first, the live schema
+    # is only replaced once all tables have been populated successfully.
+    prepare_staging_schema(engine)
+    fingerprints, unchanged_tables = create_cubes_tables(engine, schema=STAGING_SCHEMA,
+                                                         cubes_list_file=CUBES_LIST_FILE + ".staging",
+                                                         previous_fingerprints=previous_fingerprints,
+                                                         **table_options)
+    with open(TABLE_FINGERPRINTS_FILE + ".staging", "w") as f:
+        f.write(json.dumps(fingerprints, sort_keys=True, indent=4, separators=(',', ': ')))
+    write_data_version(DATA_VERSION_FILE + ".staging", fingerprints)
+    finalise_staging_schema(engine)
+    swap_schemas(engine, carry_over=unchanged_tables)
+    _rotate_build_state_files()
+
+def build_embedded_tables(db_file, **table_options):
+    """
+    Build all cube tables into an embedded SQLite database file.
+
+    The counterpart of build_cubes_tables: The tables are built into a
+    staging file, which replaces db_file once all tables have been
+    populated. The replaced file is kept with a ".previous" suffix for
+    rollback. There are no schemas in SQLite, so the tables are created
+    without one.
+
+    Args:
+        db_file: Path of the SQLite database file.
+        table_options: Additional keyword arguments for create_cubes_tables().
+    """
+    staging_file = db_file + ".staging"
+    if os.path.isfile(staging_file):
+        os.remove(staging_file)
+    engine = embedded_store.create_sqlite_engine(staging_file, bulk_load=True)
+    # COPY is specific to PostgreSQL
+    fingerprints, _ = create_cubes_tables(engine, schema=None, cubes_list_file=CUBES_LIST_FILE + ".staging",
+                                          use_copy=False, **table_options)
+    engine.dispose()
+    with open(TABLE_FINGERPRINTS_FILE + ".staging", "w") as f:
+        f.write(json.dumps(fingerprints, sort_keys=True, indent=4, separators=(',', ': ')))
+    write_data_version(DATA_VERSION_FILE + ".staging", fingerprints)
+    if os.path.isfile(db_file):
+        os.replace(db_file, db_file + ".previous")
+    os.replace(staging_file, db_file)
+    _rotate_build_state_files()
+
+def _rotate_build_state_files():
+    for file_name in BUILD_STATE_FILES:
+        if os.path.isfile(file_name):
+            os.replace(file_name, file_name + ".previous")
+        os.replace(file_name + ".staging", file_name)
+
+def _hash_source_files():
+    source_hash = hashlib.sha1()
+    for file_name in SOURCE_FILES:
+        source_hash.update(file_name.encode("utf-8"))
+        with open(file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                source_hash.update(chunk)
+    return source_hash.hexdigest()
+
+def write_data_version(path, fingerprints):
+    """
+    Write the data version stamp for a build. Its version is the build
+    identifier, a hash of the source files, the table fingerprints and the
+    build time. The slicer uses it to invalidate its response cache and as
+    ETag for all responses (see response_cache.py). Rotating the build state
+    files on a rollback restores the previous stamp.
+    """
+    built_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    source_hash = _hash_source_files()
+    content = source_hash + json.dumps(fingerprints, sort_keys=True) + built_at
+    data_version = {
+        "version": hashlib.sha1(content.encode("utf-8")).hexdigest(),
+        "source_hash": source_hash,
+        "built_at": built_at
+    }
+    with open(path, "w") as f:
+        f.write(json.dumps(data_version, indent=4))
+
+def create_snapshots(engine, path, output_format="parquet", institutional=False):
+    """
+    Export the cube tables of the live schema to columnar files in the
+    snapshots directory below path (see snapshots.py). Should be run after
+    every tables job, the data version of the build is recorded in the
+    snapshot index.
+    """
+    if not os.path.isfile(CUBES_LIST_FILE):
+        print('Error: Cubes list file ("' + CUBES_LIST_FILE + '") not found. ' +
+              'Run this script with the "tables" job first to generate it.')
+        sys.exit()
+    table_names = list(snapshots.STATIC_TABLES)
+    if institutional:
+        with open(CUBES_LIST_FILE, "r") as cubes_list:
+            table_names += [row["cube_name"] for row in csv.DictReader(cubes_list)]
+    data_version = read_data_version(DATA_VERSION_FILE)
+    if data_version is not None:
+        data_version = {"version": data_version["version"],
+                        "built_at": data_version["built_at"].strftime("%Y-%m-%dT%H:%M:%SZ")}
+    print(colorise("Writing {} snapshots of {} tables...".format(output_format, len(table_names)), "green"))
+    start = time.time()
+    index = snapshots.write_snapshots(engine, LIVE_SCHEMA, table_names, os.path.join(path, snapshots.SNAPSHOT_DIR),
+                                      output_format, data_version)
+    num_rows = sum([entry["rows"] for entry in index["files"]])
+    print("Wrote {} rows in {:.1f} seconds".format(num_rows, time.time() - start))
+
+def rollback_cubes_tables(engine):
+    rollback_schemas(engine)
+    _restore_build_state_files()
+
+def rollback_embedded_tables(db_file):
+    if not os.path.isfile(db_file + ".previous"):
+        print("ERROR: No previous version of " + db_file + " found, nothing to roll back to.")
+        sys.exit()
+    os.replace(db_file, db_file + ".staging")
+    os.replace(db_file + ".previous", db_file)
+    _restore_build_state_files()
+
+def _restore_build_state_files():
+    for file_name in BUILD_STATE_FILES:
+        if os.path.isfile(file_name + ".previous"):
+            if os.path.isfile(file_name):
+                os.replace(file_name, file_name + ".staging")
+            os.replace(file_name + ".previous", file_name)
+
+def _load_table_fingerprints(connectable, live_schema=LIVE_SCHEMA):
+    """
+    Load the table fingerprints of the last build. Only fingerprints of
+    tables which are actually present in the live schema are returned.
+    """
+    if not os.path.isfile(TABLE_FINGERPRINTS_FILE):
+        print("No fingerprints file (" + TABLE_FINGERPRINTS_FILE + ") found, all tables will be rebuilt.")
+        return {}
+    with open(TABLE_FINGERPRINTS_FILE, "r") as f:
+        try:
+            fingerprints = json.loads(f.read())
+        except ValueError:
+            print("Could not decode fingerprints from " + TABLE_FINGERPRINTS_FILE + ", all tables will be rebuilt.")
+            return {}
+    with connectable.begin() as connection:
+        live_tables = _list_tables(connection, live_schema)
+    return {name: fp for name, fp in fingerprints.items() if name in live_tables}
+
+def prepare_staging_schema(connectable, staging_schema=STAGING_SCHEMA):
+    """
+    (Re-)create an empty staging schema. Leftovers from a previous failed or
+    rolled back build are dropped.
+    """
+    print(colorise("Preparing staging schema '" + staging_schema + "'...", "green"))
+    with connectable.begin() as connection:
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(staging_schema))
+        connection.execute("CREATE SCHEMA {}".format(staging_schema))
+
+def finalise_staging_schema(connectable, staging_schema=STAGING_SCHEMA):
+    """
+    Update planner statistics for all tables in the staging schema, so the
+    new tables are ready to serve queries right after the swap.
+    """
+    print(colorise("Analysing tables in staging schema '" + staging_schema + "'...", "green"))
+    with connectable.begin() as connection:
+        for table_name in sorted(_list_tables(connection, staging_schema)):
+            connection.execute('ANALYZE {}."{}"'.format(staging_schema, table_name))
+
+def swap_schemas(connectable, live_schema=LIVE_SCHEMA, staging_schema=STAGING_SCHEMA,
+                 previous_schema=PREVIOUS_SCHEMA, carry_over=None):
+    """
+    Replace the live schema with the staging schema in a single transaction.
+
+    The current live schema is kept as previous_schema so it can be restored
+    using rollback_schemas(). Queries served by the slicer will either see the
+    old or the new set of tables, but never a partially built one.
+
+    Tables listed in carry_over are moved from the live schema into the
+    staging schema before the swap (incremental builds).
+    """
+    print(colorise("Swapping staging schema '" + staging_schema + "' into place...", "green"))
+    with connectable.begin() as connection:
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(previous_schema))
+        for table_name in carry_over or []:
+            connection.execute('ALTER TABLE {}."{}" SET SCHEMA {}'.format(live_schema, table_name, staging_schema))
+        if _schema_exists(connection, live_schema):
+            connection.execute("ALTER SCHEMA {} RENAME TO {}".format(live_schema, previous_schema))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(staging_schema, live_schema))
+        connection.execute("GRANT USAGE ON SCHEMA {} TO cubes_user".format(live_schema))
+        connection.execute("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO cubes_user".format(live_schema))
+
+def rollback_schemas(connectable, live_schema=LIVE_SCHEMA, staging_schema=STAGING_SCHEMA,
+                     previous_schema=PREVIOUS_SCHEMA):
+    """
+    Restore the schema replaced by the last swap_schemas() call. The rolled
+    back schema becomes the staging schema and will be dropped by the next build.
+
+    Tables which only exist in the live schema (carried over by an incremental
+    build or new in the last build) are moved back along with the previous schema.
+    """
+    with connectable.begin() as connection:
+        if not _schema_exists(connection, previous_schema):
+            print("ERROR: No previous schema '" + previous_schema + "' found, nothing to roll back to.")
+            sys.exit()
+        print(colorise("Rolling back to schema '" + previous_schema + "'...", "green"))
+        previous_tables = _list_tables(connection, previous_schema)
+        for table_name in sorted(_list_tables(connection, live_schema) - previous_tables):
+            connection.execute('ALTER TABLE {}."{}" SET SCHEMA {}'.format(live_schema, table_name, previous_schema))
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(staging_schema))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(live_schema, staging_schema))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(previous_schema, live_schema))
 
 def init_table(table, fields, create_id=False):
 
@@ -248,7 +687,553 @@ def init_table(table, fields, create_id=False):
 
     table.create()
 
-def create_cubes_tables(connectable, schema="openapc_schema"):
+def _read_model_cubes():
+    """
+    Read the cube definitions from the model templates.
+
+    Returns:
+        A tuple (cubes, table_types). cubes maps the names of the aggregated
+        cubes to their definitions, table_types does the same for the
+        institutional table types.
+    """
+    with open("static/templates/MODEL_FIRST_PART", "r") as first, \
+         open("static/templates/MODEL_LAST_PART", "r") as last:
+        model = json.loads(first.read() + last.read())
+    cubes = {cube["name"]: cube for cube in model["cubes"]}
+    table_types = {}
+    for table_type, file_name in MODEL_STATIC_FILES.items():
+        with open("static/templates/" + file_name, "r") as model_part:
+            # The static parts are the tail of a JSON object
+            table_types[table_type] = json.loads("{" + model_part.read())
+    return cubes, table_types
+
+def _parse_yaml_hierarchy(lines):
+    """
+    Extract the filter fields and the drilldown path from the lines of a
+    hierarchy definition (as found in the YAML templates).
+
+    Returns:
+        A tuple (filters, drilldowns), both lists of field names in order.
+    """
+    sections = {"filters": [], "drilldowns": []}
+    section = None
+    section_indent = 0
+    for line in lines:
+        stripped = line.strip()
+        indent = len(line) - len(line.lstrip())
+        if stripped[:-1] in sections and stripped.endswith(":"):
+            section = sections[stripped[:-1]]
+            section_indent = indent
+        elif section is not None and indent <= section_indent:
+            section = None
+        elif section is not None:
+            match = YAML_FIELD_RE.match(line)
+            if match:
+                section.append(match.group("field"))
+    return sections["filters"], sections["drilldowns"]
+
+def _read_yaml_hierarchies():
+    """
+    Read the filters and the drilldown path from the YAML templates.
+
+    Returns:
+        A dict mapping table types to (filters, drilldowns) tuples, both
+        lists of field names in template order.
+    """
+    hierarchies = {}
+    for table_type, file_name in YAML_STATIC_FILES.items():
+        with open("static/templates/" + file_name, "r") as yaml:
+            hierarchies[table_type] = _parse_yaml_hierarchy(yaml.readlines())
+    return hierarchies
+
+def get_index_columns():
+    """
+    Derive the columns to index from the cube model and the YAML templates.
+
+    A dimension is indexed if it is one of the COMMON_CUT_DIMENSIONS or used
+    as a filter or drilldown for the table type. Institutional tables hold a
+    single institution, so they are not indexed on it.
+
+    Returns:
+        A tuple (aggregated, institutional). aggregated maps aggregated table
+        names, institutional maps institutional table types to lists of columns.
+    """
+    cubes, table_types = _read_model_cubes()
+    yaml_fields = {}
+    for table_type, (filters, drilldowns) in _read_yaml_hierarchies().items():
+        yaml_fields[table_type] = set(filters + drilldowns)
+    aggregated = {}
+    for cube_name, cube in cubes.items():
+        fields = yaml_fields.get(AGGREGATED_TABLE_TYPES.get(cube_name), set())
+        aggregated[cube_name] = [dim for dim in cube["dimensions"] if dim in COMMON_CUT_DIMENSIONS or dim in fields]
+    institutional = {}
+    for table_type, cube in table_types.items():
+        fields = yaml_fields[table_type]
+        institutional[table_type] = [dim for dim in cube["dimensions"] if dim != "institution" and
+                                     (dim in COMMON_CUT_DIMENSIONS or dim in fields)]
+    return aggregated, institutional
+
+def _shortened_name(table_name, suffix):
+    # PostgreSQL truncates identifiers to 63 bytes, shorten long table names
+    # in a way which keeps the derived names unique.
+    if len(table_name) + len(suffix) <= 63:
+        return table_name + suffix
+    digest = hashlib.sha1(table_name.encode("utf-8")).hexdigest()[:8]
+    return table_name[:63 - len(suffix) - 9] + "_" + digest + suffix
+
+def _index_name(table_name, column_name):
+    return _shortened_name(table_name, "_" + column_name + "_idx")
+
+def build_preaggregates(connectable, schema, sources, workers=1, unchanged_schema=LIVE_SCHEMA):
+    """
+    Create the pre-aggregate tables for the treemap drilldown paths and
+    register them for the slicer (see preaggregates.py).
+
+    Args:
+        connectable: An SQLAlchemy engine.
+        schema: The schema to create the aggregate tables in.
+        sources: A list of (cubes_name, table_type, unchanged) tuples, one for
+                 each cube table. table_type is the institutional table type
+                 or None for aggregated tables.
+        workers: The number of aggregate tables to create concurrently.
+        unchanged_schema: The schema holding the unchanged tables of an
+                          incremental build.
+    """
+    print(colorise("Creating pre-aggregate tables...", "green"))
+    start = time.time()
+    cubes, table_types = _read_model_cubes()
+    hierarchies = _read_yaml_hierarchies()
+    jobs = []
+    for cubes_name, table_type, unchanged in sources:
+        if table_type is None:
+            cube = cubes.get(cubes_name)
+            hierarchy = hierarchies.get(AGGREGATED_TABLE_TYPES.get(cubes_name))
+        else:
+            cube = table_types[table_type]
+            hierarchy = hierarchies.get(table_type)
+        if cube is None or hierarchy is None:
+            continue
+        source_schema = unchanged_schema if unchanged else schema
+        for depth, group_columns in enumerate(preaggregates.plan_preaggregates(cube, *hierarchy), 1):
+            aggregate_table_name = _shortened_name(cubes_name, "_agg" + str(depth))
+            jobs.append((cubes_name, aggregate_table_name, group_columns, cube["aggregates"], source_schema))
+
+    def create(job):
+        cubes_name, aggregate_table_name, group_columns, aggregates, source_schema = job
+        return preaggregates.create_preaggregate_table(connectable, schema, cubes_name, aggregate_table_name,
+                                                       group_columns, aggregates, source_schema)
+
+    if workers <= 1:
+        created = [create(job) for job in jobs]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            created = list(executor.map(create, jobs))
+    entries = [job[:4] for job, kept in zip(jobs, created) if kept]
+    preaggregates.create_registry(connectable, schema, entries)
+    msg = "Created {} pre-aggregate tables in {:.1f} seconds"
+    print(msg.format(len(entries), time.time() - start))
+
+def copy_rows(connectable, table, fields, rows):
+    """
+    Bulk load rows into a table using PostgreSQL's COPY ... FROM STDIN.
+
+    The rows are encoded into an in-memory CSV buffer. Every non-null value
+    is quoted, so empty strings are kept while None values end up as NULL.
+
+    Args:
+        connectable: An SQLAlchemy engine connected to a PostgreSQL database.
+        table: The (already created) SQLAlchemy table to load the rows into.
+        fields: A list of (field_name, field_type) tuples.
+        rows: A list of value tuples, ordered like fields.
+    """
+    column_names = [field_name for field_name, _ in fields]
+    buf = io.StringIO()
+    for row in rows:
+        values = []
+        for value in row:
+            if value is None:
+                values.append("")
+            else:
+                values.append('"' + str(value).replace('"', '""') + '"')
+        buf.write(",".join(values) + "\n")
+    buf.seek(0)
+    preparer = connectable.dialect.identifier_preparer
+    columns = ", ".join([preparer.quote(column_name) for column_name in column_names])
+    statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(preparer.format_table(table), columns)
+    connection = connectable.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(statement, buf)
+        connection.commit()
+    finally:
+        connection.close()
+
+class RowOverlay(object):
+    """
+    A derived variant of a source row (DEAL rows, additional cost rows).
+
+    Only the changed values are stored, all other lookups fall through to the
+    base row, which is shared instead of being copied.
+    """
+
+    __slots__ = ("base", "changes")
+
+    def __init__(self, base, **changes):
+        self.base = base
+        self.changes = changes
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def get(self, key, default=None):
+        if key in self.changes:
+            return self.changes[key]
+        return self.base.get(key, default)
+
+
+class ValuesRow(object):
+    """
+    A row which has already been converted to a value tuple ordered like
+    column_names. Used to pass rows from ETL worker processes, table loaders
+    with matching columns take the values as they are.
+    """
+
+    __slots__ = ("column_names", "values")
+
+    def __init__(self, column_names, values):
+        self.column_names = column_names
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.column_names.index(key)]
+
+    def get(self, key, default=None):
+        if key in self.column_names:
+            return self.values[self.column_names.index(key)]
+        return default
+
+
+class TableLoader(object):
+    """
+    Collects the rows for a single cube table and writes them to the database
+    once the ETL process has finished.
+
+    Rows (dicts or RowOverlays) are converted to value tuples ordered like
+    the table fields as soon as they are appended. This snapshot is all that
+    is kept, so later changes to a source row do not affect the table.
+
+    A fingerprint of the table content is calculated along the way. It also
+    covers the storage layout of the table (see _layout) and the
+    TABLE_SCHEMA_VERSION. If it matches previous_fingerprint, the table is
+    left out and marked as unchanged.
+
+    Tables get an additional serial ID_COLUMN, which is filled in by the
+    database in insertion order.
+    """
+
+    def __init__(self, connectable, metadata, schema, cubes_name, fields, use_copy=True,
+                 previous_fingerprint=None, partitions=None, index_columns=None):
+        self.connectable = connectable
+        self.metadata = metadata
+        self.schema = schema
+        self.cubes_name = cubes_name
+        self.fields = fields
+        self.use_copy = use_copy
+        self.previous_fingerprint = previous_fingerprint
+        # A list of (partition_name, institution) tuples. If set, the table
+        # is created as a parent table list-partitioned by institution.
+        self.partitions = partitions
+        self._created_partitions = set()
+        # Columns to create an index on once the table has been filled
+        self.index_columns = index_columns
+        self.unchanged = False
+        self.table = None
+        self.rows = []
+        self._column_names = tuple([field_name for field_name, _ in fields])
+        self._hash = hashlib.sha1(repr((TABLE_SCHEMA_VERSION, self._layout(), ID_COLUMN, fields)).encode("utf-8"))
+        if index_columns:
+            self._hash.update(repr(index_columns).encode("utf-8"))
+
+    def fingerprint(self):
+        return self._hash.hexdigest()
+
+    def _layout(self):
+        # Plain tables have ID_COLUMN as primary key, partitioned ones as
+        # a serial column without a key (see _add_serial_id).
+        if self.partitions is not None:
+            return "partitioned"
+        return "plain"
+
+    def _to_values(self, row):
+        if isinstance(row, ValuesRow) and row.column_names == self._column_names:
+            values = row.values
+        else:
+            values = tuple([row.get(column_name) for column_name in self._column_names])
+        self._hash.update(repr(values).encode("utf-8"))
+        return values
+
+    def append(self, row):
+        self.rows.append(self._to_values(row))
+
+    def create(self):
+        table_kwargs = {}
+        if self.partitions is not None:
+            table_kwargs["postgresql_partition_by"] = "LIST (institution)"
+        self.table = sqlalchemy.Table(self.cubes_name, self.metadata, autoload=False, schema=self.schema,
+                                      **table_kwargs)
+        if self.table.exists():
+            self.table.drop(checkfirst=False)
+        if self.partitions is not None:
+            init_table(self.table, self.fields)
+            self._add_serial_id()
+            self._create_default_partition()
+        else:
+            init_table(self.table, self.fields, create_id=True)
+
+    def _add_serial_id(self):
+        # A primary key on a partitioned table would have to include the
+        # partition key, so the id is added as a plain serial column. The
+        # partitions inherit its default.
+        preparer = self.connectable.dialect.identifier_preparer
+        statement = "ALTER TABLE {} ADD COLUMN {} SERIAL".format(preparer.format_table(self.table),
+                                                                 preparer.quote(ID_COLUMN))
+        with self.connectable.begin() as connection:
+            connection.execute(statement)
+        self.table.append_column(sqlalchemy.schema.Column(ID_COLUMN, sqlalchemy.Integer))
+
+    def _create_partition(self, connection, partition_name, bound):
+        preparer = self.connectable.dialect.identifier_preparer
+        prefix = preparer.quote_schema(self.schema) + "." if self.schema else ""
+        statement = "CREATE TABLE {}{} PARTITION OF {} {}"
+        connection.execute(statement.format(prefix, preparer.quote(partition_name),
+                                            preparer.format_table(self.table), bound))
+
+    def _create_default_partition(self):
+        # Rows from institutions without a cube of their own
+        with self.connectable.begin() as connection:
+            self._create_partition(connection, self.cubes_name + "_default", "DEFAULT")
+
+    def _create_partitions(self, rows):
+        # Partitions are only created right before the first rows of their
+        # institution are written, so institutions without rows in this
+        # table do not get an empty one. No rows of an institution can have
+        # ended up in the default partition before.
+        position = self._column_names.index("institution")
+        institutions = set([values[position] for values in rows])
+        with self.connectable.begin() as connection:
+            for partition_name, institution in self.partitions:
+                if institution not in institutions or partition_name in self._created_partitions:
+                    continue
+                bound = "FOR VALUES IN ('" + institution.replace("'", "''") + "')"
+                self._create_partition(connection, partition_name, bound)
+                self._created_partitions.add(partition_name)
+
+    def create_indexes(self):
+        index_columns = list(self.index_columns or [])
+        if self.partitions is not None:
+            index_columns.append(ID_COLUMN)
+        for column_name in index_columns:
+            index = sqlalchemy.Index(_index_name(self.cubes_name, column_name), self.table.c[column_name])
+            index.create(self.connectable)
+
+    def flush(self):
+        if self.rows:
+            if self.partitions is not None:
+                self._create_partitions(self.rows)
+            if self.use_copy:
+                copy_rows(self.connectable, self.table, self.fields, self.rows)
+            else:
+                rows = [dict(zip(self._column_names, values)) for values in self.rows]
+                self.connectable.execute(self.table.insert(), rows)
+            self.rows = []
+
+    def finish(self):
+        if self.previous_fingerprint is not None and self.previous_fingerprint == self.fingerprint():
+            self.unchanged = True
+            self.rows = []
+            return
+        self.create()
+        self.flush()
+        self.create_indexes()
+
+    def discard(self):
+        self.rows = []
+
+
+class RowBudget(object):
+    """
+    Limits the number of rows buffered by all StreamingTableLoaders of a
+    build together. batch_size only bounds the buffer of a single table, with
+    hundreds of institutional tables that alone does not bound memory usage.
+
+    Once more than max_rows are buffered, the loaders holding the largest
+    buffers are flushed until at most half of the budget is in use.
+    """
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.buffered = 0
+        self.loaders = []
+
+    def register(self, loader):
+        self.loaders.append(loader)
+
+    def unregister(self, loader):
+        self.loaders.remove(loader)
+
+    def add(self, num_rows):
+        self.buffered += num_rows
+        if self.buffered > self.max_rows:
+            self._flush_largest()
+
+    def release(self, num_rows):
+        self.buffered -= num_rows
+
+    def _flush_largest(self):
+        for loader in sorted(self.loaders, key=lambda loader: len(loader.rows), reverse=True):
+            if self.buffered <= self.max_rows // 2 or not loader.rows:
+                break
+            loader.flush()
+
+
+class StreamingTableLoader(TableLoader):
+    """
+    A TableLoader which creates its table right away and inserts rows in
+    batches of batch_size while the source files are still being processed.
+    If a RowBudget is given, the rows buffered by all loaders sharing it are
+    limited as well.
+    """
+
+    def __init__(self, connectable, metadata, schema, cubes_name, fields, batch_size, use_copy=True,
+                 partitions=None, index_columns=None, budget=None):
+        super(StreamingTableLoader, self).__init__(connectable, metadata, schema, cubes_name, fields, use_copy,
+                                                   partitions=partitions, index_columns=index_columns)
+        self.batch_size = batch_size
+        self.budget = budget
+        if budget is not None:
+            budget.register(self)
+        self.create()
+
+    def append(self, row):
+        self.rows.append(self._to_values(row))
+        if self.budget is not None:
+            self.budget.add(1)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.budget is not None:
+            self.budget.release(len(self.rows))
+        super(StreamingTableLoader, self).flush()
+
+    def finish(self):
+        self.flush()
+        if self.budget is not None:
+            self.budget.unregister(self)
+        self.create_indexes()
+
+    def discard(self):
+        if self.budget is not None:
+            self.budget.release(len(self.rows))
+            self.budget.unregister(self)
+        self.rows = []
+        self.table.drop(checkfirst=False)
+
+
+def _finish_loader(label, loader):
+    start = time.time()
+    loader.finish()
+    if loader.unchanged:
+        print(label + " unchanged, skipped")
+    else:
+        print(label + " loaded in {:.2f} seconds".format(time.time() - start))
+
+def load_tables(labelled_loaders, workers=1):
+    """
+    Finish a list of table loaders, i.e. create and fill their tables.
+
+    With workers > 1, the loaders are run by a pool of threads. Every loader
+    uses its own connection for the duration of a statement, so the number of
+    concurrent writers is bounded by the worker count (and the size of the
+    engine's connection pool, see _create_db_engine).
+
+    If a loader fails, all loaders which have not been started yet are
+    cancelled and the error is raised once the running ones have returned.
+    Tables are always built in the staging schema, which is only swapped in
+    after every table has been loaded successfully, so a failed load never
+    leaves the live schema with a partial set of tables.
+
+    Args:
+        labelled_loaders: A list of (label, loader) tuples. The label is
+                          used for progress output only.
+        workers: The number of concurrent loaders.
+    """
+    if workers <= 1:
+        for label, loader in labelled_loaders:
+            _finish_loader(label, loader)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_finish_loader, label, loader) for label, loader in labelled_loaders]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class PartitionLoader(TableLoader):
+    """
+    Stands in for an institutional table in partitioned mode. The rows are
+    already stored in the parent table and routed into the partition by
+    PostgreSQL, so only the fingerprint is kept track of here.
+    """
+
+    def _layout(self):
+        return "partition"
+
+    def append(self, row):
+        self._to_values(row)
+
+    def finish(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+def create_cubes_tables(connectable, schema=LIVE_SCHEMA, streaming=False, batch_size=STREAMING_BATCH_SIZE,
+                        max_buffered_rows=STREAMING_MAX_BUFFERED_ROWS, use_copy=True, cubes_list_file=CUBES_LIST_FILE, previous_fingerprints=None,
+                        partitioned=False, engine="rows", jobs=1, load_workers=1):
+    """
+    Process the OpenAPC source files and populate all cube tables.
+
+    In partitioned mode, the aggregated tables listed in PARTITIONED_TABLES
+    are list-partitioned by institution and the institutional tables are
+    created as their partitions instead of holding a copy of the rows.
+
+    engine selects the ETL implementation from ETL_ENGINES. "columnar"
+    requires numpy and produces the same tables as the default "rows" engine.
+    With jobs > 1, the source files are processed in parallel by a pool of
+    worker processes (see _run_processors). With load_workers > 1, the
+    tables are written concurrently (see load_tables). Every table is indexed
+    after it has been filled, see get_index_columns. Finally, pre-aggregate
+    tables are created for the treemap drilldown paths (see build_preaggregates).
+
+    Returns:
+        A tuple (fingerprints, unchanged_tables). fingerprints is a dict mapping
+        all created table names to their content fingerprints, unchanged_tables
+        a list of tables which were skipped since their fingerprint matched the
+        one in previous_fingerprints (never the case in streaming mode).
+    """
+    if previous_fingerprints is None or streaming:
+        previous_fingerprints = {}
 
     springer_compact_coverage_fields = [
         ("period", "string"),
@@ -272,55 +1257,180 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
 
     metadata = sqlalchemy.MetaData(bind=connectable)
 
+    institution_lookup_table = _create_institution_lookup_table()
+
+    partitions = {}
+    if partitioned:
+        partitions = _get_institutional_partitions(institution_lookup_table)
+
+    aggregated_index_columns, institutional_index_columns = get_index_columns()
+
+    budget = RowBudget(max_buffered_rows) if streaming else None
+
+    def create_loader(cubes_name, fields, table_type=None):
+        if table_type is None:
+            index_columns = aggregated_index_columns.get(cubes_name)
+        else:
+            if partitioned:
+                # Partitions inherit the indexes of their parent table
+                return PartitionLoader(connectable, metadata, schema, cubes_name, fields)
+            index_columns = institutional_index_columns.get(table_type)
+        if index_columns:
+            field_names = [field_name for field_name, _ in fields]
+            index_columns = [column for column in index_columns if column in field_names]
+        if streaming:
+            return StreamingTableLoader(connectable, metadata, schema, cubes_name, fields, batch_size, use_copy,
+                                        partitions.get(cubes_name), index_columns, budget)
+        return TableLoader(connectable, metadata, schema, cubes_name, fields, use_copy,
+                           previous_fingerprints.get(cubes_name), partitions.get(cubes_name), index_columns)
+
     # a dict to store individual insert commands and data for static tables
     static_tables_data = {
         "doi_lookup": {
             "fields": doi_lookup_fields,
-            "cubes_name": "doi_lookup",
-            "data": []
+            "cubes_name": "doi_lookup"
         },
         "openapc": {
             "fields": TABLE_SCHEMAS["apc"],
-            "cubes_name": "openapc",
-            "data": []
+            "cubes_name": "openapc"
         },
         "openapc_ac": {
             "fields": TABLE_SCHEMAS["apc_ac"],
-            "cubes_name": "openapc_ac",
-            "data": []
+            "cubes_name": "openapc_ac"
         },
         "transformative_agreements": {
             "fields": TABLE_SCHEMAS["ta"],
-            "cubes_name": "transformative_agreements",
-            "data": []
+            "cubes_name": "transformative_agreements"
         },
         "bpc": {
             "fields": TABLE_SCHEMAS["bpc"],
-            "cubes_name": "bpc",
-            "data": []
+            "cubes_name": "bpc"
         },
         "combined": {
             "fields": TABLE_SCHEMAS["apc"],
-            "cubes_name": "combined",
-            "data": []
+            "cubes_name": "combined"
         },
         "springer_compact_coverage": {
              "fields": springer_compact_coverage_fields,
-             "cubes_name": "springer_compact_coverage",
-             "data": []
+             "cubes_name": "springer_compact_coverage"
         },
         "deal": {
             "fields": TABLE_SCHEMAS["deal"],
-            "cubes_name": "deal",
-            "data": []
+            "cubes_name": "deal"
         }
     }
+    for data in static_tables_data.values():
+        data["data"] = create_loader(data["cubes_name"], data["fields"])
 
     # a dict to store individual insert commands and data for institutional tables
     institutional_tables_data = {}
 
-    additional_cost_data = {}
+    def route_rows(rows):
+        for static_table, table_type, row in rows:
+            if static_table is not None:
+                static_tables_data[static_table]["data"].append(row)
+            if table_type is not None:
+                _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table,
+                                                       table_type, row, create_loader)
+
+    additional_cost_data = _create_additional_cost_data()
+
+    journal_coverage = None
+    article_pubyears = None
+    try:
+        # Memory-mapped indexes are used instead of the decoded JSON if available
+        journal_coverage = cache_index.load_cache(scc.COVERAGE_CACHE_FILE, cache_index.CoverageIndex)
+        article_pubyears = cache_index.load_cache(scc.PUBDATES_CACHE_FILE, cache_index.PubdatesIndex)
+    except IOError as ioe:
+        msg = "Error while trying to access cache file: {}"
+        print(msg.format(ioe))
+        sys.exit()
+    except ValueError as ve:
+        msg = "Error while trying to decode cache structure in: {}"
+        print(msg.format(str(ve)))
+        sys.exit()
+
+    summarised_transformative_agreements = {}
 
+    journal_id_title_map = {}
+
+    institution_key_errors = []
+
+    # Source files in processing order, together with the arguments for their processors
+    processor_args = [
+        ("bpc", (institution_lookup_table,)),
+        ("wiley_opt_out", (institution_lookup_table, institution_key_errors)),
+        ("springer_opt_out", (institution_lookup_table, institution_key_errors)),
+        ("transformative_agreements", (institution_lookup_table, institution_key_errors, article_pubyears,
+                                       summarised_transformative_agreements, journal_id_title_map)),
+        ("apc", (institution_lookup_table, additional_cost_data))
+    ]
+    static_columns = {}
+    for table_name, data in static_tables_data.items():
+        static_columns[table_name] = tuple([field_name for field_name, _ in data["fields"]])
+
+    for name, rows in _run_processors(engine, processor_args, static_columns, jobs):
+        route_rows(rows)
+        if name != "transformative_agreements":
+            continue
+        if institution_key_errors:
+            print("KeyError: The following institutions were not found in the " +
+                  "institutions_transformative_agreements file:")
+            for institution in institution_key_errors:
+                print(institution)
+            sys.exit()
+        print(colorise("Generating Springer Compact Coverage data...", "green"))
+
+        for journal_id, info in journal_coverage.items():
+            for year, stats in info["years"].items():
+                row = {
+                    "publisher": "Springer Nature",
+                    "journal_full_title": info["title"],
+                    "period": year,
+                    "is_hybrid": "TRUE",
+                    "num_journal_total_articles": stats["num_journal_total_articles"],
+                    "num_journal_oa_articles": stats["num_journal_oa_articles"]
+                }
+                try:
+                    row["num_springer_compact_articles"] = summarised_transformative_agreements[journal_id][year]
+                except KeyError:
+                    row["num_springer_compact_articles"] = 0
+                static_tables_data["springer_compact_coverage"]["data"].append(row)
+
+    for data in _postprocess_institutional_tables(institutional_tables_data, institution_lookup_table):
+        data["data"].discard()
+    _report_non_apc_cubes(institutional_tables_data)
+    print(colorise("Populating database tables...", "green"))
+    start = time.time()
+    labelled_loaders = []
+    preaggregate_sources = []
+    for table_name, data in static_tables_data.items():
+        labelled_loaders.append(("Aggregated table '" + data["cubes_name"] + "'", data["data"]))
+        preaggregate_sources.append((data["cubes_name"], None, data["data"]))
+    with open(cubes_list_file, "w") as cubes_list:
+        writer = csv.writer(cubes_list)
+        writer.writerow(["institution", "cube_name", "full_name", "cube_type", "priority"])
+        for institution, institutional_data in institutional_tables_data.items():
+            for table_type, data in institutional_data.items():
+                label = "Institutional " + table_type + " table '" + data["cubes_name"] + "'"
+                labelled_loaders.append((label, data["data"]))
+                preaggregate_sources.append((data["cubes_name"], table_type, data["data"]))
+                writer.writerow([institution, data["cubes_name"], data["full_name"], table_type, data["priority"]])
+    load_tables(labelled_loaders, load_workers)
+    print("Populating database tables took {:.1f} seconds".format(time.time() - start))
+    preaggregate_sources = [(cubes_name, table_type, loader.unchanged)
+                            for cubes_name, table_type, loader in preaggregate_sources]
+    build_preaggregates(connectable, schema, preaggregate_sources, load_workers)
+    loaders = [loader for _, loader in labelled_loaders]
+    fingerprints = {loader.cubes_name: loader.fingerprint() for loader in loaders}
+    unchanged_tables = [loader.cubes_name for loader in loaders if loader.unchanged]
+    if previous_fingerprints:
+        msg = "{} of {} tables were unchanged and will be carried over from the live schema."
+        print(colorise(msg.format(len(unchanged_tables), len(loaders)), "cyan"))
+    return fingerprints, unchanged_tables
+
+def _create_additional_cost_data():
+    additional_cost_data = {}
     print(colorise("Processing additional costs file...", "green"))
     reader = csv.DictReader(open(ADDITIONAL_COSTS_FILE, "r"))
     for row in reader:
@@ -337,86 +1447,77 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
                     pass
         if cost_dict:
             additional_cost_data[doi] = cost_dict
+    return additional_cost_data
 
-    institution_lookup_table = _create_institution_lookup_table()
+# The _process_* functions below are generators which read a source file row
+# by row and yield (static_table, table_type, row) triples, where static_table
+# names an entry in static_tables_data and table_type an institutional table
+# type. Exactly one of both is set for each triple. Rows are consumed before the
+# generator resumes and table loaders keep a snapshot of the values, so any
+# changes made to a row after it has been yielded will not show up in the target
+# table.
 
+def _process_bpc_file(institution_lookup_table):
     print(colorise("Processing BPC file...", "green"))
     reader = csv.DictReader(open(BPC_FILE, "r"))
-    bpc_data = []
     for row in reader:
         row["book_title"] = row["book_title"].replace(":", "")
         institution = row["institution"]
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "bpc", row)
+        # Institutional tables get the country as well, they may be
+        # partitions of the aggregated table (--partitioned)
         row["country"] = institution_lookup_table[institution]["country"]
-        static_tables_data["bpc"]["data"].append(row)
+        yield None, "bpc", row
+        yield "bpc", None, row
         ror_id = institution_lookup_table[institution]["ror_id"]
         full_name = institution_lookup_table[institution]["full_name"]
         lookup_data = _create_lookup_data(row, ror_id, full_name, "bpc")
         if lookup_data:
-            static_tables_data["doi_lookup"]["data"].append(lookup_data)
-
-    journal_coverage = None
-    article_pubyears = None
-    try:
-        cache_file = open(scc.COVERAGE_CACHE_FILE, "r")
-        journal_coverage = json.loads(cache_file.read())
-        cache_file.close()
-        cache_file = open(scc.PUBDATES_CACHE_FILE, "r")
-        article_pubyears = json.loads(cache_file.read())
-        cache_file.close()
-    except IOError as ioe:
-        msg = "Error while trying to access cache file: {}"
-        print(msg.format(ioe))
-        sys.exit()
-    except ValueError as ve:
-        msg = "Error while trying to decode cache structure in: {}"
-        print(msg.format(str(ve)))
-        sys.exit()
-
-    summarised_transformative_agreements = {}
-
-    journal_id_title_map = {}
-
-    institution_key_errors = []
+            yield "doi_lookup", None, lookup_data
 
+def _process_wiley_opt_out_file(institution_lookup_table, institution_key_errors):
     reader = csv.DictReader(open(DEAL_WILEY_OPT_OUT_FILE, "r"))
     print(colorise("Processing Wiley Opt-Out file...", "green"))
     for row in reader:
-        row_copy = deepcopy(row) # work on a deep copy since we make some DEAL-specific changes 
-        row_copy["opt_out"] = "TRUE"
-        if row_copy["publisher"] in DEAL_IMPRINTS["Wiley-Blackwell"]:
-            row_copy["publisher"] = "Wiley-Blackwell"
-        institution = row_copy["institution"]
+        row["opt_out"] = "TRUE"
+        if row["publisher"] in DEAL_IMPRINTS["Wiley-Blackwell"]:
+            row["publisher"] = "Wiley-Blackwell"
+        institution = row["institution"]
         try:
-            row_copy["country"] = institution_lookup_table[institution]["country"]
+            row["country"] = institution_lookup_table[institution]["country"]
         except KeyError:
             if institution not in institution_key_errors:
                 institution_key_errors.append(institution)
-        if row_copy["period"] == "2019":
+        if row["period"] == "2019":
             # Special rule: Half 2019 costs since DEAL only started in 07/19
-            halved = round(float(row_copy["euro"]) / 2, 2)
-            row_copy["euro"] = str(halved)
-        static_tables_data["deal"]["data"].append(row_copy)
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+            halved = round(float(row["euro"]) / 2, 2)
+            row["euro"] = str(halved)
+        yield "deal", None, row
+        yield None, "deal", row
         institution_lookup_table[institution]["deal_participant"] = True
-        
+
+def _process_springer_opt_out_file(institution_lookup_table, institution_key_errors):
     reader = csv.DictReader(open(DEAL_SPRINGER_OPT_OUT_FILE, "r"))
     print(colorise("Processing Springer Opt-Out file...", "green"))
     for row in reader:
-        row_copy = deepcopy(row) # work on a deep copy since we make some DEAL-specific changes 
-        row_copy["opt_out"] = "TRUE"
-        if row_copy["publisher"] in DEAL_IMPRINTS["Springer Nature"]:
-                row_copy["publisher"] = "Springer Nature"
-        institution = row_copy["institution"]
+        row["opt_out"] = "TRUE"
+        if row["publisher"] in DEAL_IMPRINTS["Springer Nature"]:
+                row["publisher"] = "Springer Nature"
+        institution = row["institution"]
         try:
-            row_copy["country"] = institution_lookup_table[institution]["country"]
+            row["country"] = institution_lookup_table[institution]["country"]
         except KeyError:
             if institution not in institution_key_errors:
                 institution_key_errors.append(institution)
-        static_tables_data["deal"]["data"].append(row_copy)
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+        yield "deal", None, row
+        yield None, "deal", row
         institution_lookup_table[institution]["deal_participant"] = True
 
+def _process_transformative_agreements_file(institution_lookup_table, institution_key_errors, article_pubyears,
+                                            summarised_transformative_agreements, journal_id_title_map):
+    with open(TRANSFORMATIVE_AGREEMENTS_FILE, "r") as f:
+        springer_articles = [(row["doi"], row["issn"]) for row in csv.DictReader(f)
+                             if row["publisher"] == "Springer Nature"]
+    journal_ids = scc.resolve_springer_journal_ids(springer_articles)
     reader = csv.DictReader(open(TRANSFORMATIVE_AGREEMENTS_FILE, "r"))
     print(colorise("Processing Transformative Agreements file...", "green"))
     for row in reader:
@@ -424,7 +1525,6 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
             print(str(reader.line_num) + " records processed")
         institution = row["institution"]
         publisher = row["publisher"]
-        issn = row["issn"]
         doi = row["doi"]
         # colons cannot be escaped in URL queries to the cubes server, so we have
         # to remove them here
@@ -435,43 +1535,44 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
         except KeyError:
             if institution not in institution_key_errors:
                 institution_key_errors.append(institution)
-        static_tables_data["transformative_agreements"]["data"].append(row)
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "ta", row)
+        yield "transformative_agreements", None, row
+        yield None, "ta", row
         ror_id = institution_lookup_table[institution]["ror_id"]
         full_name = institution_lookup_table[institution]["full_name"]
         lookup_data = _create_lookup_data(row, ror_id, full_name, "transformative_agreements")
         if lookup_data:
-            static_tables_data["doi_lookup"]["data"].append(lookup_data)
+            yield "doi_lookup", None, lookup_data
         if row["euro"] != "NA":
-            static_tables_data["combined"]["data"].append(row)
+            yield "combined", None, row
         if row["agreement"] == "DEAL Wiley Germany":
             # DEAL Wiley
-            row_copy = deepcopy(row)
-            row_copy["opt_out"] = "FALSE"
+            row_copy = RowOverlay(row, opt_out="FALSE")
             if row_copy["period"] == "2019":
                 # Special rule: Half 2019 costs since DEAL only started in 07/19 
                 halved = round(float(row["euro"]) / 2, 2)
                 row_copy["euro"] = str(halved)
             if row_copy["publisher"] in DEAL_IMPRINTS["Wiley-Blackwell"]:
                 row_copy["publisher"] = "Wiley-Blackwell"
-            static_tables_data["deal"]["data"].append(row_copy)
-            _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+            yield "deal", None, row_copy
+            yield None, "deal", row_copy
             institution_lookup_table[institution]["deal_participant"] = True
 
         if row["agreement"] == "DEAL Springer Nature Germany":
-            row_copy = deepcopy(row)
             # DEAL SN
-            row_copy["opt_out"] = "FALSE"
+            row_copy = RowOverlay(row, opt_out="FALSE")
             if row_copy["publisher"] in DEAL_IMPRINTS["Springer Nature"]:
                 row_copy["publisher"] = "Springer Nature"
-            static_tables_data["deal"]["data"].append(row_copy)
-            _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+            yield "deal", None, row_copy
+            yield None, "deal", row_copy
             institution_lookup_table[institution]["deal_participant"] = True
 
         if publisher != "Springer Nature":
             continue
 
-        journal_id = scc._get_springer_journal_id_from_doi(doi, issn)
+        journal_id = journal_ids[doi]
+        if journal_id is None:
+            # Lookup failed, already reported by the resolver
+            continue
         journal_id_title_map[journal_id] = title
         try:
             pub_year = article_pubyears[journal_id][doi]
@@ -484,30 +1585,8 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
             summarised_transformative_agreements[journal_id][pub_year] = 1
         else:
             summarised_transformative_agreements[journal_id][pub_year] += 1
-    if institution_key_errors:
-        print("KeyError: The following institutions were not found in the " +
-              "institutions_transformative_agreements file:")
-        for institution in institution_key_errors:
-            print(institution)
-        sys.exit()
-    print(colorise("Generating Springer Compact Coverage data...", "green"))
-
-    for journal_id, info in journal_coverage.items():
-        for year, stats in info["years"].items():
-            row = {
-                "publisher": "Springer Nature",
-                "journal_full_title": info["title"],
-                "period": year,
-                "is_hybrid": "TRUE",
-                "num_journal_total_articles": stats["num_journal_total_articles"],
-                "num_journal_oa_articles": stats["num_journal_oa_articles"]
-            }
-            try:
-                row["num_springer_compact_articles"] = summarised_transformative_agreements[journal_id][year]
-            except KeyError:
-                row["num_springer_compact_articles"] = 0
-            static_tables_data["springer_compact_coverage"]["data"].append(row)
 
+def _process_apc_file(institution_lookup_table, additional_cost_data):
     print(colorise("Processing APC file...", "green"))
     reader = csv.DictReader(open(APC_DE_FILE, "r"))
     for row in reader:
@@ -522,67 +1601,394 @@ def create_cubes_tables(connectable, schema="openapc_schema"):
         ror_id = institution_lookup_table[institution]["ror_id"]
         full_name = institution_lookup_table[institution]["full_name"]
         row["institution_ror"] = ror_id
-        static_tables_data["openapc"]["data"].append(row)
+        yield "openapc", None, row
         lookup_data = _create_lookup_data(row, ror_id, full_name, "openapc")
         if lookup_data:
-            static_tables_data["doi_lookup"]["data"].append(lookup_data)
-        static_tables_data["combined"]["data"].append(row)
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "apc", row)
-        # create copy with ac fields
-        row_copy = deepcopy(row)
-        row_copy["publication_key"] = _create_publication_key(row)
-        row_copy["cost_type"] = "apc"
-        row_copy["cost_category"] = "APC"
-        static_tables_data["openapc_ac"]["data"].append(row_copy)
-        _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "apc_ac", row_copy)
+            yield "doi_lookup", None, lookup_data
+        yield "combined", None, row
+        yield None, "apc", row
+        # create variant with ac fields
+        publication_key = _create_publication_key(row)
+        row_copy = RowOverlay(row, publication_key=publication_key, cost_type="apc", cost_category="APC")
+        yield "openapc_ac", None, row_copy
+        yield None, "apc_ac", row_copy
         if doi in additional_cost_data:
             for cost_type, value in additional_cost_data[doi].items():
-                row_copy = deepcopy(row)
-                row_copy["cost_type"] = cost_type
-                row_copy["cost_category"] = "Additional Cost"
-                row_copy["euro"] = value
-                row_copy["publication_key"] = _create_publication_key(row)
-                _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "apc_ac", row_copy)
-                static_tables_data["openapc_ac"]["data"].append(row_copy)
+                row_copy = RowOverlay(row, cost_type=cost_type, cost_category="Additional Cost", euro=value,
+                                      publication_key=publication_key)
+                yield None, "apc_ac", row_copy
+                yield "openapc_ac", None, row_copy
         # DEAL Wiley
         if row["publisher"] in DEAL_IMPRINTS["Wiley-Blackwell"] and row["country"] == "DEU" and row["is_hybrid"] == "FALSE":
             if datetime.strptime(row["period"], "%Y") > DEAL_WILEY_START_YEAR:
-                row_copy = deepcopy(row)
-                row_copy["publisher"] = "Wiley-Blackwell" # Imprint normalization
-                row_copy["opt_out"] = "FALSE"
-                static_tables_data["deal"]["data"].append(row_copy)
-                _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+                # Imprint normalization
+                row_copy = RowOverlay(row, publisher="Wiley-Blackwell", opt_out="FALSE")
+                yield "deal", None, row_copy
+                yield None, "deal", row_copy
         # DEAL Springer
         if row["publisher"] in DEAL_IMPRINTS["Springer Nature"] and row["country"] == "DEU" and row["is_hybrid"] == "FALSE":
             if datetime.strptime(row["period"], "%Y") > DEAL_SPRINGER_START_YEAR:
-                row_copy = deepcopy(row)
-                row_copy["opt_out"] = "FALSE"
-                row_copy["publisher"] = "Springer Nature"
-                static_tables_data["deal"]["data"].append(row_copy)
-                _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, "deal", row_copy)
+                row_copy = RowOverlay(row, opt_out="FALSE", publisher="Springer Nature")
+                yield "deal", None, row_copy
+                yield None, "deal", row_copy
+
+# Columnar ETL engine (--engine columnar)
+#
+# The functions below are drop-in replacements for the _process_* generators
+# above and yield exactly the same (static_table, table_type, row) triples.
+# Each source file is loaded into a dict of numpy object arrays first. The
+# enrichment steps (joins against the institutions table, title cleanup, DEAL
+# rules, publication keys) are then carried out on whole columns, rows only
+# exist as light-weight ColumnarRow views into those arrays.
+
+class ColumnarRow(object):
+    """
+    A read-only view on a single row of a dict of equally sized columns.
+    """
+
+    __slots__ = ("columns", "index")
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.columns[key][self.index]
+
+    def get(self, key, default=None):
+        column = self.columns.get(key)
+        if column is None:
+            return default
+        return column[self.index]
+
+def _read_columns(path):
+    """
+    Read a CSV file into a dict of numpy object arrays, one per column.
+
+    Returns:
+        A tuple (columns, num_rows).
+    """
+    with open(path, "r") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        values = list(reader)
+    columns = {}
+    for index, column_name in enumerate(header):
+        column = numpy.empty(len(values), dtype=object)
+        # short rows are padded with None like csv.DictReader does
+        column[:] = [value[index] if index < len(value) else None for value in values]
+        columns[column_name] = column
+    return columns, len(values)
+
+def _object_column(values):
+    column = numpy.empty(len(values), dtype=object)
+    column[:] = list(values)
+    return column
+
+def _strip_colons(column):
+    if len(column) == 0:
+        return column
+    return numpy.char.replace(column.astype(str), ":", "").astype(object)
+
+def _join_institutions(institutions, institution_lookup_table, key):
+    """
+    Look up an attribute in the institutions table for a whole column of
+    institution names. Every distinct institution is looked up only once.
+    """
+    if len(institutions) == 0:
+        return _object_column([])
+    distinct, inverse = numpy.unique(institutions.astype(str), return_inverse=True)
+    values = _object_column([institution_lookup_table[institution][key] for institution in distinct])
+    return values[inverse]
+
+def _normalise_imprints(publishers, deal_publisher, mask=None):
+    normalised = publishers.copy()
+    imprint_mask = numpy.isin(publishers, DEAL_IMPRINTS[deal_publisher])
+    if mask is not None:
+        imprint_mask &= mask
+    normalised[imprint_mask] = deal_publisher
+    return normalised
+
+def _halve_costs(euros, mask):
+    # Special rule: Half 2019 costs since DEAL only started in 07/19. Python's
+    # round() is used on purpose, numpy.round may differ in the last digit.
+    halved = euros.copy()
+    halved[mask] = [str(round(float(euro) / 2, 2)) for euro in euros[mask]]
+    return halved
+
+def _mark_deal_participants(institutions, mask, institution_lookup_table):
+    for institution in numpy.unique(institutions[mask].astype(str)):
+        institution_lookup_table[institution]["deal_participant"] = True
 
-    _postprocess_institutional_tables(institutional_tables_data, institution_lookup_table)
-    _report_non_apc_cubes(institutional_tables_data)
-    print(colorise("Populating database tables...", "green"))
-    for table_name, data in static_tables_data.items():
-        print("Aggregated table '" + data["cubes_name"] + "'...")
-        table = sqlalchemy.Table(data["cubes_name"], metadata, autoload=False, schema=schema)
-        if table.exists():
-            table.drop(checkfirst=False)
-        init_table(table, data["fields"])
-        connectable.execute(table.insert(), data["data"])
-    with open(CUBES_LIST_FILE, "w") as cubes_list:
-        writer = csv.writer(cubes_list)
-        writer.writerow(["institution", "cube_name", "full_name", "cube_type", "priority"])
-        for institution, institutional_data in institutional_tables_data.items():
-            for table_type, data in institutional_data.items():
-                print("Institutional " + table_type + " table '" + data["cubes_name"] + "'...")
-                table = sqlalchemy.Table(data["cubes_name"], metadata, autoload=False, schema=schema)
-                if table.exists():
-                    table.drop(checkfirst=False)
-                init_table(table, data["fields"])
-                connectable.execute(table.insert(), data["data"])
-                writer.writerow([institution, data["cubes_name"], data["full_name"], table_type, data["priority"]])
+def _year_after(periods, mask, start_year):
+    # Same as datetime.strptime(period, "%Y") > start_year for the masked rows
+    result = numpy.zeros(len(periods), dtype=bool)
+    if mask.any():
+        years = numpy.array([datetime.strptime(period, "%Y").year for period in periods[mask]])
+        result[mask] = years > start_year.year
+    return result
+
+def _publication_keys(columns):
+    dois = columns["doi"]
+    keys = dois.copy()
+    no_doi = (dois == "NA") | (dois == "")
+    for index in numpy.flatnonzero(no_doi):
+        keys[index] = _create_publication_key(ColumnarRow(columns, index))
+    return keys
+
+def _process_bpc_file_columnar(institution_lookup_table):
+    print(colorise("Processing BPC file...", "green"))
+    columns, num_rows = _read_columns(BPC_FILE)
+    columns["book_title"] = _strip_colons(columns["book_title"])
+    columns["country"] = _join_institutions(columns["institution"], institution_lookup_table, "country")
+    ror_ids = _join_institutions(columns["institution"], institution_lookup_table, "ror_id")
+    full_names = _join_institutions(columns["institution"], institution_lookup_table, "full_name")
+    for index in range(num_rows):
+        row = ColumnarRow(columns, index)
+        yield None, "bpc", row
+        yield "bpc", None, row
+        lookup_data = _create_lookup_data(row, ror_ids[index], full_names[index], "bpc")
+        if lookup_data:
+            yield "doi_lookup", None, lookup_data
+
+def _process_opt_out_file_columnar(path, deal_publisher, institution_lookup_table, institution_key_errors):
+    columns, num_rows = _read_columns(path)
+    columns["opt_out"] = _object_column(["TRUE"] * num_rows)
+    columns["publisher"] = _normalise_imprints(columns["publisher"], deal_publisher)
+    for institution in numpy.unique(columns["institution"].astype(str)):
+        if institution not in institution_lookup_table and institution not in institution_key_errors:
+            institution_key_errors.append(institution)
+    columns["country"] = _join_institutions(columns["institution"], institution_lookup_table, "country")
+    if deal_publisher == "Wiley-Blackwell":
+        columns["euro"] = _halve_costs(columns["euro"], columns["period"] == "2019")
+    _mark_deal_participants(columns["institution"], numpy.ones(num_rows, dtype=bool), institution_lookup_table)
+    for index in range(num_rows):
+        row = ColumnarRow(columns, index)
+        yield "deal", None, row
+        yield None, "deal", row
+
+def _process_wiley_opt_out_file_columnar(institution_lookup_table, institution_key_errors):
+    print(colorise("Processing Wiley Opt-Out file...", "green"))
+    return _process_opt_out_file_columnar(DEAL_WILEY_OPT_OUT_FILE, "Wiley-Blackwell", institution_lookup_table,
+                                          institution_key_errors)
+
+def _process_springer_opt_out_file_columnar(institution_lookup_table, institution_key_errors):
+    print(colorise("Processing Springer Opt-Out file...", "green"))
+    return _process_opt_out_file_columnar(DEAL_SPRINGER_OPT_OUT_FILE, "Springer Nature", institution_lookup_table,
+                                          institution_key_errors)
+
+def _process_transformative_agreements_file_columnar(institution_lookup_table, institution_key_errors,
+                                                     article_pubyears, summarised_transformative_agreements,
+                                                     journal_id_title_map):
+    print(colorise("Processing Transformative Agreements file...", "green"))
+    columns, num_rows = _read_columns(TRANSFORMATIVE_AGREEMENTS_FILE)
+    # colons cannot be escaped in URL queries to the cubes server, so we have
+    # to remove them here
+    columns["journal_full_title"] = _strip_colons(columns["journal_full_title"])
+    for institution in numpy.unique(columns["institution"].astype(str)):
+        if institution not in institution_lookup_table and institution not in institution_key_errors:
+            institution_key_errors.append(institution)
+    columns["country"] = _join_institutions(columns["institution"], institution_lookup_table, "country")
+    ror_ids = _join_institutions(columns["institution"], institution_lookup_table, "ror_id")
+    full_names = _join_institutions(columns["institution"], institution_lookup_table, "full_name")
+    has_costs = columns["euro"] != "NA"
+
+    wiley = columns["agreement"] == "DEAL Wiley Germany"
+    wiley_columns = dict(columns)
+    wiley_columns["opt_out"] = _object_column(["FALSE"] * num_rows)
+    wiley_columns["euro"] = _halve_costs(columns["euro"], wiley & (columns["period"] == "2019"))
+    wiley_columns["publisher"] = _normalise_imprints(columns["publisher"], "Wiley-Blackwell", wiley)
+
+    springer = columns["agreement"] == "DEAL Springer Nature Germany"
+    springer_columns = dict(columns)
+    springer_columns["opt_out"] = wiley_columns["opt_out"]
+    springer_columns["publisher"] = _normalise_imprints(columns["publisher"], "Springer Nature", springer)
+
+    _mark_deal_participants(columns["institution"], wiley | springer, institution_lookup_table)
+
+    springer_rows = numpy.flatnonzero(columns["publisher"] == "Springer Nature")
+    journal_ids = scc.resolve_springer_journal_ids(zip(columns["doi"][springer_rows], columns["issn"][springer_rows]))
+    for index in springer_rows:
+        doi = columns["doi"][index]
+        journal_id = journal_ids[doi]
+        if journal_id is None:
+            # Lookup failed, already reported by the resolver
+            continue
+        journal_id_title_map[journal_id] = columns["journal_full_title"][index]
+        try:
+            pub_year = article_pubyears[journal_id][doi]
+        except KeyError:
+            pub_year = columns["period"][index]
+        journal_stats = summarised_transformative_agreements.setdefault(journal_id, {})
+        journal_stats[pub_year] = journal_stats.get(pub_year, 0) + 1
+
+    for index in range(num_rows):
+        if index > 0 and index % 10000 == 0:
+            print(str(index) + " records processed")
+        row = ColumnarRow(columns, index)
+        yield "transformative_agreements", None, row
+        yield None, "ta", row
+        lookup_data = _create_lookup_data(row, ror_ids[index], full_names[index], "transformative_agreements")
+        if lookup_data:
+            yield "doi_lookup", None, lookup_data
+        if has_costs[index]:
+            yield "combined", None, row
+        if wiley[index]:
+            row = ColumnarRow(wiley_columns, index)
+            yield "deal", None, row
+            yield None, "deal", row
+        if springer[index]:
+            row = ColumnarRow(springer_columns, index)
+            yield "deal", None, row
+            yield None, "deal", row
+
+def _process_apc_file_columnar(institution_lookup_table, additional_cost_data):
+    print(colorise("Processing APC file...", "green"))
+    columns, num_rows = _read_columns(APC_DE_FILE)
+    # colons cannot be escaped in URL queries to the cubes server, so we have
+    # to remove them here
+    columns["journal_full_title"] = _strip_colons(columns["journal_full_title"])
+    columns["country"] = _join_institutions(columns["institution"], institution_lookup_table, "country")
+    columns["institution_ror"] = _join_institutions(columns["institution"], institution_lookup_table, "ror_id")
+    full_names = _join_institutions(columns["institution"], institution_lookup_table, "full_name")
+    publication_keys = _publication_keys(columns)
+
+    ac_columns = dict(columns)
+    ac_columns["publication_key"] = publication_keys
+    ac_columns["cost_type"] = _object_column(["apc"] * num_rows)
+    ac_columns["cost_category"] = _object_column(["APC"] * num_rows)
+    has_additional_costs = numpy.isin(columns["doi"], list(additional_cost_data.keys()))
+
+    deal_candidates = (columns["country"] == "DEU") & (columns["is_hybrid"] == "FALSE")
+    wiley = numpy.isin(columns["publisher"], DEAL_IMPRINTS["Wiley-Blackwell"]) & deal_candidates
+    wiley = _year_after(columns["period"], wiley, DEAL_WILEY_START_YEAR)
+    springer = numpy.isin(columns["publisher"], DEAL_IMPRINTS["Springer Nature"]) & deal_candidates
+    springer = _year_after(columns["period"], springer, DEAL_SPRINGER_START_YEAR)
+    deal_opt_out = _object_column(["FALSE"] * num_rows)
+    wiley_columns = dict(columns)
+    wiley_columns["publisher"] = _object_column(["Wiley-Blackwell"] * num_rows) # Imprint normalization
+    wiley_columns["opt_out"] = deal_opt_out
+    springer_columns = dict(columns)
+    springer_columns["publisher"] = _object_column(["Springer Nature"] * num_rows)
+    springer_columns["opt_out"] = deal_opt_out
+
+    for index in range(num_rows):
+        if index > 0 and index % 10000 == 0:
+            print(str(index) + " records processed")
+        row = ColumnarRow(columns, index)
+        yield "openapc", None, row
+        lookup_data = _create_lookup_data(row, columns["institution_ror"][index], full_names[index], "openapc")
+        if lookup_data:
+            yield "doi_lookup", None, lookup_data
+        yield "combined", None, row
+        yield None, "apc", row
+        row_copy = ColumnarRow(ac_columns, index)
+        yield "openapc_ac", None, row_copy
+        yield None, "apc_ac", row_copy
+        if has_additional_costs[index]:
+            for cost_type, value in additional_cost_data[columns["doi"][index]].items():
+                row_copy = RowOverlay(row, cost_type=cost_type, cost_category="Additional Cost", euro=value,
+                                      publication_key=publication_keys[index])
+                yield None, "apc_ac", row_copy
+                yield "openapc_ac", None, row_copy
+        if wiley[index]:
+            row_copy = ColumnarRow(wiley_columns, index)
+            yield "deal", None, row_copy
+            yield None, "deal", row_copy
+        if springer[index]:
+            row_copy = ColumnarRow(springer_columns, index)
+            yield "deal", None, row_copy
+            yield None, "deal", row_copy
+
+def _run_processors(engine, processor_args, static_columns, jobs=1):
+    """
+    Run the processors of an ETL engine for all source files.
+
+    With jobs > 1, the processors run in parallel in a pool of worker
+    processes. Every worker returns the complete list of (static_table,
+    table_type, row) triples for its file along with the changes it made to
+    the shared state. Results are yielded in the order of processor_args, so
+    the tables end up exactly like in a sequential run.
+
+    Args:
+        engine: A key in ETL_ENGINES.
+        processor_args: A list of (processor_name, args) tuples.
+        static_columns: A dict mapping static table names to their column names.
+        jobs: The number of worker processes.
+
+    Yields:
+        (processor_name, rows) tuples, where rows is an iterable of triples.
+    """
+    if jobs <= 1:
+        for name, args in processor_args:
+            yield name, ETL_ENGINES[engine][name](*args)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for name, args in processor_args:
+            futures.append(executor.submit(_run_processor_job, engine, name, args, static_columns))
+        for (name, args), future in zip(processor_args, futures):
+            rows, state = future.result()
+            _merge_processor_state(args, state)
+            yield name, rows
+
+def _run_processor_job(engine, name, args, static_columns):
+    # Runs in a worker process: Rows are converted to compact ValuesRows here,
+    # so the conversion is parallelised as well and less data has to be pickled.
+    column_names = {}
+    for table_type, fields in TABLE_SCHEMAS.items():
+        column_names[table_type] = tuple([field_name for field_name, _ in fields])
+    rows = []
+    for static_table, table_type, row in ETL_ENGINES[engine][name](*args):
+        if static_table is not None:
+            names = static_columns[static_table]
+        else:
+            names = column_names[table_type]
+        values = tuple([row.get(column_name) for column_name in names])
+        rows.append((static_table, table_type, ValuesRow(names, values)))
+    institution_lookup_table = args[0]
+    state = {
+        "deal_participants": [institution for institution, info in institution_lookup_table.items()
+                              if info.get("deal_participant", False)]
+    }
+    if name in ["wiley_opt_out", "springer_opt_out", "transformative_agreements"]:
+        state["institution_key_errors"] = args[1]
+    if name == "transformative_agreements":
+        state["summarised_transformative_agreements"] = args[3]
+        state["journal_id_title_map"] = args[4]
+    return rows, state
+
+def _merge_processor_state(args, state):
+    # deal_participant flags are only read after all files have been processed
+    # (_postprocess_institutional_tables), so merging them here is sufficient.
+    institution_lookup_table = args[0]
+    for institution in state["deal_participants"]:
+        institution_lookup_table[institution]["deal_participant"] = True
+    if "institution_key_errors" in state:
+        institution_key_errors = args[1]
+        for institution in state["institution_key_errors"]:
+            if institution not in institution_key_errors:
+                institution_key_errors.append(institution)
+    if "summarised_transformative_agreements" in state:
+        args[3].update(state["summarised_transformative_agreements"])
+        args[4].update(state["journal_id_title_map"])
+
+ETL_ENGINES = {
+    "rows": {
+        "bpc": _process_bpc_file,
+        "wiley_opt_out": _process_wiley_opt_out_file,
+        "springer_opt_out": _process_springer_opt_out_file,
+        "transformative_agreements": _process_transformative_agreements_file,
+        "apc": _process_apc_file
+    },
+    "columnar": {
+        "bpc": _process_bpc_file_columnar,
+        "wiley_opt_out": _process_wiley_opt_out_file_columnar,
+        "springer_opt_out": _process_springer_opt_out_file_columnar,
+        "transformative_agreements": _process_transformative_agreements_file_columnar,
+        "apc": _process_apc_file_columnar
+    }
+}
 
 def _is_cubes_institution(institutions_row):
     cubes_name = institutions_row["institution_cubes_name"]
@@ -613,11 +2019,14 @@ def _create_publication_key(row):
             return row["url"]
     raise Exception("Error while processing row " + ",".join(row) + ": Cound not extract a publication key!")
 
-def generate_model_file(path):
+def generate_model_file(path, lazy=False):
     if not os.path.isfile(CUBES_LIST_FILE):
         print('Error: Cubes list file ("' + CUBES_LIST_FILE + '") not found. ' +
               'Run this script with the "tables" job first to generate it.')
         sys.exit()
+    if lazy:
+        _generate_lazy_model_file(path)
+        return
     content = ""
     with open("static/templates/MODEL_FIRST_PART", "r") as model:
         content += model.read()
@@ -641,25 +2050,49 @@ def generate_model_file(path):
     with open(output_file, "w") as model:
         model.write(content)
 
+def _generate_lazy_model_file(path):
+    """
+    Write the model for LazyModelProvider (see model_provider.py): The
+    static model, the institutional cube types as shared templates and a
+    reference to its template for every institutional cube.
+    """
+    with open("static/templates/MODEL_FIRST_PART", "r") as first, \
+         open("static/templates/MODEL_LAST_PART", "r") as last:
+        model = json.loads(first.read() + last.read())
+    _, model["cube_templates"] = _read_model_cubes()
+    model["provider"] = LAZY_MODEL_PROVIDER
+    model["lazy_cubes"] = []
+    with open(CUBES_LIST_FILE, "r") as f:
+        for row in csv.DictReader(f):
+            cube = {
+                "name": row["cube_name"],
+                "label": "{} openAPC data cube".format(row["full_name"]),
+                "template": row["cube_type"]
+            }
+            model["lazy_cubes"].append(cube)
+    output_file = os.path.join(path, LAZY_MODEL_FILE)
+    with open(output_file, "w") as f:
+        f.write(json.dumps(model, indent=4))
+
 # - Remove institutional ac tables if no additional costs are present
 # - Remove institutional deal tables if no TA entries with a deal agreemnt 
+# Returns the removed table entries.
 def _postprocess_institutional_tables(institutional_tables_data, institution_lookup_table):
     deal_deleted = []
-    for institution, data in deepcopy(institutional_tables_data).items():
+    removed = []
+    for institution, data in list(institutional_tables_data.items()):
         if "apc_ac" in data:
-            for row in data["apc_ac"]["data"]:
-                if row["cost_type"] != "apc":
-                    break
-            else:
-                del institutional_tables_data[institution]["apc_ac"]
+            if not data["apc_ac"]["additional_costs"]:
+                removed.append(data.pop("apc_ac"))
         if "deal" in data:
             if not institution_lookup_table[institution].get("deal_participant", False):
                 deal_deleted.append(institution)
-                del institutional_tables_data[institution]["deal"]
+                removed.append(data.pop("deal"))
     msg = ("A deal cube will not be generated for these {} institutions " +
            "since they did not report hybrid DEAL TA data: {}\n")
     msg = msg.format(len(deal_deleted), ", ".join(deal_deleted))
     print(colorise(msg, "yellow"))
+    return removed
 
 def _report_non_apc_cubes(institutional_tables_data):
     non_apc_cubes = {}
@@ -675,7 +2108,8 @@ def _report_non_apc_cubes(institutional_tables_data):
         msg = msg.format(cube_type, len(institution_list), ", ".join(sorted(institution_list)))
         print(colorise(msg, "cyan"))
 
-def _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, table_type, row):
+def _insert_into_institutional_tables_data(institutional_tables_data, institution_lookup_table, table_type, row,
+                                           create_loader):
     institution = row["institution"]
     full_name = institution_lookup_table[institution]["full_name"]
     cube_name = institution_lookup_table[institution]["cube_name"]
@@ -691,9 +2125,12 @@ def _insert_into_institutional_tables_data(institutional_tables_data, institutio
             "fields": TABLE_SCHEMAS[table_type],
             "cubes_name": target_cube_name,
             "full_name": full_name,
-            "data": []
+            "additional_costs": False,
+            "data": create_loader(target_cube_name, TABLE_SCHEMAS[table_type], table_type)
         }
-    institutional_tables_data[institution][table_type]["data"].append(deepcopy(row))
+    institutional_tables_data[institution][table_type]["data"].append(row)
+    if table_type == "apc_ac" and row["cost_type"] != "apc":
+        institutional_tables_data[institution][table_type]["additional_costs"] = True
     # create/reorder priority
     priority = 0
     for priority_type in CUBES_PRIORITIES:
@@ -701,6 +2138,28 @@ def _insert_into_institutional_tables_data(institutional_tables_data, institutio
             institutional_tables_data[institution][priority_type]["priority"] = priority
             priority += 1
 
+def _get_institutional_partitions(institution_lookup_table):
+    """
+    Determine the possible partitions of all tables in PARTITIONED_TABLES.
+    Every institution with a cubes name may get a partition for each table
+    type, named like the institutional table it replaces. A partition is only
+    created once there are rows for it (see TableLoader._create_partitions).
+
+    Returns:
+        A dict mapping parent table names to lists of (partition_name, institution) tuples.
+    """
+    partitions = {parent: [] for parent in PARTITIONED_TABLES.values()}
+    for institution, info in sorted(institution_lookup_table.items()):
+        cube_name = info["cube_name"]
+        if not cube_name or cube_name == "NA":
+            continue
+        for table_type, parent in PARTITIONED_TABLES.items():
+            partition_name = cube_name
+            if table_type != "apc":
+                partition_name += "_" + table_type
+            partitions[parent].append((partition_name, institution))
+    return partitions
+
 def _create_institution_lookup_table():
     print(colorise("Processing institutions file...", "green"))
     reader = csv.DictReader(open(INSTITUTIONS_FILE, "r"))
@@ -788,5 +2247,137 @@ def generate_yamls(path):
         with open(out_file_path, "w") as outfile:
             outfile.write(content)
 
+def _read_institution_yaml(file_path):
+    """
+    Read the hierarchies from a generated institution YAML file.
+
+    Returns:
+        A tuple (default, hierarchies). default is the default cube type,
+        hierarchies a list of (cube_type, cube_name, filters, drilldowns)
+        tuples.
+    """
+    default = None
+    hierarchy_lines = []
+    with open(file_path, "r") as yaml:
+        in_hierarchies = False
+        for line in yaml:
+            indent = len(line) - len(line.lstrip())
+            stripped = line.strip()
+            if indent == 0 and stripped:
+                in_hierarchies = stripped == "hierarchies:"
+                if stripped.startswith("default:"):
+                    default = stripped.split(":", 1)[1].strip()
+            elif in_hierarchies and indent == 4 and stripped.endswith(":"):
+                hierarchy_lines.append((stripped[:-1], []))
+            elif in_hierarchies and hierarchy_lines:
+                hierarchy_lines[-1][1].append(line)
+    hierarchies = []
+    for cube_type, lines in hierarchy_lines:
+        cube_name = None
+        for line in lines:
+            if line.strip().startswith("cube:"):
+                cube_name = line.strip().split(":", 1)[1].strip()
+        filters, drilldowns = _parse_yaml_hierarchy(lines)
+        hierarchies.append((cube_type, cube_name, filters, drilldowns))
+    return default, hierarchies
+
+def _timed_request(url):
+    start = time.time()
+    try:
+        response = urlopen(url, timeout=300)
+        body = response.read()
+        error = None
+    except (HTTPError, URLError, OSError) as e:
+        body = None
+        error = str(e)
+    return url, time.time() - start, body, error
+
+def warm_caches(path, base_url, workers=4):
+    """
+    Replay the aggregate requests of the treemaps against a (freshly deployed)
+    OLAP server to warm up the database and server caches.
+
+    For every hierarchy in the generated institution YAMLs, the treemap's
+    initial drilldown and the list of years are requested first (default
+    hierarchies before all others), then the initial drilldown cut by each of
+    the years. A latency report is printed at the end.
+
+    Args:
+        path: The directory containing the generated YAML files.
+        base_url: The base URL of the OLAP server.
+        workers: The maximum number of concurrent requests.
+    """
+    if not os.path.isfile(CUBES_LIST_FILE):
+        print('Error: Cubes list file ("' + CUBES_LIST_FILE + '") not found. ' +
+              'Run this script with the "tables" job first to generate it.')
+        sys.exit()
+    institutions = []
+    with open(CUBES_LIST_FILE, "r") as cubes_list:
+        for line in csv.DictReader(cubes_list):
+            if line["institution"] not in institutions:
+                institutions.append(line["institution"])
+    institution_lookup_table = _create_institution_lookup_table()
+
+    aggregate_url = base_url.rstrip("/") + "/cube/{}/aggregate?{}"
+    first_requests = []
+    other_requests = []
+    year_requests = {}
+    for institution in institutions:
+        yaml_path = os.path.join(path, institution_lookup_table[institution]["cube_name"] + ".yaml")
+        if not os.path.isfile(yaml_path):
+            print(colorise("YAML file " + yaml_path + " not found, skipping", "yellow"))
+            continue
+        default, hierarchies = _read_institution_yaml(yaml_path)
+        for cube_type, cube_name, filters, drilldowns in hierarchies:
+            if not cube_name or not drilldowns:
+                continue
+            requests = first_requests if cube_type == default else other_requests
+            requests.append(aggregate_url.format(cube_name, urlencode({"drilldown": drilldowns[0]})))
+            if "period" in filters:
+                periods_url = aggregate_url.format(cube_name, urlencode({"drilldown": "period"}))
+                requests.append(periods_url)
+                year_requests[periods_url] = (cube_name, drilldowns[0])
+
+    print(colorise("Warming up " + base_url + " with {} concurrent requests...".format(workers), "green"))
+    start = time.time()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        follow_up = []
+        for url, duration, body, error in executor.map(_timed_request, first_requests + other_requests):
+            results.append((url, duration, error))
+            if url not in year_requests or body is None:
+                continue
+            cube_name, drilldown = year_requests[url]
+            try:
+                cells = json.loads(body.decode("utf-8"))["cells"]
+            except (ValueError, KeyError):
+                continue
+            for cell in cells:
+                if cell.get("period"):
+                    query = urlencode({"drilldown": drilldown, "cut": "period:" + str(cell["period"])})
+                    follow_up.append(aggregate_url.format(cube_name, query))
+        for url, duration, body, error in executor.map(_timed_request, follow_up):
+            results.append((url, duration, error))
+    _print_latency_report(results, time.time() - start)
+
+def _print_latency_report(results, total_time):
+    durations = sorted([duration for _, duration, error in results if error is None])
+    errors = [(url, error) for url, _, error in results if error is not None]
+    print(colorise("Latency report", "green"))
+    msg = "{} requests in {:.1f} seconds ({} successful, {} failed)"
+    print(msg.format(len(results), total_time, len(durations), len(errors)))
+    if durations:
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(len(durations) * p))] * 1000
+        msg = "min {:.0f} ms, median {:.0f} ms, p90 {:.0f} ms, p99 {:.0f} ms, max {:.0f} ms"
+        print(msg.format(durations[0] * 1000, percentile(0.5), percentile(0.9), percentile(0.99),
+                         durations[-1] * 1000))
+        print("Slowest requests:")
+        for url, duration, error in sorted(results, key=lambda x: x[1], reverse=True)[:10]:
+            if error is None:
+                print("{:8.0f} ms  {}".format(duration * 1000, url))
+    for url, error in errors:
+        print(colorise("Failed: " + url + " (" + error + ")", "red"))
+
 if __name__ == '__main__':
     main()
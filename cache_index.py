@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Memory-mappable indexes of the Springer cache files.
+
+The tables job only needs a few point lookups in article_pubdates.json and
+a single pass over coverage_stats.json, but parsing the JSON files means
+holding all of their content in memory. The coverage_stats job therefore
+also writes an index file next to each cache file. It is a sorted table of
+string keys and values which is opened with mmap and searched with a
+binary search, so nothing is deserialised up front.
+
+File layout (little-endian):
+
+    header:  magic (8 bytes), number of entries (uint32),
+             SHA-1 of the JSON file the index was built from (20 bytes)
+    entries: key offset, key length, value offset, value length (4 x uint32),
+             sorted by key
+    strings: UTF-8 keys and values, offsets are relative to this section
+
+An index is only used if the hash in its header matches the current JSON
+file, otherwise the JSON file is loaded as before.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"OAPCIDX1"
+HEADER = struct.Struct("<8sI20s")
+ENTRY = struct.Struct("<IIII")
+
+INDEX_SUFFIX = ".idx"
+
+# Separates journal ID and DOI in the keys of the pubdates index
+KEY_SEPARATOR = "\t"
+
+
+def hash_file(path):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.digest()
+
+def write_index(path, items, source_hash):
+    """
+    Write an index file.
+
+    Args:
+        path: The index file, it is written atomically.
+        items: An iterable of (key, value) string tuples with unique keys.
+        source_hash: The SHA-1 digest of the file the items were taken from.
+    """
+    items = sorted([(key.encode("utf-8"), value.encode("utf-8")) for key, value in items])
+    entries = []
+    strings = []
+    offset = 0
+    for key, value in items:
+        entries.append(ENTRY.pack(offset, len(key), offset + len(key), len(value)))
+        strings.append(key)
+        strings.append(value)
+        offset += len(key) + len(value)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries), source_hash))
+        f.write(b"".join(entries))
+        f.write(b"".join(strings))
+    os.replace(tmp_path, path)
+
+
+class CacheIndex(object):
+    """
+    Read access to an index file. Instances can be pickled (for worker
+    processes), the file is mapped again on unpickling.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self.source_hash = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(self.path + " is not a cache index file")
+        self._strings_start = HEADER.size + self._count * ENTRY.size
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, position):
+        key_offset, key_length, value_offset, value_length = ENTRY.unpack_from(self._map,
+                                                                                HEADER.size + position * ENTRY.size)
+        start = self._strings_start
+        return (self._map[start + key_offset:start + key_offset + key_length],
+                self._map[start + value_offset:start + value_offset + value_length])
+
+    def get(self, key, default=None):
+        key = key.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, value = self._entry(middle)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return value.decode("utf-8")
+        return default
+
+    def items(self):
+        for position in range(self._count):
+            key, value = self._entry(position)
+            yield key.decode("utf-8"), value.decode("utf-8")
+
+
+class _JournalPubdates(object):
+
+    def __init__(self, index, journal_id):
+        self._index = index
+        self._prefix = journal_id + KEY_SEPARATOR
+
+    def __getitem__(self, doi):
+        year = self._index.get(self._prefix + doi)
+        if year is None:
+            raise KeyError(doi)
+        return year
+
+
+class PubdatesIndex(CacheIndex):
+    """
+    Index of article_pubdates.json, used like the decoded JSON:
+    index[journal_id][doi] returns the publication year or raises a KeyError.
+    """
+
+    def __getitem__(self, journal_id):
+        return _JournalPubdates(self, journal_id)
+
+
+class CoverageIndex(CacheIndex):
+    """
+    Index of coverage_stats.json. items() yields (journal_id, info) tuples
+    like the decoded JSON, in the same (sorted) order.
+    """
+
+    def items(self):
+        for journal_id, info in super(CoverageIndex, self).items():
+            yield journal_id, json.loads(info)
+
+
+def write_pubdates_index(json_path, pubdates):
+    items = []
+    for journal_id, dois in pubdates.items():
+        items += [(journal_id + KEY_SEPARATOR + doi, year) for doi, year in dois.items()]
+    write_index(json_path + INDEX_SUFFIX, items, hash_file(json_path))
+
+def write_coverage_index(json_path, coverage):
+    items = [(journal_id, json.dumps(info, sort_keys=True)) for journal_id, info in coverage.items()]
+    write_index(json_path + INDEX_SUFFIX, items, hash_file(json_path))
+
+def load_cache(json_path, index_class):
+    """
+    Open the index of a cache file if there is an up-to-date one, otherwise
+    decode the JSON file.
+
+    Raises:
+        IOError if the JSON file cannot be read, ValueError if it cannot be
+        decoded.
+    """
+    index_path = json_path + INDEX_SUFFIX
+    if os.path.isfile(index_path):
+        try:
+            index = index_class(index_path)
+        except (ValueError, struct.error):
+            index = None
+        if index is not None and index.source_hash == hash_file(json_path):
+            return index
+        print("Index " + index_path + " is outdated, falling back to " + json_path)
+    with open(json_path, "r") as f:
+        return json.loads(f.read())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Incremental, crash-safe storage for the caches of the coverage_stats job.
+
+The job keeps its results (journal coverage stats, article publication
+years and journal IDs) in dicts which used to be written to JSON files only
+at the end of a run. CoverageStore keeps a copy in an SQLite file and
+commits every single result as soon as it is obtained, so an interrupted
+run loses nothing. The JSON files remain the format read by the tables job,
+they are exported from the dicts at the end of every run.
+
+The store also holds the work queue of the job: The lookups still to be
+performed are planned once and removed from the queue one by one as they
+succeed, so a later run resumes where an interrupted one stopped.
+"""
+
+import json
+import sqlite3
+
+COVERAGE_STORE_FILE = "coverage_cache.sqlite"
+
+
+class CoverageStore(object):
+
+    def __init__(self, path=COVERAGE_STORE_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS journals (journal_id TEXT PRIMARY KEY, title TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS coverage (journal_id TEXT, year TEXT, " +
+                                    "num_journal_total_articles INTEGER, num_journal_oa_articles INTEGER, " +
+                                    "PRIMARY KEY (journal_id, year))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pubdates (journal_id TEXT, doi TEXT, year TEXT, " +
+                                    "PRIMARY KEY (journal_id, doi))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS journal_ids (issn TEXT PRIMARY KEY, journal_id TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS journal_id_failures (issn TEXT PRIMARY KEY, doi TEXT, " +
+                                    "reason TEXT, failed_at REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS work_queue (id INTEGER PRIMARY KEY, kind TEXT, " +
+                                    "item_key TEXT, payload TEXT, UNIQUE (kind, item_key))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def put_journal_stats(self, journal_id, title, year, total, oa):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO journals VALUES (?, ?)", (journal_id, title))
+            self.connection.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)", (journal_id, year, total, oa))
+
+    def put_pubdate(self, journal_id, doi, year):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pubdates VALUES (?, ?, ?)", (journal_id, doi, year))
+
+    def put_journal_id(self, issn, journal_id):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO journal_ids VALUES (?, ?)", (issn, journal_id))
+            self.connection.execute("DELETE FROM journal_id_failures WHERE issn = ?", (issn,))
+
+    def put_journal_id_failure(self, issn, doi, reason, failed_at):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO journal_id_failures VALUES (?, ?, ?, ?)",
+                                    (issn, doi, reason, failed_at))
+
+    def merge(self, coverage, pubdates, journal_ids, journal_id_failures=None):
+        """
+        Merge the store with cache dicts (in the structure of the JSON cache
+        files): Entries missing in the store are added to it, entries missing
+        in the dicts or differing from the store (because a run was
+        interrupted before the JSON files were written) are updated from it.
+        The dicts are modified in place.
+        """
+        with self.connection:
+            for journal_id, journal in coverage.items():
+                self.connection.execute("INSERT OR IGNORE INTO journals VALUES (?, ?)", (journal_id, journal["title"]))
+                for year, stats in journal["years"].items():
+                    if "num_journal_total_articles" in stats and "num_journal_oa_articles" in stats:
+                        self.connection.execute("INSERT OR IGNORE INTO coverage VALUES (?, ?, ?, ?)",
+                                                (journal_id, year, stats["num_journal_total_articles"],
+                                                 stats["num_journal_oa_articles"]))
+            for journal_id, dois in pubdates.items():
+                self.connection.executemany("INSERT OR IGNORE INTO pubdates VALUES (?, ?, ?)",
+                                            [(journal_id, doi, year) for doi, year in dois.items()])
+            self.connection.executemany("INSERT OR IGNORE INTO journal_ids VALUES (?, ?)", journal_ids.items())
+            if journal_id_failures is not None:
+                self.connection.executemany("INSERT OR IGNORE INTO journal_id_failures VALUES (?, ?, ?, ?)",
+                                            [(issn, failure["doi"], failure["reason"], failure["failed_at"])
+                                             for issn, failure in journal_id_failures.items()])
+        titles = dict(self.connection.execute("SELECT journal_id, title FROM journals"))
+        query = "SELECT journal_id, year, num_journal_total_articles, num_journal_oa_articles FROM coverage"
+        for journal_id, year, total, oa in self.connection.execute(query):
+            journal = coverage.setdefault(journal_id, {"title": titles.get(journal_id), "years": {}})
+            journal["years"].setdefault(year, {}).update({"num_journal_total_articles": total,
+                                                          "num_journal_oa_articles": oa})
+        for journal_id, doi, year in self.connection.execute("SELECT journal_id, doi, year FROM pubdates"):
+            pubdates.setdefault(journal_id, {})[doi] = year
+        journal_ids.update(self.connection.execute("SELECT issn, journal_id FROM journal_ids"))
+        if journal_id_failures is not None:
+            for issn, doi, reason, failed_at in self.connection.execute("SELECT * FROM journal_id_failures"):
+                if issn not in journal_ids:
+                    journal_id_failures[issn] = {"doi": doi, "reason": reason, "failed_at": failed_at}
+
+    def replace_work_queue(self, items, plan_inputs):
+        """
+        Replace the work queue with a newly planned one.
+
+        Args:
+            items: A list of (kind, key, payload) tuples in processing order.
+                   payload is a JSON-serialisable dict, duplicate keys of
+                   the same kind are ignored.
+            plan_inputs: A fingerprint of the files the queue was planned
+                         from, returned by plan_inputs() later on.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM work_queue")
+            self.connection.executemany("INSERT OR IGNORE INTO work_queue (kind, item_key, payload) VALUES (?, ?, ?)",
+                                        [(kind, key, json.dumps(payload)) for kind, key, payload in items])
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('plan_inputs', ?)", (plan_inputs,))
+
+    def plan_inputs(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = 'plan_inputs'").fetchone()
+        return row[0] if row else None
+
+    def pending_work(self):
+        """
+        Returns:
+            A list of (id, kind, payload) tuples for all items in the queue,
+            in processing order.
+        """
+        rows = self.connection.execute("SELECT id, kind, payload FROM work_queue ORDER BY id")
+        return [(item_id, kind, json.loads(payload)) for item_id, kind, payload in rows]
+
+    def complete_work(self, item_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM work_queue WHERE id = ?", (item_id,))
+
+    def requeue_work(self, item_id):
+        """
+        Move an item which could not be processed to the end of the queue.
+        """
+        with self.connection:
+            self.connection.execute("UPDATE work_queue SET id = (SELECT MAX(id) + 1 FROM work_queue) WHERE id = ?",
+                                    (item_id,))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Support for keeping the cube tables in an embedded SQLite database file
+instead of PostgreSQL.
+
+The tables job builds such a file with --sqlite_file (see
+build_embedded_tables in assets_generator.py) and the slicer serves it when
+the store url in its configuration points to it (see slicer_sqlite.ini).
+SQLite lacks some aggregate functions used by the cubes model, they are
+provided by register_sqlite_functions().
+"""
+
+import math
+import sqlite3
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+
+class StdDev(object):
+    """
+    Sample standard deviation (like stddev in PostgreSQL), computed with
+    Welford's online algorithm.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+SQLITE_AGGREGATES = {
+    "stddev": StdDev,
+    "stddev_samp": StdDev
+}
+
+_functions_registered = False
+
+
+def _add_sqlite_functions(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    for name, aggregate in SQLITE_AGGREGATES.items():
+        dbapi_connection.create_aggregate(name, 1, aggregate)
+
+def register_sqlite_functions():
+    """
+    Make the aggregates in SQLITE_AGGREGATES available on every SQLite
+    connection opened through SQLAlchemy from now on, including those of
+    the slicer's own engine. Connections to other databases are not
+    affected. Calling this more than once has no further effect.
+    """
+    global _functions_registered
+    if not _functions_registered:
+        sqlalchemy.event.listen(Engine, "connect", _add_sqlite_functions)
+        _functions_registered = True
+
+def create_sqlite_engine(path, bulk_load=False):
+    """
+    Create an engine for an SQLite database file.
+
+    With bulk_load, journaling and syncing are switched off. This is only
+    safe for files which are thrown away if anything goes wrong, like the
+    staging file of the tables job.
+    """
+    register_sqlite_functions()
+    engine = sqlalchemy.create_engine("sqlite:///" + path)
+    if bulk_load:
+        def disable_journal(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA journal_mode=OFF")
+            dbapi_connection.execute("PRAGMA synchronous=OFF")
+        sqlalchemy.event.listen(engine, "connect", disable_journal)
+    return engine
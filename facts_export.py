@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Unpaginated facts export and keyset pagination for facts.
+
+The slicer limits facts responses to json_record_limit records, so getting
+all facts of a large cube takes hundreds of paginated requests with growing
+OFFSETs. The export endpoint streams all facts of a cube (optionally limited
+by point cuts) in a single response:
+
+    /cube/<name>/export?format=ndjson&cut=period:2020|publisher:Elsevier BV
+
+format is either "ndjson" (default, one JSON object per line) or "csv".
+Rows are read through a server-side cursor in chunks of CHUNK_SIZE and the
+response is sent with chunked transfer encoding, so memory usage on the
+server does not depend on the size of the export.
+
+Clients which have to paginate can pass a cursor parameter to the facts
+function instead of page/pagesize (empty for the first page):
+
+    /cube/<name>/facts?cursor=&pagesize=500&cut=period:2020
+
+The response body is the usual list of facts, ordered by the tables' id
+column. An opaque token for the next page is returned in the X-Next-Cursor
+header (and a Link header with rel="next"), it is missing on the last page.
+Each page seeks directly to the id following the previous page using the
+primary key index, so deep pages are as fast as the first one. Cursors are
+bound to the data build they were created for.
+"""
+
+import base64
+import csv
+from decimal import Decimal
+import io
+import json
+import os
+import re
+import threading
+from urllib.parse import urlencode
+
+import sqlalchemy
+from sqlalchemy.exc import NoSuchTableError, SQLAlchemyError
+
+from preaggregates import parse_point_cuts
+from response_cache import DATA_VERSION_FILE, DataVersion
+
+CHUNK_SIZE = 2000
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+CUBE_NAME_RE = re.compile(r"^\w+$")
+
+FACTS_PATH_RE = re.compile(r"^/cube/(?P<cube>[^/]+)/facts/?$")
+
+ID_COLUMN = "id"
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def _encode_ndjson(column_names, rows):
+    lines = []
+    for row in rows:
+        record = {name: _json_value(value) for name, value in zip(column_names, row)}
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+def encode_cursor(cube_name, version, last_id):
+    content = json.dumps([cube_name, version, last_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(content).decode("ascii")
+
+def decode_cursor(token):
+    """
+    Returns:
+        A tuple (cube_name, version, last_id) or None if the token is invalid.
+    """
+    try:
+        cube_name, version, last_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(last_id, int):
+        return None
+    return cube_name, version, last_id
+
+def _encode_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["" if value is None else value for value in row])
+    return buf.getvalue()
+
+
+class FactsExporter(object):
+    """
+    Streams the rows of cube tables. Table definitions are reflected on
+    first use and kept until reflection fails (the table might have been
+    removed by the tables job).
+    """
+
+    def __init__(self, engine, schema=None):
+        self.engine = engine
+        self.schema = schema
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def table(self, cube_name):
+        """
+        Returns:
+            The reflected SQLAlchemy table or None if the cube does not exist.
+        """
+        if not CUBE_NAME_RE.match(cube_name):
+            return None
+        with self._lock:
+            if cube_name not in self._tables:
+                try:
+                    table = sqlalchemy.Table(cube_name, sqlalchemy.MetaData(), autoload=True,
+                                             autoload_with=self.engine, schema=self.schema)
+                except NoSuchTableError:
+                    return None
+                self._tables[cube_name] = table
+            return self._tables[cube_name]
+
+    def forget(self, cube_name):
+        with self._lock:
+            self._tables.pop(cube_name, None)
+
+    def query(self, table, cuts):
+        statement = sqlalchemy.select([table])
+        for dimension, value in sorted(cuts.items()):
+            statement = statement.where(table.c[dimension] == value)
+        return statement
+
+    def page(self, cube_name, table, cuts, after_id, page_size):
+        """
+        Fetch a page of facts following the row with id after_id.
+
+        Returns:
+            A list of fact dicts, at most page_size long.
+        """
+        statement = self.query(table, cuts)
+        if after_id is not None:
+            statement = statement.where(table.c[ID_COLUMN] > after_id)
+        statement = statement.order_by(table.c[ID_COLUMN]).limit(page_size)
+        column_names = [column.name for column in table.columns]
+        try:
+            rows = self.engine.execute(statement).fetchall()
+        except SQLAlchemyError:
+            self.forget(cube_name)
+            raise
+        return [{name: _json_value(value) for name, value in zip(column_names, row)} for row in rows]
+
+    def stream(self, cube_name, table, statement, output_format):
+        """
+        A generator yielding the encoded export chunk by chunk. The database
+        connection is only held while the generator is being consumed.
+        """
+        column_names = [column.name for column in table.columns]
+        if output_format == "csv":
+            yield _encode_csv([column_names])
+        connection = self.engine.connect()
+        try:
+            # stream_results makes psycopg2 use a named (server-side) cursor
+            result = connection.execution_options(stream_results=True).execute(statement)
+            while True:
+                rows = result.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                if output_format == "csv":
+                    yield _encode_csv(rows)
+                else:
+                    yield _encode_ndjson(column_names, rows)
+        except SQLAlchemyError:
+            self.forget(cube_name)
+            raise
+        finally:
+            connection.close()
+
+
+def register_export(app, config):
+    """
+    Add the export endpoint to a Flask app serving the slicer.
+
+    The database connection and schema are taken from the [store] section
+    of the slicer configuration.
+
+    Returns:
+        The FactsExporter.
+    """
+    from flask import Blueprint, Response, abort, request
+
+    schema = None
+    if config.has_option("store", "schema"):
+        schema = config.get("store", "schema")
+    exporter = FactsExporter(sqlalchemy.create_engine(config.get("store", "url")), schema)
+    blueprint = Blueprint("facts_export", __name__)
+
+    @blueprint.route("/cube/<cube_name>/export")
+    def export_facts(cube_name):
+        output_format = request.args.get("format", "ndjson")
+        if output_format not in FORMATS:
+            abort(400, "Unknown format '{}', use one of: {}".format(output_format, ", ".join(sorted(FORMATS))))
+        cuts = parse_point_cuts(request.args.get("cut", ""))
+        if cuts is None:
+            abort(400, "Only point cuts (dimension:value) are supported by the export")
+        table = exporter.table(cube_name)
+        if table is None:
+            abort(404, "Unknown cube '{}'".format(cube_name))
+        for dimension in cuts:
+            if dimension not in table.c:
+                abort(400, "Unknown dimension '{}'".format(dimension))
+        statement = exporter.query(table, cuts)
+        headers = {"Content-Disposition": "attachment; filename={}.{}".format(cube_name, output_format)}
+        return Response(exporter.stream(cube_name, table, statement, output_format),
+                        mimetype=FORMATS[output_format], headers=headers)
+
+    app.register_blueprint(blueprint)
+    return exporter
+
+
+def register_keyset_pagination(app, config, base_dir=None):
+    """
+    Answer /cube/<name>/facts requests carrying a cursor parameter with
+    keyset pagination (see the module docstring). Requests without a cursor
+    are left to the slicer.
+
+    The page size is limited to the json_record_limit of the [server]
+    section. The data version stamp is looked up like the response cache
+    does, relative to base_dir (Default: the current working directory).
+
+    Returns:
+        The FactsExporter.
+    """
+    from flask import abort, jsonify, request
+
+    base_dir = base_dir or os.getcwd()
+    version_file = DATA_VERSION_FILE
+    if config.has_option("response_cache", "data_version_file"):
+        version_file = config.get("response_cache", "data_version_file")
+    data_version = DataVersion(os.path.join(base_dir, version_file))
+    max_page_size = DEFAULT_PAGE_SIZE
+    if config.has_option("server", "json_record_limit"):
+        max_page_size = config.getint("server", "json_record_limit")
+    schema = None
+    if config.has_option("store", "schema"):
+        schema = config.get("store", "schema")
+    exporter = FactsExporter(sqlalchemy.create_engine(config.get("store", "url")), schema)
+
+    @app.before_request
+    def answer_with_keyset_page():
+        match = FACTS_PATH_RE.match(request.path)
+        if not match or "cursor" not in request.args:
+            return None
+        cube_name = match.group("cube")
+        unsupported = set(request.args.keys()) - set(["cursor", "pagesize", "cut"])
+        if unsupported:
+            abort(400, "Not supported with a cursor: " + ", ".join(sorted(unsupported)))
+        stamp = data_version.current()
+        version = stamp["version"] if stamp is not None else None
+        after_id = None
+        if request.args["cursor"]:
+            decoded = decode_cursor(request.args["cursor"])
+            if decoded is None or decoded[0] != cube_name:
+                abort(400, "Invalid cursor")
+            if decoded[1] != version:
+                abort(410, "The data has been updated since this cursor was created, please start over")
+            after_id = decoded[2]
+        try:
+            page_size = min(int(request.args.get("pagesize", max_page_size)), max_page_size)
+        except ValueError:
+            abort(400, "Invalid pagesize")
+        if page_size < 1:
+            abort(400, "Invalid pagesize")
+        cuts = parse_point_cuts(request.args.get("cut", ""))
+        if cuts is None:
+            abort(400, "Only point cuts (dimension:value) are supported with a cursor")
+        table = exporter.table(cube_name)
+        if table is None:
+            abort(404, "Unknown cube '{}'".format(cube_name))
+        if ID_COLUMN not in table.c:
+            abort(400, "Cube '{}' does not support cursors".format(cube_name))
+        for dimension in cuts:
+            if dimension not in table.c:
+                abort(400, "Unknown dimension '{}'".format(dimension))
+        facts = exporter.page(cube_name, table, cuts, after_id, page_size)
+        response = jsonify(facts)
+        if len(facts) == page_size:
+            token = encode_cursor(cube_name, version, facts[-1][ID_COLUMN])
+            response.headers["X-Next-Cursor"] = token
+            args = request.args.to_dict()
+            args["cursor"] = token
+            next_url = request.base_url + "?" + urlencode(args)
+            response.headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        return response
+
+    return exporter
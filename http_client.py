@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+A small concurrent HTTP client for the lookups of the coverage_stats job.
+
+Requests are spread over a thread pool, but all of them pass through a
+global rate limit and a cap on concurrent requests per host, so the remote
+side never sees more than it would from a polite serial client. Failed
+requests (connection errors, timeouts, HTTP 429 and 5xx) are retried with
+exponential backoff and full jitter, honouring Retry-After headers.
+
+Connections are kept alive and reused between requests to the same host.
+Responses can optionally be kept in an on-disk ResponseCache: Fresh entries
+are returned without any request, stale ones are revalidated with
+If-None-Match/If-Modified-Since if the server sent validators. Large
+responses can be streamed to a file with Fetcher.download() instead of
+being held in memory.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+DEFAULT_WORKERS = 4
+DEFAULT_PER_HOST = 4
+DEFAULT_RATE_LIMIT = 2.0 # requests per second, all hosts together
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0 # seconds
+BACKOFF_CAP = 60.0
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024 # bytes, for streamed downloads
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]
+
+USER_AGENT = "Python-urllib/{}.{}".format(*sys.version_info[:2])
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() evenly, so that no more than rate calls per
+    second return (across all threads). A rate of None disables the limit.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            self._sleep(slot - now)
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, grouped by scheme and host. A connection is
+    only used by one request at a time, the number of connections per host
+    is bounded by the fetcher's per-host cap.
+    """
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        Returns:
+            A tuple (connection, reused).
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+
+class ResponseCache(object):
+    """
+    An on-disk cache of response bodies. Bodies are stored content-addressed
+    (objects/<sha1 of the body>), so identical responses are stored once.
+    For every URL there is a small index entry (index/<sha1 of the URL>.json)
+    with the body hash, the fetch time and the validators sent by the
+    server. All files are replaced atomically, so the cache can be shared
+    by threads and survives interrupted runs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for sub_directory in ["index", "objects"]:
+            os.makedirs(os.path.join(directory, sub_directory), exist_ok=True)
+
+    def _index_path(self, url):
+        return os.path.join(self.directory, "index", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _object_path(self, body_hash):
+        return os.path.join(self.directory, "objects", body_hash)
+
+    def _write(self, path, content):
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def lookup(self, url):
+        """
+        Returns:
+            The index entry of a URL as dict or None if it is not cached.
+        """
+        try:
+            with open(self._index_path(url), "r") as f:
+                entry = json.loads(f.read())
+            if os.path.isfile(self._object_path(entry["body"])):
+                return entry
+        except (IOError, ValueError, KeyError):
+            pass
+        return None
+
+    def get(self, url):
+        """
+        Returns:
+            A tuple (entry, body) with the index entry as dict or None if the
+            URL is not cached.
+        """
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        try:
+            return entry, self.read_body(entry)
+        except IOError:
+            return None
+
+    def read_body(self, entry):
+        with open(self._object_path(entry["body"]), "rb") as f:
+            return f.read()
+
+    def copy_body(self, entry, path):
+        shutil.copyfile(self._object_path(entry["body"]), path)
+
+    def put(self, url, body, headers):
+        body_hash = hashlib.sha1(body).hexdigest()
+        object_path = self._object_path(body_hash)
+        if not os.path.isfile(object_path):
+            self._write(object_path, body)
+        self._put_entry(url, body_hash, headers)
+
+    def put_file(self, url, path, headers):
+        """
+        Like put(), with the body read from a file.
+        """
+        body_hash = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                body_hash.update(chunk)
+        body_hash = body_hash.hexdigest()
+        object_path = self._object_path(body_hash)
+        if not os.path.isfile(object_path):
+            tmp_path = "{}.{}.tmp".format(object_path, threading.get_ident())
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, object_path)
+        self._put_entry(url, body_hash, headers)
+
+    def _put_entry(self, url, body_hash, headers):
+        entry = {
+            "url": url,
+            "body": body_hash,
+            "fetched_at": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")
+        }
+        self._write(self._index_path(url), json.dumps(entry).encode("utf-8"))
+
+    def touch(self, url, entry):
+        entry = dict(entry, fetched_at=time.time())
+        self._write(self._index_path(url), json.dumps(entry).encode("utf-8"))
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    The delay before retry number attempt (starting at 0): A random value
+    between 0 and base * 2^attempt, capped at cap ("full jitter").
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def _retry_after(headers):
+    try:
+        return min(float(headers.get("Retry-After")), BACKOFF_CAP)
+    except (TypeError, ValueError):
+        return None
+
+
+class Fetcher(object):
+    """
+    Fetches URLs concurrently with a global rate limit, a per-host
+    concurrency cap and retries.
+
+    Args:
+        workers: Number of threads used by map().
+        per_host: Maximum number of concurrent requests to the same host.
+        rate_limit: Maximum number of requests per second (None: unlimited).
+        max_retries: Number of retries before an error is raised.
+        log: A function called with a message whenever a request is retried.
+        cache: An optional ResponseCache.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, rate_limit=DEFAULT_RATE_LIMIT,
+                 max_retries=MAX_RETRIES, timeout=TIMEOUT, log=print, sleep=time.sleep, cache=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.log = log
+        self.cache = cache
+        self._sleep = sleep
+        self._rate_limiter = RateLimiter(rate_limit, sleep=sleep)
+        self._pool = ConnectionPool(timeout)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, netloc):
+        with self._lock:
+            if netloc not in self._host_slots:
+                self._host_slots[netloc] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[netloc]
+
+    def _send(self, scheme, netloc, path, headers, body_path=None):
+        connection, reused = self._pool.get(scheme, netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if body_path is not None and response.status == 200:
+                # Stream the body to the file, error responses are read as usual
+                with open(body_path, "wb") as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        f.write(chunk)
+                body = None
+            else:
+                body = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if reused:
+                # The server may have closed the idle connection in the
+                # meantime, try once more on a fresh one
+                return self._send(scheme, netloc, path, headers, body_path)
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.put(scheme, netloc, connection)
+        return response.status, response.reason, response.headers, body
+
+    def _open(self, url, headers, body_path=None):
+        """
+        Send a GET request, following redirects. With body_path, the body of
+        a successful response is written to this file and None is returned
+        as body.
+
+        Returns:
+            A tuple (status, reason, headers, body).
+        """
+        headers = dict(headers, **{"User-Agent": USER_AGENT})
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            with self._host_slot(parts.netloc):
+                self._rate_limiter.wait()
+                try:
+                    status, reason, response_headers, body = self._send(parts.scheme, parts.netloc, path, headers,
+                                                                        body_path)
+                except (http.client.HTTPException, OSError) as e:
+                    raise URLError(e)
+            if status not in REDIRECT_STATUS_CODES or "Location" not in response_headers:
+                return status, reason, response_headers, body
+            url = urljoin(url, response_headers["Location"])
+        raise URLError("Too many redirects")
+
+    def fetch(self, url, ttl=None):
+        """
+        Fetch a URL, retrying transient errors.
+
+        If the fetcher has a cache and ttl is not None, a cached response
+        younger than ttl seconds is returned without a request. Older ones
+        are revalidated if possible (ttl=0 always revalidates).
+
+        Returns:
+            The response body (bytes).
+
+        Raises:
+            HTTPError or URLError if the request did not succeed after
+            max_retries retries or failed with a non-retryable status.
+        """
+        return self._fetch(url, ttl)
+
+    def download(self, url, path, ttl=None):
+        """
+        Like fetch(), but the response body is streamed to a file instead of
+        being returned. The file is only replaced once the download is
+        complete.
+
+        Returns:
+            True if the body was transferred, False if it was taken from
+            the cache (fresh or revalidated).
+        """
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            transferred = self._fetch(url, ttl, tmp_path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        return transferred
+
+    def _fetch(self, url, ttl, body_path=None):
+        # Returns the body or, with body_path, whether it was transferred
+        entry = None
+        request_headers = {}
+        if self.cache is not None and ttl is not None:
+            entry = self.cache.lookup(url)
+            if entry is not None:
+                if time.time() - entry["fetched_at"] < ttl:
+                    return self._cached_body(entry, body_path)
+                if entry["etag"]:
+                    request_headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    request_headers["If-Modified-Since"] = entry["last_modified"]
+        attempt = 0
+        while True:
+            try:
+                status, reason, headers, body = self._open(url, request_headers, body_path)
+                if status == 304 and entry is not None:
+                    self.cache.touch(url, entry)
+                    return self._cached_body(entry, body_path)
+                if status == 200:
+                    if body_path is not None:
+                        if self.cache is not None:
+                            self.cache.put_file(url, body_path, headers)
+                        return True
+                    if self.cache is not None:
+                        self.cache.put(url, body, headers)
+                    return body
+                error = HTTPError(url, status, reason, headers, None)
+                if status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise error
+                delay = max(backoff_delay(attempt), _retry_after(headers) or 0)
+                reason = "HTTP " + str(status)
+            except (URLError, socket.timeout) as error:
+                if isinstance(error, HTTPError) or attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                reason = str(getattr(error, "reason", error))
+            self.log("{} ({}), retrying in {:.1f}s...".format(url, reason, delay))
+            self._sleep(delay)
+            attempt += 1
+
+    def _cached_body(self, entry, body_path):
+        if body_path is not None:
+            self.cache.copy_body(entry, body_path)
+            return False
+        return self.cache.read_body(entry)
+
+    def map(self, function, args_list):
+        """
+        Call function with each argument tuple of args_list in the thread
+        pool, function will usually call fetch().
+
+        Returns:
+            A list of (result, exception) tuples in the order of args_list.
+            Exactly one of both is None.
+        """
+        def call(args):
+            try:
+                return function(*args), None
+            except Exception as e:
+                return None, e
+        if self.workers <= 1 or len(args_list) <= 1:
+            return [call(args) for args in args_list]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(call, args_list))
+
+    def close(self):
+        self._pool.close()
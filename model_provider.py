@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+A cubes model provider which creates the institutional cubes on demand.
+
+The regular model file (model.json) contains a full definition for every
+institutional cube, all of which are parsed by the slicer at startup and on
+every reload. With --lazy_model, the model job writes a lazy model file
+instead: The aggregated cubes and the dimensions as usual, one shared
+template per institutional cube type ("cube_templates") and a short entry
+(name, label and template) for every institutional cube ("lazy_cubes").
+
+LazyModelProvider lists the institutional cubes from these entries and
+only builds the definition of a cube from its template when the cube is
+requested for the first time. The lazy model file selects the provider
+with its "provider" key, register_lazy_model_provider() has to be called
+before the slicer is created.
+"""
+
+import copy
+import threading
+
+from cubes import ext
+from cubes.errors import ModelError
+from cubes.providers import StaticModelProvider
+
+LAZY_PROVIDER_NAME = "openapc_lazy"
+
+_provider_registered = False
+
+
+class LazyModelProvider(StaticModelProvider):
+
+    def __init__(self, metadata=None):
+        metadata = dict(metadata or {})
+        self.cube_templates = metadata.pop("cube_templates", {})
+        self.lazy_cubes = {}
+        for cube in metadata.pop("lazy_cubes", []):
+            if cube["template"] not in self.cube_templates:
+                raise ModelError("Unknown template '{}' for cube '{}'".format(cube["template"], cube["name"]))
+            self.lazy_cubes[cube["name"]] = cube
+        self._lock = threading.Lock()
+        super(LazyModelProvider, self).__init__(metadata)
+
+    def _materialise(self, name):
+        with self._lock:
+            if name in self.lazy_cubes and name not in self.cubes_metadata:
+                cube = self.lazy_cubes[name]
+                metadata = copy.deepcopy(self.cube_templates[cube["template"]])
+                metadata.update({"name": name, "label": cube["label"]})
+                self.cubes_metadata[name] = metadata
+
+    def list_cubes(self):
+        cubes = super(LazyModelProvider, self).list_cubes()
+        for name, cube in self.lazy_cubes.items():
+            cubes.append({"name": name, "label": cube["label"], "category": None, "info": {}})
+        return cubes
+
+    def has_cube(self, name):
+        return name in self.cubes_metadata or name in self.lazy_cubes
+
+    def cube_options(self, cube_name):
+        self._materialise(cube_name)
+        return super(LazyModelProvider, self).cube_options(cube_name)
+
+    def cube_metadata(self, name, locale=None):
+        self._materialise(name)
+        return super(LazyModelProvider, self).cube_metadata(name, locale)
+
+
+def register_lazy_model_provider():
+    """
+    Make LazyModelProvider available to cubes under LAZY_PROVIDER_NAME.
+    Calling this more than once has no further effect.
+    """
+    global _provider_registered
+    if not _provider_registered:
+        # ExtensionFinder.register() of cubes 1.1 stores every extension under
+        # the same key, so the provider is added to the built-in ones instead
+        ext.model_provider.builtins[LAZY_PROVIDER_NAME] = __name__ + ":LazyModelProvider"
+        _provider_registered = True
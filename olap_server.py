@@ -1,14 +1,32 @@
+import sys
+
 from flask import Flask
 from configparser import ConfigParser
 from cubes.server import slicer
 from flask_cors import CORS
 
+from embedded_store import register_sqlite_functions
+from facts_export import register_export, register_keyset_pagination
+from model_provider import register_lazy_model_provider
+from preaggregates import register_preaggregates
+from response_cache import register_conditional_requests, register_response_cache
+from snapshots import register_snapshots
+
 
 app = Flask(__name__)
 CORS(app)
 config_parser = ConfigParser()
-config_parser.read("slicer.ini")
+# Optional: The path of another slicer configuration, like slicer_sqlite.ini
+config_parser.read(sys.argv[1] if len(sys.argv) > 1 else "slicer.ini")
+register_sqlite_functions()
+register_lazy_model_provider()
 app.register_blueprint(slicer, config=config_parser)
+register_conditional_requests(app, config_parser)
+register_response_cache(app, config_parser)
+register_preaggregates(app, config_parser)
+register_export(app, config_parser)
+register_keyset_pagination(app, config_parser)
+register_snapshots(app, config_parser)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3001)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Materialised pre-aggregates for the treemap drilldown paths.
+
+The tables job creates an aggregate table for every level of a cube's
+drilldown path (see plan_preaggregates). Each one is grouped by the filter
+dimensions and the path up to that level and stores partial results for all
+measures: record count, non-null count, sum, sum of squares, minimum and
+maximum. Every aggregate function used in the model can be derived exactly
+from these by summing over the matching groups, including the sample standard
+deviation. The tables are listed in a registry table (PREAGGREGATES_TABLE).
+
+On the server side, register_preaggregates() installs a request hook which
+answers /cube/<name>/aggregate requests from these tables if all cuts and the
+drilldown are covered by one of them. Anything else is passed on to the
+slicer unchanged.
+"""
+
+from decimal import Decimal, localcontext
+import json
+import re
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.exc import SQLAlchemyError
+
+PREAGGREGATES_TABLE = "preaggregates"
+
+# Aggregate functions which can be computed from the partial results
+SUPPORTED_FUNCTIONS = ["sum", "count", "count_nonempty", "avg", "stddev", "min", "max"]
+
+# Tables with fewer rows are cheap to aggregate directly
+MIN_SOURCE_ROWS = 5000
+
+# An aggregate table is only kept if it has at most this fraction of the
+# rows of its source table
+MAX_ROW_RATIO = 0.5
+
+# Seconds after which the server reloads the registry
+REGISTRY_TTL = 300
+
+AGGREGATE_PATH_RE = re.compile(r"^/cube/(?P<cube>[^/]+)/aggregate/?$")
+
+
+def plan_preaggregates(cube, filters, drilldowns):
+    """
+    Determine the aggregate tables for a cube.
+
+    Args:
+        cube: The cube definition from the model (a dict with "aggregates"
+              and "dimensions").
+        filters: The filter fields of the cube's hierarchy, in template order.
+        drilldowns: The drilldown path of the cube's hierarchy.
+
+    Returns:
+        A list of group column lists, one for each drilldown level. Empty if
+        the cube uses an aggregate function not in SUPPORTED_FUNCTIONS.
+    """
+    for aggregate in cube["aggregates"]:
+        if aggregate["function"] not in SUPPORTED_FUNCTIONS:
+            return []
+    filters = [field for field in filters if field in cube["dimensions"]]
+    drilldowns = [field for field in drilldowns if field in cube["dimensions"]]
+    levels = []
+    for depth in range(1, len(drilldowns) + 1):
+        levels.append(filters + drilldowns[:depth])
+    return levels
+
+def _measures(aggregates):
+    measures = []
+    for aggregate in aggregates:
+        if aggregate["function"] != "count" and aggregate["measure"] not in measures:
+            measures.append(aggregate["measure"])
+    return measures
+
+def create_preaggregate_table(connectable, schema, table_name, aggregate_table_name, group_columns, aggregates,
+                              source_schema=None):
+    """
+    Create an aggregate table from a (filled) cube table.
+
+    The aggregate table is created in schema, the source table is read from
+    source_schema if given and from schema otherwise.
+
+    The table is dropped again if the source table has less than
+    MIN_SOURCE_ROWS rows or if grouping does not reduce the number of rows
+    by at least MAX_ROW_RATIO.
+
+    Returns:
+        True if the aggregate table was kept, False otherwise.
+    """
+    preparer = connectable.dialect.identifier_preparer
+    prefix = preparer.quote_schema(schema) + "." if schema else ""
+    source_schema = source_schema or schema
+    source_prefix = preparer.quote_schema(source_schema) + "." if source_schema else ""
+    source = source_prefix + preparer.quote(table_name)
+    target = prefix + preparer.quote(aggregate_table_name)
+    groups = ", ".join([preparer.quote(column) for column in group_columns])
+    columns = [groups, "COUNT(*) AS record_count"]
+    for measure in _measures(aggregates):
+        quoted = preparer.quote(measure)
+        columns += [
+            "COUNT({0}) AS {1}".format(quoted, preparer.quote(measure + "_count")),
+            "SUM({0}) AS {1}".format(quoted, preparer.quote(measure + "_sum")),
+            "SUM({0} * {0}) AS {1}".format(quoted, preparer.quote(measure + "_sumsq")),
+            "MIN({0}) AS {1}".format(quoted, preparer.quote(measure + "_min")),
+            "MAX({0}) AS {1}".format(quoted, preparer.quote(measure + "_max"))
+        ]
+    with connectable.begin() as connection:
+        source_rows = connection.execute("SELECT COUNT(*) FROM " + source).scalar()
+        if source_rows < MIN_SOURCE_ROWS:
+            return False
+        connection.execute("DROP TABLE IF EXISTS " + target)
+        statement = "CREATE TABLE {} AS SELECT {} FROM {} GROUP BY {}"
+        connection.execute(statement.format(target, ", ".join(columns), source, groups))
+        aggregate_rows = connection.execute("SELECT COUNT(*) FROM " + target).scalar()
+        if aggregate_rows > source_rows * MAX_ROW_RATIO:
+            connection.execute("DROP TABLE " + target)
+            return False
+    return True
+
+def create_registry(connectable, schema, entries):
+    """
+    (Re)create the registry table listing all aggregate tables.
+
+    Args:
+        entries: A list of (cube_name, aggregate_table_name, group_columns,
+                 aggregates) tuples.
+    """
+    preparer = connectable.dialect.identifier_preparer
+    prefix = preparer.quote_schema(schema) + "." if schema else ""
+    registry = prefix + preparer.quote(PREAGGREGATES_TABLE)
+    insert = sqlalchemy.text("INSERT INTO " + registry + " VALUES (:cube_name, :table_name, :group_columns, " +
+                             ":aggregates)")
+    with connectable.begin() as connection:
+        connection.execute("DROP TABLE IF EXISTS " + registry)
+        connection.execute("CREATE TABLE " + registry + " (cube_name TEXT, table_name TEXT, " +
+                           "group_columns TEXT, aggregates TEXT)")
+        for cube_name, table_name, group_columns, aggregates in entries:
+            connection.execute(insert, cube_name=cube_name, table_name=table_name,
+                               group_columns=json.dumps(group_columns), aggregates=json.dumps(aggregates))
+
+def _parse_path_value(value):
+    """
+    Unescape a cut value. Returns None for anything but a single point value
+    (ranges, sets and multi-level paths are left to the slicer).
+    """
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in "-~;,":
+            # Range ("-" in cubes, "~" in the OpenAPC fork), set and path separators
+            return None
+        else:
+            chars.append(char)
+    if escaped:
+        return None
+    return "".join(chars)
+
+def parse_aggregate_request(args):
+    """
+    Parse the arguments of an /aggregate request.
+
+    Returns:
+        A tuple (drilldown, cuts), where drilldown is a dimension name or None
+        and cuts a dict mapping dimensions to point values. None if the
+        request uses any feature which is not supported here.
+    """
+    if set(args.keys()) - set(["cut", "drilldown"]):
+        return None
+    cut_args = args.getlist("cut")
+    drilldown_args = args.getlist("drilldown")
+    if len(cut_args) > 1 or len(drilldown_args) > 1:
+        return None
+    drilldown = None
+    if drilldown_args:
+        drilldown = drilldown_args[0]
+        if not re.match(r"^\w+$", drilldown):
+            return None
+    cuts = parse_point_cuts(cut_args[0] if cut_args else "")
+    if cuts is None:
+        return None
+    return drilldown, cuts
+
+def parse_point_cuts(cut_string):
+    """
+    Parse a cubes cut string consisting of point cuts only.
+
+    Returns:
+        A dict mapping dimensions to values or None if the string contains
+        anything else (ranges, sets, inverted or multi-level cuts).
+    """
+    cuts = {}
+    if not cut_string:
+        return cuts
+    # Cut separators may be escaped as well
+    for cut in re.split(r"(?<!\\)\|", cut_string):
+        dimension, sep, value = cut.partition(":")
+        if not sep or not re.match(r"^\w+$", dimension) or dimension in cuts:
+            return None
+        value = _parse_path_value(value)
+        if value is None:
+            return None
+        cuts[dimension] = value
+    return cuts
+
+def _to_float(value):
+    if value is None:
+        return None
+    return float(value)
+
+def _compute_aggregates(aggregates, record_count, partials):
+    """
+    Compute the cubes aggregates for a cell.
+
+    Args:
+        partials: A dict mapping measures to (count, sum, sumsq, min, max) tuples.
+    """
+    cell = {}
+    for aggregate in aggregates:
+        function = aggregate["function"]
+        if function == "count":
+            cell[aggregate["name"]] = int(record_count)
+            continue
+        count, total, sumsq, minimum, maximum = partials[aggregate["measure"]]
+        count = int(count or 0)
+        value = None
+        if function == "count_nonempty":
+            value = count
+        elif function == "sum":
+            value = _to_float(total)
+        elif function == "min":
+            value = _to_float(minimum)
+        elif function == "max":
+            value = _to_float(maximum)
+        elif function == "avg" and count > 0:
+            value = _to_float(Decimal(total) / count)
+        elif function == "stddev" and count > 1:
+            # Sample standard deviation, like PostgreSQL's stddev()
+            with localcontext() as context:
+                context.prec = 50
+                total = Decimal(total)
+                variance = (Decimal(sumsq) - total * total / count) / (count - 1)
+                value = _to_float(max(variance, Decimal(0)).sqrt())
+        cell[aggregate["name"]] = value
+    return cell
+
+
+class PreaggregateResolver(object):
+    """
+    Answers aggregation requests from the aggregate tables listed in the
+    registry. The registry is cached for REGISTRY_TTL seconds and reloaded
+    whenever a query fails (the tables job may have swapped the schema).
+    """
+
+    def __init__(self, engine, schema=None, record_limit=None, ttl=REGISTRY_TTL):
+        self.engine = engine
+        self.schema = schema
+        self.record_limit = record_limit
+        self.ttl = ttl
+        self._registry = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _qualified(self, table_name):
+        preparer = self.engine.dialect.identifier_preparer
+        prefix = preparer.quote_schema(self.schema) + "." if self.schema else ""
+        return prefix + preparer.quote(table_name)
+
+    def invalidate(self):
+        with self._lock:
+            self._registry = None
+
+    def registry(self):
+        with self._lock:
+            if self._registry is None or time.time() - self._loaded_at > self.ttl:
+                registry = {}
+                try:
+                    query = "SELECT cube_name, table_name, group_columns, aggregates FROM "
+                    for row in self.engine.execute(query + self._qualified(PREAGGREGATES_TABLE)):
+                        entry = (row[1], json.loads(row[2]), json.loads(row[3]))
+                        registry.setdefault(row[0], []).append(entry)
+                except SQLAlchemyError:
+                    # No registry (yet), all requests go to the slicer
+                    pass
+                self._registry = registry
+                self._loaded_at = time.time()
+            return self._registry
+
+    def _find_table(self, cube_name, dimensions):
+        candidates = []
+        for table_name, group_columns, aggregates in self.registry().get(cube_name, []):
+            if dimensions <= set(group_columns):
+                candidates.append((len(group_columns), table_name, group_columns, aggregates))
+        if not candidates:
+            return None
+        return min(candidates)[1:]
+
+    def aggregate(self, cube_name, args):
+        """
+        Answer an aggregation request.
+
+        Returns:
+            A dict shaped like a cubes aggregation result or None if the
+            request cannot be answered from an aggregate table.
+        """
+        parsed = parse_aggregate_request(args)
+        if parsed is None:
+            return None
+        drilldown, cuts = parsed
+        dimensions = set(cuts.keys())
+        if drilldown is not None:
+            dimensions.add(drilldown)
+        found = self._find_table(cube_name, dimensions)
+        if found is None:
+            return None
+        table_name, group_columns, aggregates = found
+        preparer = self.engine.dialect.identifier_preparer
+        measures = _measures(aggregates)
+        columns = ["SUM(record_count)"]
+        for measure in measures:
+            columns += ["SUM({})".format(preparer.quote(measure + "_count")),
+                        "SUM({})".format(preparer.quote(measure + "_sum")),
+                        "SUM({})".format(preparer.quote(measure + "_sumsq")),
+                        "MIN({})".format(preparer.quote(measure + "_min")),
+                        "MAX({})".format(preparer.quote(measure + "_max"))]
+        conditions = []
+        params = {}
+        for index, (dimension, value) in enumerate(sorted(cuts.items())):
+            conditions.append("{} = :cut_{}".format(preparer.quote(dimension), index))
+            params["cut_" + str(index)] = value
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        source = self._qualified(table_name)
+        try:
+            summary_row = self.engine.execute(sqlalchemy.text("SELECT " + ", ".join(columns) + " FROM " +
+                                                              source + where), **params).first()
+            cell_rows = []
+            if drilldown is not None:
+                quoted = preparer.quote(drilldown)
+                statement = "SELECT {}, {} FROM {}{} GROUP BY {} ORDER BY {}"
+                statement = statement.format(quoted, ", ".join(columns), source, where, quoted, quoted)
+                cell_rows = self.engine.execute(sqlalchemy.text(statement), **params).fetchall()
+        except SQLAlchemyError:
+            self.invalidate()
+            return None
+        if self.record_limit and len(cell_rows) > self.record_limit:
+            # Leave paging to the slicer
+            return None
+
+        def to_cell(row):
+            partials = {}
+            for index, measure in enumerate(measures):
+                partials[measure] = tuple(row[1 + index * 5:6 + index * 5])
+            return _compute_aggregates(aggregates, row[0] or 0, partials)
+
+        cells = []
+        for row in cell_rows:
+            cell = {drilldown: row[0]}
+            cell.update(to_cell(row[1:]))
+            cells.append(cell)
+        cell_cuts = []
+        for dimension, value in sorted(cuts.items()):
+            cell_cuts.append({"type": "point", "dimension": dimension, "hierarchy": "default",
+                              "level_depth": 1, "invert": False, "hidden": False, "path": [value]})
+        result = {
+            "summary": to_cell(summary_row),
+            "remainder": {},
+            "cells": cells,
+            "total_cell_count": len(cells),
+            "aggregates": [aggregate["name"] for aggregate in aggregates],
+            "cell": cell_cuts,
+            "levels": {drilldown: [drilldown]} if drilldown is not None else {},
+            "attributes": [drilldown] if drilldown is not None else [],
+            "has_split": False
+        }
+        return result
+
+
+def register_preaggregates(app, config):
+    """
+    Install a request hook on a Flask app serving the slicer which answers
+    /cube/<name>/aggregate requests from the aggregate tables where possible.
+
+    Args:
+        app: The Flask application.
+        config: The slicer configuration (a ConfigParser).
+    """
+    from flask import jsonify, request
+
+    schema = None
+    if config.has_option("store", "schema"):
+        schema = config.get("store", "schema")
+    record_limit = None
+    if config.has_option("server", "json_record_limit"):
+        record_limit = config.getint("server", "json_record_limit")
+    engine = sqlalchemy.create_engine(config.get("store", "url"))
+    resolver = PreaggregateResolver(engine, schema, record_limit)
+
+    @app.before_request
+    def answer_from_preaggregates():
+        match = AGGREGATE_PATH_RE.match(request.path)
+        if not match:
+            return None
+        result = resolver.aggregate(match.group("cube"), request.args)
+        if result is None:
+            return None
+        return jsonify(result)
+
+    return resolver
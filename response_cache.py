@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Response caching and HTTP revalidation for the slicer.
+
+The OLAP data only changes when the tables job runs, so responses to GET
+requests can be cached until then. The tables job writes a data version stamp
+(DATA_VERSION_FILE, see assets_generator.py) and every cache entry is tagged
+with the version it was created for. Whenever the stamp changes, the whole
+cache is invalidated. The same stamp is used as ETag and Last-Modified value
+for all responses, so clients and proxies can revalidate their own copies
+(see register_conditional_requests).
+
+Responses are kept in two tiers: An in-process LRU cache bounded by the size
+of the cached bodies and a shared SQLite file, which is used by all server
+processes and evicts the least recently used entries once it grows beyond its
+size limit.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DATA_VERSION_FILE = "data_version.json"
+
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+DEFAULT_SHARED_SIZE = 512 * 1024 * 1024
+DEFAULT_SHARED_FILE = "response_cache.sqlite"
+
+# Responses larger than this fraction of the memory cache are not cached
+MAX_ENTRY_RATIO = 0.125
+
+# Headers which are not stored, they are set again for every response
+UNCACHED_HEADERS = ["content-length", "set-cookie", "vary", "date", "etag", "last-modified", "cache-control"]
+
+DEFAULT_MAX_AGE = 3600
+
+# Access times in the shared cache are only updated if older than this (seconds)
+ACCESS_RESOLUTION = 60
+
+
+def read_data_version(path):
+    """
+    Read the data version stamp written by the tables job.
+
+    Returns:
+        A dict with the keys "version" (the build identifier) and "built_at"
+        (a datetime) or None if there is no valid stamp.
+    """
+    try:
+        with open(path, "r") as f:
+            stamp = json.loads(f.read())
+        built_at = datetime.strptime(stamp["built_at"], "%Y-%m-%dT%H:%M:%SZ")
+        return {"version": stamp["version"], "built_at": built_at.replace(tzinfo=timezone.utc)}
+    except (IOError, ValueError, KeyError):
+        return None
+
+def cache_key(path, args):
+    """
+    Normalise a request path and query string: Arguments are sorted by name,
+    the order of repeated arguments is kept.
+    """
+    items = []
+    for name in sorted(args.keys()):
+        for value in args.getlist(name):
+            items.append(name + "=" + value)
+    return path + "?" + "&".join(items)
+
+
+class DataVersion(object):
+    """
+    Keeps track of the data version stamp. The file is checked on every
+    call to current(), but only read if its modification time has changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stamp = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        """
+        Returns:
+            The current stamp (see read_data_version) or None.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._stamp = read_data_version(self.path) if mtime is not None else None
+            return self._stamp
+
+
+class MemoryCache(object):
+    """
+    An LRU cache bounded by the total size of the cached bodies. Entries are
+    tuples with the body as last element.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)[-1])
+            self._entries[key] = entry
+            self.size += len(entry[-1])
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[-1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class SharedCache(object):
+    """
+    An LRU cache stored in an SQLite file which can be shared by several
+    processes. Entries are tagged with the data version, entries of other
+    versions are never returned and removed by clear_other_versions().
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        connection = self._connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, version TEXT, " +
+                               "status INTEGER, headers TEXT, body BLOB, size INTEGER, accessed REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_idx ON entries (accessed)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, version):
+        connection = self._connection()
+        row = connection.execute("SELECT status, headers, body, accessed FROM entries WHERE key = ? AND " +
+                                 "version = ?", (key, version)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[3] > ACCESS_RESOLUTION:
+            with connection:
+                connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return row[0], json.loads(row[1]), bytes(row[2])
+
+    def put(self, key, version, entry):
+        status, headers, body = entry
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (key, version, status, json.dumps(headers), sqlite3.Binary(body), len(body),
+                                time.time()))
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total > self.max_size:
+                oldest = connection.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 100").fetchall()
+                if not oldest:
+                    break
+                for oldest_key, size in oldest:
+                    connection.execute("DELETE FROM entries WHERE key = ?", (oldest_key,))
+                    total -= size
+                    if total <= self.max_size:
+                        break
+
+    def clear_other_versions(self, version):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries WHERE version != ?", (version,))
+
+
+class ResponseCache(object):
+    """
+    Combines the memory and the shared cache and invalidates both whenever
+    the data version changes.
+    """
+
+    def __init__(self, data_version, memory_size=DEFAULT_MEMORY_SIZE, shared_file=None,
+                 shared_size=DEFAULT_SHARED_SIZE):
+        self.data_version = data_version
+        self.memory = MemoryCache(memory_size)
+        self.max_entry_size = int(memory_size * MAX_ENTRY_RATIO)
+        self.shared = SharedCache(shared_file, shared_size) if shared_file else None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        stamp = self.data_version.current()
+        version = stamp["version"] if stamp is not None else None
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self.memory.clear()
+                if self.shared is not None and version is not None:
+                    self.shared.clear_other_versions(version)
+            return self.version
+
+    def get(self, key):
+        """
+        Returns:
+            A (status, headers, body) tuple or None.
+        """
+        version = self.current_version()
+        if version is None:
+            return None
+        entry = self.memory.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1:]
+        if self.shared is not None:
+            entry = self.shared.get(key, version)
+            if entry is not None:
+                self.memory.put(key, (version,) + entry)
+                return entry
+        return None
+
+    def put(self, key, status, headers, body):
+        version = self.current_version()
+        if version is None or len(body) > self.max_entry_size:
+            return
+        self.memory.put(key, (version, status, headers, body))
+        if self.shared is not None:
+            self.shared.put(key, version, (status, headers, body))
+
+
+def _option(config, name, default):
+    if config.has_option("response_cache", name):
+        return config.get("response_cache", name)
+    return default
+
+def _data_version(config, base_dir):
+    return DataVersion(os.path.join(base_dir, _option(config, "data_version_file", DATA_VERSION_FILE)))
+
+def register_response_cache(app, config, base_dir=None):
+    """
+    Install the response cache on a Flask app serving the slicer.
+
+    Settings are read from the optional [response_cache] section of the slicer
+    configuration: memory_size and shared_size in bytes, shared_file (empty to
+    disable the shared tier) and data_version_file. Relative paths are
+    resolved against base_dir (Default: the current working directory).
+    The cache should be registered before any other request hooks answering
+    slicer requests, so their responses are cached as well.
+
+    Returns:
+        The ResponseCache.
+    """
+    from flask import g, request
+
+    base_dir = base_dir or os.getcwd()
+    shared_file = _option(config, "shared_file", DEFAULT_SHARED_FILE)
+    if shared_file:
+        shared_file = os.path.join(base_dir, shared_file)
+    cache = ResponseCache(_data_version(config, base_dir), int(_option(config, "memory_size", DEFAULT_MEMORY_SIZE)),
+                          shared_file, int(_option(config, "shared_size", DEFAULT_SHARED_SIZE)))
+
+    @app.before_request
+    def answer_from_cache():
+        if request.method != "GET":
+            return None
+        g.response_cache_key = cache_key(request.path, request.args)
+        entry = cache.get(g.response_cache_key)
+        if entry is None:
+            return None
+        g.response_cache_hit = True
+        status, headers, body = entry
+        return app.response_class(body, status=status, headers=headers)
+
+    @app.after_request
+    def store_in_cache(response):
+        key = g.get("response_cache_key")
+        if key is None or g.get("response_cache_hit") or response.status_code != 200:
+            return response
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in UNCACHED_HEADERS and not name.lower().startswith("access-control-")]
+        cache.put(key, response.status_code, headers, response.get_data())
+        return response
+
+    return cache
+
+def register_conditional_requests(app, config, base_dir=None):
+    """
+    Tie HTTP caching to the data build: Successful GET responses get an
+    ETag (the data version), a Last-Modified header (the build time) and a
+    Cache-Control header with the max_age from the [response_cache] section.
+    Matching If-None-Match or If-Modified-Since requests are answered with
+    304 Not Modified before any other request hook runs, so this should be
+    registered first.
+
+    Returns:
+        The DataVersion used.
+    """
+    from flask import request
+
+    base_dir = base_dir or os.getcwd()
+    data_version = _data_version(config, base_dir)
+    max_age = int(_option(config, "max_age", DEFAULT_MAX_AGE))
+
+    def add_validators(response, stamp):
+        response.set_etag(stamp["version"])
+        response.last_modified = stamp["built_at"]
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response
+
+    @app.before_request
+    def answer_not_modified():
+        if request.method != "GET":
+            return None
+        stamp = data_version.current()
+        if stamp is None:
+            return None
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(stamp["version"])
+        elif request.if_modified_since:
+            not_modified = request.if_modified_since >= stamp["built_at"]
+        else:
+            not_modified = False
+        if not not_modified:
+            return None
+        return add_validators(app.response_class(status=304), stamp)
+
+    @app.after_request
+    def add_cache_headers(response):
+        if request.method != "GET" or response.status_code != 200:
+            return response
+        stamp = data_version.current()
+        if stamp is None:
+            return response
+        return add_validators(response, stamp)
+
+    return data_version
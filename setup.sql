@@ -5,7 +5,10 @@
 CREATE USER table_creator WITH PASSWORD :pw;
 CREATE USER cubes_user WITH PASSWORD 'no_password';
 CREATE DATABASE openapc_db;
+-- table_creator builds new tables in a staging schema and swaps it with
+-- openapc_schema afterwards, so it needs to create and own schemas
+GRANT CREATE ON DATABASE openapc_db TO table_creator;
 \c openapc_db;
-CREATE SCHEMA openapc_schema;
+CREATE SCHEMA openapc_schema AUTHORIZATION table_creator;
 GRANT ALL PRIVILEGES ON SCHEMA openapc_schema TO table_creator WITH GRANT OPTION;
 GRANT USAGE ON SCHEMA openapc_schema TO cubes_user;
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Columnar bulk snapshots of the cube tables.
+
+The snapshots job (see assets_generator.py) exports the enriched contents of
+the static cube tables and optionally of all institutional cubes to one file
+per table, either Parquet or Arrow IPC (both zstd compressed). Rows are
+sorted by period and publisher, so the row group statistics of Parquet files
+on these columns allow readers to skip most of a file when filtering by year
+or publisher. An index file (SNAPSHOT_INDEX_FILE) lists all files together
+with their row counts and the data version they were created from.
+
+register_snapshots() serves the snapshot directory as static downloads under
+/snapshots/ from the slicer app.
+
+Requires pyarrow.
+"""
+
+import json
+import os
+
+import sqlalchemy
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_INDEX_FILE = "index.json"
+
+FORMATS = {
+    "parquet": ".parquet",
+    "arrow": ".arrow"
+}
+
+# Aggregated tables, institutional cubes are listed in the cubes list file
+STATIC_TABLES = ["openapc", "openapc_ac", "bpc", "transformative_agreements", "deal", "combined",
+                 "springer_compact_coverage", "doi_lookup"]
+
+SORT_COLUMNS = ["period", "publisher"]
+
+# Internal columns which are left out of the snapshots
+EXCLUDED_COLUMNS = ["id"]
+
+# Rows per Parquet row group (and per Arrow record batch)
+ROW_GROUP_SIZE = 50000
+
+COMPRESSION = "zstd"
+
+
+def _arrow_type(column):
+    if isinstance(column.type, sqlalchemy.Integer):
+        return pyarrow.int64()
+    if isinstance(column.type, sqlalchemy.Numeric):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def _to_arrow_value(value):
+    # Numeric columns are returned as Decimal by psycopg2
+    if value is not None and not isinstance(value, (int, str)):
+        return float(value)
+    return value
+
+def _open_writer(path, schema, output_format):
+    if output_format == "parquet":
+        return pyarrow.parquet.ParquetWriter(path, schema, compression=COMPRESSION, write_statistics=True)
+    options = pyarrow.ipc.IpcWriteOptions(compression=COMPRESSION)
+    return pyarrow.ipc.new_file(path, schema, options=options)
+
+def write_snapshot(connectable, schema, table_name, path, output_format="parquet"):
+    """
+    Write the contents of a table to a snapshot file. The file is written
+    under a temporary name first and renamed once it is complete.
+
+    Returns:
+        The number of rows written.
+    """
+    table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload=True, autoload_with=connectable,
+                             schema=schema)
+    columns = [column for column in table.columns if column.name not in EXCLUDED_COLUMNS]
+    arrow_schema = pyarrow.schema([(column.name, _arrow_type(column)) for column in columns])
+    statement = sqlalchemy.select(columns)
+    order_by = [table.c[name] for name in SORT_COLUMNS if name in table.c]
+    if order_by:
+        statement = statement.order_by(*order_by)
+    tmp_path = path + ".tmp"
+    num_rows = 0
+    connection = connectable.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        writer = _open_writer(tmp_path, arrow_schema, output_format)
+        try:
+            while True:
+                rows = result.fetchmany(ROW_GROUP_SIZE)
+                if not rows:
+                    break
+                arrays = []
+                for index, field in enumerate(arrow_schema):
+                    values = [_to_arrow_value(row[index]) for row in rows]
+                    arrays.append(pyarrow.array(values, type=field.type))
+                batch = pyarrow.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+                if output_format == "parquet":
+                    writer.write_table(pyarrow.Table.from_batches([batch]), row_group_size=ROW_GROUP_SIZE)
+                else:
+                    writer.write_batch(batch)
+                num_rows += len(rows)
+        finally:
+            writer.close()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    return num_rows
+
+def write_snapshots(connectable, schema, table_names, directory, output_format="parquet", data_version=None):
+    """
+    Write snapshots of several tables into a directory and (re-)create its
+    index file. Snapshots of tables which are no longer exported are removed.
+
+    Args:
+        connectable: An SQLAlchemy engine.
+        schema: The database schema of the tables.
+        table_names: A list of table names.
+        directory: The output directory, it is created if necessary.
+        output_format: "parquet" or "arrow".
+        data_version: The data version stamp of the build (as dict), stored
+                      in the index file.
+
+    Returns:
+        The index content as dict.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    extension = FORMATS[output_format]
+    files = []
+    for table_name in table_names:
+        file_name = table_name + extension
+        num_rows = write_snapshot(connectable, schema, table_name, os.path.join(directory, file_name),
+                                  output_format)
+        files.append({"table": table_name, "file": file_name, "rows": num_rows})
+    file_names = set([entry["file"] for entry in files])
+    for file_name in os.listdir(directory):
+        if file_name.endswith(tuple(FORMATS.values())) and file_name not in file_names:
+            os.remove(os.path.join(directory, file_name))
+    index = {
+        "format": output_format,
+        "data_version": data_version,
+        "files": files
+    }
+    tmp_path = os.path.join(directory, SNAPSHOT_INDEX_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(index, indent=4))
+    os.replace(tmp_path, os.path.join(directory, SNAPSHOT_INDEX_FILE))
+    return index
+
+def register_snapshots(app, config, base_dir=None):
+    """
+    Serve the snapshot directory under /snapshots/ from a Flask app. The
+    directory can be set with the directory option of an optional [snapshots]
+    section in the slicer configuration, relative paths are resolved against
+    base_dir (Default: the current working directory).
+
+    Returns:
+        The snapshot directory.
+    """
+    from flask import Blueprint, send_from_directory
+
+    base_dir = base_dir or os.getcwd()
+    directory = SNAPSHOT_DIR
+    if config.has_option("snapshots", "directory"):
+        directory = config.get("snapshots", "directory")
+    directory = os.path.join(base_dir, directory)
+    blueprint = Blueprint("snapshots", __name__)
+
+    @blueprint.route("/snapshots/")
+    @blueprint.route("/snapshots/<path:file_name>")
+    def download_snapshot(file_name=SNAPSHOT_INDEX_FILE):
+        return send_from_directory(directory, file_name)
+
+    app.register_blueprint(blueprint)
+    return directory
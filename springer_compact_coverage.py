@@ -3,14 +3,18 @@
 
 import csv
 import datetime
-from html.parser import HTMLParser
+import hashlib
+import html
 import json
 import os
 import re
 import sys
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+import time
+from urllib.error import HTTPError, URLError
 
+import cache_index
+from coverage_store import CoverageStore
+from http_client import Fetcher, ResponseCache, DEFAULT_RATE_LIMIT, DEFAULT_WORKERS, RETRY_STATUS_CODES
 from util import colorise
 
 JOURNAL_ID_RE = re.compile(r'<a href="/journal/(?P<journal_id>\d+)" title=".*?">', re.IGNORECASE)
@@ -19,9 +23,13 @@ SEARCH_RESULTS_TITLE_RE = re.compile(r'<p class="message">You are now only searc
 
 ISSN_RE = re.compile(r"^(?P<first_part>\d{4})-?(?P<second_part>\d{3})(?P<check_digit>[\dxX])$")
 
-SPRINGER_OA_SEARCH = "https://link.springer.com/search?facet-journal-id={}&package=openaccessarticles&search-within=Journal&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
-SPRINGER_FULL_SEARCH = "https://link.springer.com/search?facet-journal-id={}&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
-SPRINGER_GET_CSV = "https://link.springer.com/search/csv?date-facet-mode=between&search-within=Journal&facet-journal-id={}&facet-start-year={}&facet-end-year={}&query="
+# Base URLs, can be pointed to a local stand-in server for testing
+SPRINGER_LINK_URL = "https://link.springer.com"
+DOI_RESOLVER_URL = "https://doi.org"
+
+SPRINGER_OA_SEARCH = "/search?facet-journal-id={}&package=openaccessarticles&search-within=Journal&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
+SPRINGER_FULL_SEARCH = "/search?facet-journal-id={}&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
+SPRINGER_GET_CSV = "/search/csv?date-facet-mode=between&search-within=Journal&facet-journal-id={}&facet-start-year={}&facet-end-year={}&query="
 
 COVERAGE_CACHE = {}
 PERSISTENT_PUBDATES_CACHE = {} # Persistent cache, loaded from PUBDATES_CACHE_FILE on startup
@@ -29,13 +37,45 @@ PERSISTENT_PUBDATES_CACHE = {} # Persistent cache, loaded from PUBDATES_CACHE_FI
 TEMP_JOURNAL_CACHE = {} # keeps cached journal statistics imported from CSV files. Intended to reduce I/O workload when multiple articles from the same journal have to be looked up. 
 
 JOURNAL_ID_CACHE = None # keeps journal IDs cached which had to be retreived from SpringerLink to avoid multiple lookups.
+JOURNAL_ID_FAILURES = None # failed journal ID lookups, to avoid repeating them on every run.
 
 COVERAGE_CACHE_FILE = "coverage_stats.json"
 PUBDATES_CACHE_FILE = "article_pubdates.json"
 JOURNAL_ID_CACHE_FILE = "journal_ids.json"
+JOURNAL_ID_FAILURES_FILE = "journal_id_failures.json"
+
+# Failed journal ID lookups are retried after this many seconds
+JOURNAL_ID_FAILURE_TTL = 30 * 24 * 3600
+
+# How to obtain the journal ID of a Springer DOI, by DOI prefix. The first
+# matching rule applies. The ID is either extracted from the DOI itself, a
+# fixed one or has to be looked up on the article's landing page.
+JOURNAL_ID_FROM_DOI = "doi"
+JOURNAL_ID_FROM_LANDING_PAGE = "landing_page"
+JOURNAL_ID_PREFIX_RULES = [
+    (["10.1007/s", "10.3758/s", "10.1245/s", "10.1617/s", "10.1186/s", "10.1208/s", "10.1365/s", "10.1038/s",
+      "10.1057/s", "10.2478/s", "10.1557/s"], JOURNAL_ID_FROM_DOI),
+    (["10.14283"], "42415"), # Irregular prefix, contains only the "Journal of Frailty & Aging"
+    (["10.1631"], "11582"), # Irregular, "Journal of Zhejiang University-SCIENCE A"
+    (["10.3938/jkps"], "40042"), # Irregular, "Journal of the Korean Physical Society"
+    # EPJ family, Canadian Public Health Association
+    (["10.1140", "10.17269"], JOURNAL_ID_FROM_LANDING_PAGE)
+]
 
 JOURNAL_CSV_DIR = "coverage_article_files"
 
+# Number of most recent years for which journal CSV files are downloaded again
+# on refetch, older years rarely change
+JOURNAL_CSV_REFETCH_YEARS = 2
+
+# Raw SpringerLink responses, see http_client.ResponseCache
+HTTP_CACHE_DIR = "http_cache"
+
+# Maximum age (seconds) of cached responses before they are revalidated
+SEARCH_PAGE_TTL = 7 * 24 * 3600
+JOURNAL_CSV_TTL = 24 * 3600
+LANDING_PAGE_TTL = 90 * 24 * 3600
+
 # A directory containing the official annual journal lists published by Springer.
 # Can be obtained from https://www.springernature.com/gp/librarians/licensing/journals-price-list
 # Excel files will need some preprocessing:
@@ -47,11 +87,23 @@ SPRINGER_JOURNAL_LISTS_DIR = "springer_journal_lists"
 ERROR_MSGS = []
 LOOKUPS_PERFORMED = None
 
+FETCHER = Fetcher() # Replaced in update_coverage_stats()
+
+STORE = None # A CoverageStore, set up in update_coverage_stats()
+
+# Number of journal lookups submitted to the fetcher at once
+LOOKUP_BATCH_SIZE = 64
+
+# Kinds of work queue items
+STATS_TASK = "stats" # coverage stats for a journal-year from the catalogue
+DOI_TASK = "doi" # publication year (and stats) for an article from the transformative agreements file
+
 
 def _shutdown():
     """
     Write cache content back to disk before terminating and display collected error messages.
     """
+    # The store is up to date already, the JSON files are exported for the tables job
     print("Updating cache files..")
     with open(COVERAGE_CACHE_FILE, "w") as f:
         f.write(json.dumps(COVERAGE_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
@@ -59,10 +111,12 @@ def _shutdown():
     with open(PUBDATES_CACHE_FILE, "w") as f:
         f.write(json.dumps(PERSISTENT_PUBDATES_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
         f.flush()
-    with open(JOURNAL_ID_CACHE_FILE, "w") as f:
-        f.write(json.dumps(JOURNAL_ID_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
-        f.flush()
+    _write_journal_id_caches()
+    _write_cache_indexes(COVERAGE_CACHE, PERSISTENT_PUBDATES_CACHE)
     print("Done.")
+    FETCHER.close()
+    if STORE is not None:
+        STORE.close()
     num_articles = 0
     for _, dois in PERSISTENT_PUBDATES_CACHE.items():
         num_articles += len(dois)
@@ -73,54 +127,122 @@ def _shutdown():
             print(msg)
     sys.exit()
 
-def _process_springer_catalogue(max_lookups=None):
-    global COVERAGE_CACHE, LOOKUPS_PERFORMED
+def _write_cache_indexes(coverage, pubdates):
+    # Lookup indexes for the tables job, see cache_index.py
+    cache_index.write_coverage_index(COVERAGE_CACHE_FILE, coverage)
+    cache_index.write_pubdates_index(PUBDATES_CACHE_FILE, pubdates)
+
+def update_cache_indexes():
+    """
+    (Re-)create the lookup indexes of the coverage and pubdates cache files,
+    without performing any lookups.
+    """
+    with open(COVERAGE_CACHE_FILE, "r") as f:
+        coverage = json.loads(f.read())
+    with open(PUBDATES_CACHE_FILE, "r") as f:
+        pubdates = json.loads(f.read())
+    _write_cache_indexes(coverage, pubdates)
+
+def _catalogue_years():
     current_year = datetime.datetime.now().year
-    years = [str(year) for year in range(2015, current_year + 1)]
+    return [str(year) for year in range(2015, current_year + 1)]
+
+def _stats_cached(journal_id, year):
+    try:
+        _ = COVERAGE_CACHE[journal_id]['years'][year]["num_journal_total_articles"]
+        _ = COVERAGE_CACHE[journal_id]['years'][year]["num_journal_oa_articles"]
+        return True
+    except KeyError:
+        return False
+
+def _plan_catalogue_stats():
+    """
+    Find all Open Choice journal-years in the Springer catalogue files which
+    have no coverage stats yet.
+
+    Returns:
+        A list of work queue items (see CoverageStore.replace_work_queue).
+    """
+    years = _catalogue_years()
     for year in years:
         # Perform a simple check before wasting any time on processing
         catalogue_file = os.path.join(SPRINGER_JOURNAL_LISTS_DIR, year + ".csv")
         if not os.path.isfile(catalogue_file):
             raise IOError("Catalogue file " + catalogue_file + " not found!")
+    items = []
     for year in years:
-        msg = "Looking up coverage stats for Open Choice journals in " + year
-        print(colorise("--- " + msg + " ---", "green"))
         catalogue_file = os.path.join(SPRINGER_JOURNAL_LISTS_DIR, year + ".csv")
-        reader = csv.DictReader(open(catalogue_file, "r"))
-        for line in reader:
-            if max_lookups is not None and LOOKUPS_PERFORMED >= max_lookups:
-                return
-            title = line["Title"]
-            oa_option = line["Open Access Option"]
-            if oa_option != "Hybrid (Open Choice)":
-                msg = u'Journal "{}" is not an Open Choice journal (oa_option={}), skipping...'
-                print(colorise(msg.format(title, oa_option), "yellow"))
-                continue
-            journal_id = line["product_id"]
-            already_cached = True
-            try:
-                _ = COVERAGE_CACHE[journal_id]['years'][year]["num_journal_total_articles"]
-                _ = COVERAGE_CACHE[journal_id]['years'][year]["num_journal_oa_articles"]
-            except KeyError:
-                try:
-                    _update_journal_stats(title, journal_id, year)
-                except ValueError as ve:
-                    error_msg = ('Journal "{}" ({}): ValueError while obtaining journal ' +
-                                 'stats, annual stats not added to cache.')
-                    error_msg = colorise(error_msg.format(title, journal_id), "red")
-                    print(error_msg)
-                    ERROR_MSGS.append(error_msg)
+        with open(catalogue_file, "r") as f:
+            for line in csv.DictReader(f):
+                if line["Open Access Option"] != "Hybrid (Open Choice)":
                     continue
-                LOOKUPS_PERFORMED += 1
-                already_cached = False
-            if already_cached:
-                msg = 'Stats for journal "{}" in {} already cached.'
-                print(colorise(msg.format(title, year), "yellow"))
+                journal_id = line["product_id"]
+                if not _stats_cached(journal_id, year):
+                    payload = {"title": line["Title"], "journal_id": journal_id, "year": year}
+                    items.append((STATS_TASK, journal_id + "/" + year, payload))
+    return items
 
-def _update_journal_stats(title, journal_id, year, verbose=True):
-    global COVERAGE_CACHE
+def _drain_stats_tasks(tasks, max_lookups=None):
+    """
+    Obtain the coverage stats for a list of (item_id, payload) stats tasks
+    from the work queue, LOOKUP_BATCH_SIZE journals at a time.
+
+    Returns:
+        False if the run was stopped because max_lookups was reached.
+    """
+    global LOOKUPS_PERFORMED
+    pending = []
+    for item_id, payload in tasks:
+        if _stats_cached(payload["journal_id"], payload["year"]):
+            STORE.complete_work(item_id)
+        else:
+            pending.append((item_id, payload))
+    while pending:
+        batch_size = LOOKUP_BATCH_SIZE
+        if max_lookups is not None:
+            batch_size = min(batch_size, max_lookups - LOOKUPS_PERFORMED)
+            if batch_size <= 0:
+                return False
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        args_list = [(payload["journal_id"], payload["year"]) for _, payload in batch]
+        results = FETCHER.map(_fetch_journal_stats, args_list)
+        for (item_id, payload), (stats, error) in zip(batch, results):
+            title, journal_id = payload["title"], payload["journal_id"]
+            if isinstance(error, ValueError):
+                error_msg = ('Journal "{}" ({}): ValueError while obtaining journal ' +
+                             'stats, annual stats not added to cache.')
+                error_msg = colorise(error_msg.format(title, journal_id), "red")
+                print(error_msg)
+                ERROR_MSGS.append(error_msg)
+                # Try again in the next run, after all other work
+                STORE.requeue_work(item_id)
+                continue
+            elif error is not None:
+                raise error
+            _store_journal_stats(title, journal_id, payload["year"], *stats)
+            STORE.complete_work(item_id)
+            LOOKUPS_PERFORMED += 1
+    return True
+
+def _fetch_journal_stats(journal_id, year):
     total = _get_springer_journal_stats(journal_id, year, oa=False)
     oa = _get_springer_journal_stats(journal_id, year, oa=True)
+    return total, oa
+
+def _update_journal_stats(title, journal_id, year, verbose=True):
+    # Both searches are independent, run them concurrently
+    args_list = [(journal_id, year, False), (journal_id, year, True)]
+    results = FETCHER.map(_get_springer_journal_stats, args_list)
+    for _, error in results:
+        if error is not None:
+            raise error
+    (total, _), (oa, _) = results
+    _store_journal_stats(title, journal_id, year, total, oa, verbose)
+
+def _store_journal_stats(title, journal_id, year, total, oa, verbose=True):
+    global COVERAGE_CACHE
+    if STORE is not None:
+        STORE.put_journal_stats(journal_id, title, year, total["count"], oa["count"])
     if verbose:
         msg = 'Obtained stats for journal "{}" in {}: {} OA, {} Total'
         print(colorise(msg.format(title, year, oa["count"], total["count"]), "green"))
@@ -131,9 +253,22 @@ def _update_journal_stats(title, journal_id, year, verbose=True):
     COVERAGE_CACHE[journal_id]['years'][year]["num_journal_total_articles"] = total["count"]
     COVERAGE_CACHE[journal_id]['years'][year]["num_journal_oa_articles"] = oa["count"]
 
-def update_coverage_stats(transformative_agreements_file, max_lookups, refetch=True):
-    global COVERAGE_CACHE, JOURNAL_ID_CACHE, PERSISTENT_PUBDATES_CACHE, LOOKUPS_PERFORMED
+def update_coverage_stats(transformative_agreements_file, max_lookups, refetch=True, workers=DEFAULT_WORKERS,
+                          rate_limit=DEFAULT_RATE_LIMIT, dry_run=False, replan=False):
+    """
+    Look up missing coverage stats and publication years.
+
+    The missing work is planned once (journal-years from the Springer
+    catalogue files and articles from the transformative agreements file)
+    and stored as a work queue in the CoverageStore. Later runs continue
+    with the remaining queue, it is only planned again if the source files
+    have changed or replan is set. With dry_run, only the remaining work is
+    reported.
+    """
+    global COVERAGE_CACHE, JOURNAL_ID_CACHE, PERSISTENT_PUBDATES_CACHE, LOOKUPS_PERFORMED, FETCHER, STORE
     LOOKUPS_PERFORMED = 0
+    FETCHER = Fetcher(workers=workers, per_host=workers, rate_limit=rate_limit,
+                      log=lambda msg: print(colorise(msg, "yellow")), cache=ResponseCache(HTTP_CACHE_DIR))
     if os.path.isfile(COVERAGE_CACHE_FILE):
         with open(COVERAGE_CACHE_FILE, "r") as f:
             try:
@@ -152,211 +287,430 @@ def update_coverage_stats(transformative_agreements_file, max_lookups, refetch=T
                 print("Could not decode a cache structure from " + PUBDATES_CACHE_FILE + ", starting with an empty pub date cache.")
     else:
         print("No cache file (" + PUBDATES_CACHE_FILE + ") found, starting with an empty pub date cache.")
-        
+    _load_journal_id_cache()
+    # Recover results of interrupted runs, which are in the store but not in the JSON files
+    STORE = CoverageStore()
+    STORE.merge(COVERAGE_CACHE, PERSISTENT_PUBDATES_CACHE, JOURNAL_ID_CACHE, JOURNAL_ID_FAILURES)
+
     if not os.path.isdir(JOURNAL_CSV_DIR):
         raise IOError("Journal CSV directory " + JOURNAL_CSV_DIR + " not found!")
 
-    _process_springer_catalogue(max_lookups)
+    plan_inputs = _plan_inputs(transformative_agreements_file)
+    if replan or STORE.plan_inputs() != plan_inputs:
+        print(colorise("Planning work queue...", "green"))
+        items = _plan_catalogue_stats() + _plan_transformative_agreements(transformative_agreements_file)
+        STORE.replace_work_queue(items, plan_inputs)
+    else:
+        print(colorise("Source files unchanged, resuming the work queue of the last run.", "green"))
+    work_queue = STORE.pending_work()
+    _report_work_queue(work_queue, refetch)
+    if dry_run:
+        STORE.close()
+        return
+
+    stats_tasks = [(item_id, payload) for item_id, kind, payload in work_queue if kind == STATS_TASK]
+    if not _drain_stats_tasks(stats_tasks, max_lookups):
+        print("maximum number of lookups performed.")
+        _shutdown()
 
-    reader = csv.DictReader(open(transformative_agreements_file, "r"))
-    for line in reader:
+    doi_tasks = [(item_id, payload) for item_id, kind, payload in work_queue if kind == DOI_TASK]
+    journal_ids = resolve_springer_journal_ids([(payload["doi"], payload["issn"]) for _, payload in doi_tasks])
+    for item_id, payload in doi_tasks:
         if max_lookups is not None and LOOKUPS_PERFORMED >= max_lookups:
             print("maximum number of lookups performed.")
             _shutdown()
-        lookup_performed = False
-        found = True
-        publisher = line["publisher"]
-        if publisher != "Springer Nature":
+        journal_id = journal_ids[payload["doi"]]
+        if journal_id is None:
+            STORE.requeue_work(item_id)
             continue
-        issn = line["issn"]
-        period = line["period"]
-        title = line["journal_full_title"]
-        doi = line["doi"]
-        journal_id = _get_springer_journal_id_from_doi(doi, issn)
-        # Retreive publication dates for articles from CSV summaries on SpringerLink.
-        # Employ a multi-level cache structure to minimize IO:
-        #  1. try to look up the doi in the persistent publication dates cache
-        #  2. if the journal is not present, repopulate local cache segment from a CSV file in the journal CSV dir
-        #  3a. if no CSV for the journal could be found, fetch it from SpringerLink
-        #  3b. Alternative to 3: If a CSV was found but it does not contain the DOI, re-fetch it from SpringerLink 
-        try:
-            _ = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
-            print("Journal {} ('{}'): DOI {} already cached.".format(journal_id, title, doi))
-        except KeyError:
-            if journal_id not in TEMP_JOURNAL_CACHE:
-                msg = "Journal {} ('{}'): Not found in temp cache, repopulating..."
-                print(msg.format(journal_id, title))
-                TEMP_JOURNAL_CACHE[journal_id] = _get_journal_cache_from_csv(journal_id, refetch=False)
-            if doi not in TEMP_JOURNAL_CACHE[journal_id]:
-                if refetch:
-                    msg = u"Journal {} ('{}'): DOI {} not found in cache, re-fetching csv file..."
-                    print(msg.format(journal_id, title, doi))
-                    TEMP_JOURNAL_CACHE[journal_id] = _get_journal_cache_from_csv(journal_id, refetch=True)
-                if doi not in TEMP_JOURNAL_CACHE[journal_id]:
-                    msg = u"Journal {} ('{}'): DOI {} NOT FOUND in SpringerLink data!"
-                    msg = colorise(msg.format(title, journal_id, doi), "red")
-                    print(msg)
-                    ERROR_MSGS.append(msg)
-                    found = False
-            lookup_performed = True
-            if journal_id not in PERSISTENT_PUBDATES_CACHE:
-                PERSISTENT_PUBDATES_CACHE[journal_id] = {}
-            if found:
-                PERSISTENT_PUBDATES_CACHE[journal_id][doi] = TEMP_JOURNAL_CACHE[journal_id][doi]
-                pub_year = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
-                compare_msg = u"DOI {} found in Springer data, Pub year is {} ".format(doi, pub_year)
-                if pub_year == period:
-                    compare_msg += colorise("(same as transformative_agreements period)", "green")
-                else:
-                    compare_msg += colorise("(DIFFERENT from transformative_agreements period, which is {})".format(period), "yellow")
-                msg = u"Journal {} ('{}'): ".format(journal_id, title)
-                print(msg.ljust(80) + compare_msg)
+        lookup_performed, found = _process_transformative_agreements_row(payload["doi"], journal_id,
+                                                                         payload["period"], payload["title"],
+                                                                         refetch)
         if found:
-            pub_year = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
+            STORE.complete_work(item_id)
         else:
-            # If a lookup error occured we will retreive coverage stats for the period year instead, since
-            # the aggregation process will make use of this value.
-            pub_year = period
-        # Test if journal stats are present
-        try:
-            _ = COVERAGE_CACHE[journal_id]['years'][pub_year]["num_journal_total_articles"]
-            _ = COVERAGE_CACHE[journal_id]['years'][pub_year]["num_journal_oa_articles"]
-        except KeyError:
-            try:
-                _update_journal_stats(title, journal_id, pub_year)
-                lookup_performed = True
-                error_msg = ('No stats found for journal "{}" ({}) in {} albeit having ' +
-                             'downloaded the full Open Choice catalogue. Stats were ' +
-                             'obtained retroactively.')
-                error_msg = colorise(error_msg.format(title, journal_id, pub_year), "red")
-                print(error_msg)
-                ERROR_MSGS.append(error_msg)
-            except ValueError as ve:
-                error_msg = ('Critical Error while processing DOI {}: No stats found ' +
-                             ' for journal "{}" ({}) in {} albeit having downloaded the ' +
-                             'full Open Choice catalogue and stats could not be obtained ' +
-                             'retroactively (ValueError: {}).')
-                error_msg = colorise(error_msg.format(doi, title, journal_id, pub_year, str(ve)), "red")
-                print(error_msg)
-                ERROR_MSGS.append(error_msg)
-                _shutdown()
+            STORE.requeue_work(item_id)
         if lookup_performed:
             LOOKUPS_PERFORMED += 1
     _shutdown()
 
+def _plan_inputs(transformative_agreements_file):
+    """
+    A fingerprint of the files the work queue is planned from (names, sizes
+    and modification times). The queue is planned again when it changes.
+    """
+    paths = [os.path.join(SPRINGER_JOURNAL_LISTS_DIR, year + ".csv") for year in _catalogue_years()]
+    paths.append(transformative_agreements_file)
+    inputs = []
+    for path in paths:
+        stat = os.stat(path) if os.path.isfile(path) else None
+        inputs.append([path, stat.st_size if stat else None, stat.st_mtime_ns if stat else None])
+    return hashlib.sha1(json.dumps(inputs).encode("utf-8")).hexdigest()
+
+def _plan_transformative_agreements(transformative_agreements_file):
+    """
+    Find all Springer Nature articles in the transformative agreements file
+    with an unknown journal ID, publication year or missing coverage stats
+    for their publication year.
+
+    Returns:
+        A list of work queue items (see CoverageStore.replace_work_queue).
+    """
+    items = []
+    with open(transformative_agreements_file, "r") as f:
+        for line in csv.DictReader(f):
+            if line["publisher"] != "Springer Nature":
+                continue
+            doi = line["doi"]
+            journal_id = _get_local_springer_journal_id(doi, line["issn"])
+            if journal_id is not None:
+                pub_year = PERSISTENT_PUBDATES_CACHE.get(journal_id, {}).get(doi)
+                if pub_year is not None and _stats_cached(journal_id, pub_year):
+                    continue
+            payload = {"doi": doi, "issn": line["issn"], "period": line["period"],
+                       "title": line["journal_full_title"], "journal_id": journal_id}
+            items.append((DOI_TASK, doi, payload))
+    return items
+
+def _report_work_queue(work_queue, refetch):
+    """
+    Print the remaining work and an estimate of the number of requests
+    needed (an upper bound, responses may be served by the HTTP cache).
+    """
+    num_years = len(_catalogue_years())
+    num_stats = 0
+    unresolved = set()
+    journals = set()
+    retroactive = 0
+    for _, kind, payload in work_queue:
+        if kind == STATS_TASK:
+            num_stats += 1
+        elif payload["journal_id"] is None:
+            key = _journal_id_cache_key(payload["doi"], payload["issn"])
+            if not _journal_id_failed(key):
+                unresolved.add(key)
+        else:
+            journals.add(payload["journal_id"])
+            if not _stats_cached(payload["journal_id"], payload["period"]):
+                retroactive += 1
+    num_dois = len(work_queue) - num_stats
+    csv_requests = 0
+    for journal_id in journals:
+        csv_requests += len(_missing_journal_csv_years(journal_id, refetch))
+    csv_requests += len(unresolved) * num_years
+    estimate = 2 * num_stats + len(unresolved) + csv_requests + 2 * retroactive
+    msg = "Work queue: {} journal-year stats, {} articles in {} journals ({} journal IDs to be resolved)"
+    print(colorise(msg.format(num_stats, num_dois, len(journals) + len(unresolved), len(unresolved)), "cyan"))
+    msg = ("Estimated requests: at most {} ({} stats searches, {} landing pages, {} CSV exports, " +
+           "{} retroactive stats searches)")
+    print(colorise(msg.format(estimate, 2 * num_stats, len(unresolved), csv_requests, 2 * retroactive), "cyan"))
+
+def _process_transformative_agreements_row(doi, journal_id, period, title, refetch):
+    """
+    Look up the publication year of an article and make sure the coverage
+    stats for this year are present.
+
+    Returns:
+        A tuple (lookup_performed, found). found is False if the article
+        could not be found in the SpringerLink data.
+    """
+    lookup_performed = False
+    found = True
+    # Retreive publication dates for articles from CSV summaries on SpringerLink.
+    # Employ a multi-level cache structure to minimize IO:
+    #  1. try to look up the doi in the persistent publication dates cache
+    #  2. if the journal is not present, repopulate local cache segment from a CSV file in the journal CSV dir
+    #  3a. if no CSV for the journal could be found, fetch it from SpringerLink
+    #  3b. Alternative to 3: If a CSV was found but it does not contain the DOI, re-fetch it from SpringerLink 
+    try:
+        _ = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
+        print("Journal {} ('{}'): DOI {} already cached.".format(journal_id, title, doi))
+    except KeyError:
+        if journal_id not in TEMP_JOURNAL_CACHE:
+            msg = "Journal {} ('{}'): Not found in temp cache, repopulating..."
+            print(msg.format(journal_id, title))
+            TEMP_JOURNAL_CACHE[journal_id] = _get_journal_cache_from_csv(journal_id, refetch=False)
+        if doi not in TEMP_JOURNAL_CACHE[journal_id]:
+            if refetch:
+                msg = u"Journal {} ('{}'): DOI {} not found in cache, re-fetching csv file..."
+                print(msg.format(journal_id, title, doi))
+                TEMP_JOURNAL_CACHE[journal_id] = _get_journal_cache_from_csv(journal_id, refetch=True)
+            if doi not in TEMP_JOURNAL_CACHE[journal_id]:
+                msg = u"Journal {} ('{}'): DOI {} NOT FOUND in SpringerLink data!"
+                msg = colorise(msg.format(title, journal_id, doi), "red")
+                print(msg)
+                ERROR_MSGS.append(msg)
+                found = False
+        lookup_performed = True
+        if journal_id not in PERSISTENT_PUBDATES_CACHE:
+            PERSISTENT_PUBDATES_CACHE[journal_id] = {}
+        if found:
+            PERSISTENT_PUBDATES_CACHE[journal_id][doi] = TEMP_JOURNAL_CACHE[journal_id][doi]
+            STORE.put_pubdate(journal_id, doi, TEMP_JOURNAL_CACHE[journal_id][doi])
+            pub_year = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
+            compare_msg = u"DOI {} found in Springer data, Pub year is {} ".format(doi, pub_year)
+            if pub_year == period:
+                compare_msg += colorise("(same as transformative_agreements period)", "green")
+            else:
+                compare_msg += colorise("(DIFFERENT from transformative_agreements period, which is {})".format(period), "yellow")
+            msg = u"Journal {} ('{}'): ".format(journal_id, title)
+            print(msg.ljust(80) + compare_msg)
+    if found:
+        pub_year = PERSISTENT_PUBDATES_CACHE[journal_id][doi]
+    else:
+        # If a lookup error occured we will retreive coverage stats for the period year instead, since
+        # the aggregation process will make use of this value.
+        pub_year = period
+    # Test if journal stats are present
+    if not _stats_cached(journal_id, pub_year):
+        try:
+            _update_journal_stats(title, journal_id, pub_year)
+            lookup_performed = True
+            error_msg = ('No stats found for journal "{}" ({}) in {} albeit having ' +
+                         'downloaded the full Open Choice catalogue. Stats were ' +
+                         'obtained retroactively.')
+            error_msg = colorise(error_msg.format(title, journal_id, pub_year), "red")
+            print(error_msg)
+            ERROR_MSGS.append(error_msg)
+        except ValueError as ve:
+            error_msg = ('Critical Error while processing DOI {}: No stats found ' +
+                         ' for journal "{}" ({}) in {} albeit having downloaded the ' +
+                         'full Open Choice catalogue and stats could not be obtained ' +
+                         'retroactively (ValueError: {}).')
+            error_msg = colorise(error_msg.format(doi, title, journal_id, pub_year, str(ve)), "red")
+            print(error_msg)
+            ERROR_MSGS.append(error_msg)
+            _shutdown()
+    return lookup_performed, found
+
 def _get_journal_cache_from_csv(journal_id, refetch):
     """
-    Get a mapping dict (doi -> pub_year) from a SpringerLink CSV.
+    Get a mapping dict (doi -> pub_year) from the SpringerLink CSVs of a journal.
 
-    Open a Springerlink search results CSV file and obtain a doi -> pub_year
-    mapping from the "Item DOI" and "Publication Year" columns. Download the file
-    first if necessary or advised.
+    Open the Springerlink search results CSV files of a journal (one per
+    year, see _fetch_springer_journal_csv) and obtain a doi -> pub_year
+    mapping from the "Item DOI" and "Publication Year" columns. Download
+    missing files first, and with refetch those of the most recent years.
 
     Args:
         journal_id: The SpringerLink internal journal ID. Can be obtained
-                    using _get_springer_journal_id_from_doi()
-        refetch: Bool. If True, the CSV file will always be re-downloaded, otherwise
-                 a local copy will be tried first.
+                    using resolve_springer_journal_ids()
+        refetch: Bool. If True, the CSV files of the last JOURNAL_CSV_REFETCH_YEARS
+                 years will always be re-downloaded, otherwise local copies will be
+                 tried first.
 
     Returns:
         A dict with a doi -> pub_year mapping.
     """
-    path = os.path.join(JOURNAL_CSV_DIR, journal_id + ".csv")
-    if not os.path.isfile(path) or refetch:
-        _fetch_springer_journal_csv(path, journal_id)
+    if _missing_journal_csv_years(journal_id, refetch):
         msg = u"Journal {}: Fetching article CSV table from SpringerLink..."
         print(msg.format(journal_id))
-    with open(path) as p:
-        reader = csv.DictReader(p)
-        cache = {}
-        for line in reader:
-            doi = line["Item DOI"]
-            year = line["Publication Year"]
-            cache[doi] = year
-        return cache
-
-def _fetch_springer_journal_csv(path, journal_id):
-    current_year = datetime.datetime.now().year
-    years = range(2015, current_year + 1)
-    joint_lines = []
+        _fetch_springer_journal_csv(journal_id, refetch)
+    legacy_path = os.path.join(JOURNAL_CSV_DIR, journal_id + ".csv")
+    chunk_dir = os.path.join(JOURNAL_CSV_DIR, journal_id)
+    if os.path.isdir(chunk_dir):
+        paths = [os.path.join(chunk_dir, year + ".csv") for year in _catalogue_years()]
+    else:
+        paths = [legacy_path]
+    cache = {}
+    for path in paths:
+        with open(path) as p:
+            reader = csv.DictReader(p)
+            for line in reader:
+                doi = line["Item DOI"]
+                year = line["Publication Year"]
+                cache[doi] = year
+    return cache
+
+def _missing_journal_csv_years(journal_id, refetch=False):
+    """
+    The years for which the CSV file of a journal has to be (re-)downloaded.
+
+    Journal CSVs are stored per year (JOURNAL_CSV_DIR/<journal_id>/<year>.csv).
+    Older versions stored a single merged file (JOURNAL_CSV_DIR/<journal_id>.csv),
+    which is still read but replaced by per-year files on refetch.
+    """
+    years = _catalogue_years()
+    chunk_dir = os.path.join(JOURNAL_CSV_DIR, journal_id)
+    if not os.path.isdir(chunk_dir):
+        if os.path.isfile(os.path.join(JOURNAL_CSV_DIR, journal_id + ".csv")) and not refetch:
+            return []
+        return years
+    missing = [year for year in years if not os.path.isfile(os.path.join(chunk_dir, year + ".csv"))]
+    if refetch:
+        missing += [year for year in years[-JOURNAL_CSV_REFETCH_YEARS:] if year not in missing]
+    return missing
+
+def _fetch_springer_journal_csv(journal_id, refetch=False):
+    """
+    Download the missing CSV files of a journal (and with refetch those of
+    the most recent years) concurrently. Every response is streamed into its
+    own file, so files obtained before an error are kept for the next try.
+    """
+    chunk_dir = os.path.join(JOURNAL_CSV_DIR, journal_id)
+    os.makedirs(chunk_dir, exist_ok=True)
+    years = _missing_journal_csv_years(journal_id, refetch)
+    # A refetch revalidates cached files in any case
+    ttl = 0 if refetch else JOURNAL_CSV_TTL
+    args_list = []
     for year in years:
-        url = SPRINGER_GET_CSV.format(journal_id, year, year)
-        handle = urlopen(url)
-        if year > 2015:
-            handle.readline() # read the CSV header only once
-        for line in handle:
-            line = line.decode("utf-8")
-            if not line.endswith("\n"):
-                line += "\n"
-            joint_lines.append(line)
-    with open(path, "w") as f:
-        f.write("".join(joint_lines))
-
-def _get_springer_journal_id_from_doi(doi, issn=None):
-    global JOURNAL_ID_CACHE
+        url = SPRINGER_LINK_URL + SPRINGER_GET_CSV.format(journal_id, year, year)
+        args_list.append((url, os.path.join(chunk_dir, year + ".csv"), ttl))
+    results = FETCHER.map(FETCHER.download, args_list)
+    for _, error in results:
+        if error is not None:
+            raise error
+    legacy_path = os.path.join(JOURNAL_CSV_DIR, journal_id + ".csv")
+    if os.path.isfile(legacy_path):
+        os.remove(legacy_path)
+
+def _load_json_cache(path, name):
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            try:
+                cache = json.loads(f.read())
+                print(name + " cache file sucessfully loaded.")
+                if cache is not None:
+                    return cache
+            except ValueError:
+                print("Could not decode a cache structure from " + path + ", starting with an empty " + name + " cache.")
+    else:
+        print("No cache file (" + path + ") found, starting with an empty " + name + " cache.")
+    return {}
+
+def _load_journal_id_cache():
+    global JOURNAL_ID_CACHE, JOURNAL_ID_FAILURES
     if JOURNAL_ID_CACHE is None:
-        if os.path.isfile(JOURNAL_ID_CACHE_FILE):
-            with open(JOURNAL_ID_CACHE_FILE, "r") as f:
-                try:
-                    JOURNAL_ID_CACHE = json.loads(f.read())
-                    print("journal_id cache file sucessfully loaded.")
-                    if JOURNAL_ID_CACHE is None:
-                        JOURNAL_ID_CACHE = {}
-                except ValueError:
-                    print("Could not decode a cache structure from " + JOURNAL_ID_CACHE_FILE + ", starting with an empty journal_id cache.")
-                    JOURNAL_ID_CACHE = {}
-        else:
-            print("No cache file (" + JOURNAL_ID_CACHE_FILE + ") found, starting with an empty journal_id cache.")
-            JOURNAL_ID_CACHE = {}
-    if doi.startswith(("10.1007/s", "10.3758/s", "10.1245/s", "10.1617/s", "10.1186/s", "10.1208/s", "10.1365/s", "10.1038/s", "10.1057/s", "10.2478/s", "10.1557/s")):
+        JOURNAL_ID_CACHE = _load_json_cache(JOURNAL_ID_CACHE_FILE, "journal_id")
+    if JOURNAL_ID_FAILURES is None:
+        JOURNAL_ID_FAILURES = _load_json_cache(JOURNAL_ID_FAILURES_FILE, "journal_id failures")
+
+def _write_journal_id_caches():
+    with open(JOURNAL_ID_CACHE_FILE, "w") as f:
+        f.write(json.dumps(JOURNAL_ID_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
+        f.flush()
+    with open(JOURNAL_ID_FAILURES_FILE, "w") as f:
+        f.write(json.dumps(JOURNAL_ID_FAILURES, sort_keys=True, indent=4, separators=(',', ': ')))
+        f.flush()
+
+def _compile_prefix_rules(rules):
+    # One alternation with a named group per rule, alternatives are tried in
+    # order like a chain of startswith() checks
+    alternatives = []
+    for index, (prefixes, _) in enumerate(rules):
+        alternatives.append("(?P<rule{}>{})".format(index, "|".join([re.escape(prefix) for prefix in prefixes])))
+    return re.compile("|".join(alternatives))
+
+JOURNAL_ID_PREFIX_RE = _compile_prefix_rules(JOURNAL_ID_PREFIX_RULES)
+
+def _journal_id_rule(doi):
+    match = JOURNAL_ID_PREFIX_RE.match(doi)
+    if match is None:
+        raise ValueError(doi + " does not seem to be a Springer DOI (prefix not in list)!")
+    return JOURNAL_ID_PREFIX_RULES[int(match.lastgroup[len("rule"):])][1]
+
+def _journal_id_cache_key(doi, issn):
+    # Landing page results are cached per journal (ISSN), per article only if there is no ISSN
+    return issn or doi
+
+def _journal_id_failed(key):
+    failure = JOURNAL_ID_FAILURES.get(key)
+    return failure is not None and time.time() - failure["failed_at"] < JOURNAL_ID_FAILURE_TTL
+
+def _get_local_springer_journal_id(doi, issn=None):
+    """
+    Obtain the SpringerLink journal ID of a DOI without any network access.
+
+    Returns:
+        The journal ID or None if it can only be found on a landing page.
+
+    Raises:
+        ValueError if the DOI is not a Springer DOI.
+    """
+    _load_journal_id_cache()
+    rule = _journal_id_rule(doi)
+    if rule == JOURNAL_ID_FROM_DOI:
         return doi[9:14].lstrip("0")
-    elif doi.startswith(("10.14283")): # Irregular prefix, contains only the "Journal of Frailty & Aging"
-        return "42415"
-    elif doi.startswith(("10.1631")): # Irregular, "Journal of Zhejiang University-SCIENCE A"
-        return "11582"
-    elif doi.startswith(("10.3938/jkps")): # Irregular, "Journal of the Korean Physical Society"
-        return "40042"
-    elif doi.startswith(("10.1140","10.17269")):
-    # In case of these journals, the id cannot be extracted directly from the DOI. (EPJ family, Canadian Public Health Association)
-        if issn is None or issn not in JOURNAL_ID_CACHE:
-            print("No local journal id extraction possible for doi " + doi + ", analysing landing page...")
-            req = Request("https://doi.org/" + doi, None)
-            response = urlopen(req)
-            content = response.read()
-            content = content.decode("utf-8")
-            match = JOURNAL_ID_RE.search(content)
-            if match:
-                journal_id = match.groupdict()["journal_id"]
-                print("journal id found: " + journal_id)
-                if issn:
-                    JOURNAL_ID_CACHE[issn] = journal_id
-                return journal_id
-            else:
-                raise ValueError("Regex could not detect a journal id for doi " + doi)
-        else:
-            return JOURNAL_ID_CACHE[issn]
+    elif rule == JOURNAL_ID_FROM_LANDING_PAGE:
+        return JOURNAL_ID_CACHE.get(_journal_id_cache_key(doi, issn))
+    return rule
+
+def _fetch_landing_page_journal_id(doi):
+    content = FETCHER.fetch(DOI_RESOLVER_URL + "/" + doi, LANDING_PAGE_TTL)
+    content = content.decode("utf-8")
+    match = JOURNAL_ID_RE.search(content)
+    if match:
+        return match.groupdict()["journal_id"]
     else:
-        raise ValueError(doi + " does not seem to be a Springer DOI (prefix not in list)!") 
+        raise ValueError("Regex could not detect a journal id for doi " + doi)
+
+def resolve_springer_journal_ids(articles):
+    """
+    Obtain the SpringerLink journal IDs of many articles at once.
+
+    Most IDs follow from the DOI prefix (see JOURNAL_ID_PREFIX_RULES). For
+    the others, one landing page per journal (ISSN) is analysed, all of them
+    concurrently. Found IDs and failed lookups are both cached on disk,
+    failures are retried after JOURNAL_ID_FAILURE_TTL.
+
+    Args:
+        articles: An iterable of (doi, issn) tuples.
+
+    Returns:
+        A dict mapping every DOI to its journal ID, or to None if it could
+        not be resolved.
+
+    Raises:
+        ValueError if a DOI is not a Springer DOI.
+    """
+    _load_journal_id_cache()
+    journal_ids = {}
+    pending = {}
+    for doi, issn in articles:
+        if doi in journal_ids:
+            continue
+        journal_ids[doi] = _get_local_springer_journal_id(doi, issn)
+        if journal_ids[doi] is None:
+            pending.setdefault(_journal_id_cache_key(doi, issn), []).append(doi)
+    lookups = [(key, dois) for key, dois in pending.items() if not _journal_id_failed(key)]
+    if not lookups:
+        return journal_ids
+    msg = "No local journal id extraction possible for {} journals ({} DOIs), analysing landing pages..."
+    print(msg.format(len(lookups), sum([len(dois) for _, dois in lookups])))
+    results = FETCHER.map(_fetch_landing_page_journal_id, [(dois[0],) for _, dois in lookups])
+    for (key, dois), (journal_id, error) in zip(lookups, results):
+        if error is None:
+            print("journal id found for {}: {}".format(key, journal_id))
+            JOURNAL_ID_CACHE[key] = journal_id
+            JOURNAL_ID_FAILURES.pop(key, None)
+            if STORE is not None:
+                STORE.put_journal_id(key, journal_id)
+            for doi in dois:
+                journal_ids[doi] = journal_id
+            continue
+        if not isinstance(error, (ValueError, URLError)):
+            raise error
+        error_msg = colorise("Could not resolve the journal id for {} ({})".format(key, error), "red")
+        print(error_msg)
+        ERROR_MSGS.append(error_msg)
+        # Permanent failures are remembered, connection errors and the like are retried next time
+        if isinstance(error, ValueError) or (isinstance(error, HTTPError) and error.code not in RETRY_STATUS_CODES):
+            JOURNAL_ID_FAILURES[key] = {"doi": dois[0], "reason": str(error), "failed_at": time.time()}
+            if STORE is not None:
+                STORE.put_journal_id_failure(key, dois[0], str(error), JOURNAL_ID_FAILURES[key]["failed_at"])
+    _write_journal_id_caches()
+    return journal_ids
 
 def _get_springer_journal_stats(journal_id, period, oa=False):
     if not journal_id.isdigit():
         raise ValueError("Invalid journal id " + journal_id + " (not a number)")
-    url = SPRINGER_FULL_SEARCH.format(journal_id, period, period)
+    url = SPRINGER_LINK_URL + SPRINGER_FULL_SEARCH.format(journal_id, period, period)
     if oa:
-        url = SPRINGER_OA_SEARCH.format(journal_id, period, period)
+        url = SPRINGER_LINK_URL + SPRINGER_OA_SEARCH.format(journal_id, period, period)
     print(url)
-    try:
-        req = Request(url, None)
-        response = urlopen(req)
-        content = response.read()
-        content = content.decode("utf-8")
-        results = {}
-    except HTTPError as httpe:
-        if httpe.code == 503: # retry on timeout
-            print(colorise("Timeout (HTTP 503), retrying...", "yellow"))
-            return _get_springer_journal_stats(journal_id, period, oa)
-        else:
-            raise httpe
+    # Timeouts (HTTP 503) and other transient errors are retried by the fetcher
+    content = FETCHER.fetch(url, SEARCH_PAGE_TTL).decode("utf-8")
+    results = {}
     count_match = SEARCH_RESULTS_COUNT_RE.search(content)
     if count_match:
         count = count_match.groupdict()['count']
@@ -367,8 +721,7 @@ def _get_springer_journal_stats(journal_id, period, oa=False):
     title_match = SEARCH_RESULTS_TITLE_RE.search(content)
     if title_match:
         title = (title_match.groupdict()['title'])
-        htmlparser = HTMLParser()
-        results['title'] = htmlparser.unescape(title)
+        results['title'] = html.unescape(title)
     else:
         raise ValueError("Regex could not detect a journal title at " + url)
     return results
@@ -11,6 +11,7 @@ cd ~/dev/openapc-olap
 . venv/bin/activate
 python assets_generator.py tables
 python assets_generator.py model
+python assets_generator.py snapshots
 deactivate
 # Finally, copy the whole directory  
 sudo cp -r ~/dev/openapc-olap /var/www/wsgi-scripts
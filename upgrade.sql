@@ -0,0 +1,11 @@
+-- Databases set up with an older version of setup.sql have openapc_schema
+-- owned by postgres. The tables job builds into a staging schema and renames
+-- it to openapc_schema, which is only possible for the owner of the schema.
+-- Execute this script once via
+--     sudo -u postgres psql -f upgrade.sql
+-- before running the tables job on such a database.
+\c openapc_db;
+GRANT CREATE ON DATABASE openapc_db TO table_creator;
+ALTER SCHEMA openapc_schema OWNER TO table_creator;
+GRANT ALL PRIVILEGES ON SCHEMA openapc_schema TO table_creator WITH GRANT OPTION;
+GRANT USAGE ON SCHEMA openapc_schema TO cubes_user;